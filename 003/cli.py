@@ -0,0 +1,150 @@
+"""Command line entry point for tallying transactions.
+
+    python cli.py --rates data/RATES.xml --trans data/TRANS.csv --sku DM1182 --currency USD
+
+prints the total of each SKU in each currency. SKUs and currencies can be repeated or given as
+comma-separated lists; without --sku, every SKU is tallied. Only what the command needs is
+imported, so short invocations start quickly.
+"""
+
+import sys
+
+
+FORMATS = ('text', 'json', 'csv')
+
+
+def parseArgs(argv):
+    """Parse the command line arguments, e.g. parseArgs(['--sku', 'DM1182'])."""
+
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Tally the sales of items in one or more currencies.")
+    parser.add_argument('--rates', default='data/RATES.xml', help="rates XML file")
+    parser.add_argument('--trans', default='data/TRANS.csv',
+                        help="transactions CSV file, or a columnar file from columnfile.py")
+    parser.add_argument('--sku', action='append', default=[],
+                        help="SKU(s) to tally; all SKUs if not given")
+    parser.add_argument('--currency', action='append', default=[],
+                        help="currency or currencies to tally in; USD if not given")
+    parser.add_argument('--format', choices=FORMATS, default='text', help="output format")
+    parser.add_argument('--cache-dir', help="directory in which to cache compiled rate tables")
+    parser.add_argument('--stats', action='store_true',
+                        help="write counters and phase timings to stderr, as JSON")
+    parser.add_argument('--validate', action='store_true',
+                        help="report every bad row and missing conversion instead of tallying")
+
+    args = parser.parse_args(argv)
+    args.skus = [sku for value in args.sku for sku in value.split(',') if sku]
+    args.currencies = [currency for value in args.currency for currency in value.split(',')
+                       if currency] or ['USD']
+
+    return args
+
+
+def tally(args):
+    """Compute the totals asked for by the command line arguments.
+
+    Returns:
+        A list of (sku, currency, total) tuples, in the order of the SKUs asked for, or sorted
+        by SKU.
+    """
+
+    from main import InternationalTrade
+
+    if args.stats:
+        from instrument import Instrumentation
+        it = InternationalTrade(instrument=Instrumentation())
+    else:
+        it = InternationalTrade()
+
+    it.getRates(args.rates, cacheDir=args.cache_dir)
+
+    if len(args.skus) == 1:
+        totals = it.tallyCurrencies(args.trans, args.skus[0], args.currencies)
+        rows = [(args.skus[0], currency, totals[currency]) for currency in args.currencies]
+    else:
+        from decimal import Decimal
+
+        allTotals = it.tallyAllCurrencies(args.trans, args.currencies)
+        skus = args.skus or sorted(sku for (sku,) in allTotals[args.currencies[0]])
+        rows = [(sku, currency, allTotals[currency].get((sku,), Decimal("0.00")))
+                for sku in skus
+                for currency in args.currencies]
+
+    if args.stats:
+        print >> sys.stderr, it.instrument.toJson()
+
+    return rows
+
+
+def validate(args, out):
+    """Validate the transactions file for the currencies asked for, writing the problems found.
+
+    Returns:
+        Whether the file can be tallied.
+    """
+
+    from main import InternationalTrade
+
+    it = InternationalTrade()
+    it.getRates(args.rates, cacheDir=args.cache_dir)
+
+    report = it.validateTransactions(args.trans, args.currencies)
+    for line in report.lines():
+        out.write(line + '\n')
+    out.write("%d transactions, %d bad rows, %d missing conversions\n"
+              % (report.rowsParsed, len(report.badRows), len(report.missing)))
+
+    return report.ok()
+
+
+def write(rows, format, out):
+    """Write (sku, currency, total) rows in a format: 'text', 'json' or 'csv'."""
+
+    if format == 'json':
+        import json
+
+        json.dump([{'sku': sku, 'currency': currency, 'total': str(total)}
+                   for sku, currency, total in rows], out)
+        out.write('\n')
+
+    elif format == 'csv':
+        import csv
+
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(('sku', 'currency', 'total'))
+        writer.writerows(rows)
+
+    else:
+        for sku, currency, total in rows:
+            out.write("%s %s %s\n" % (sku, currency, total))
+
+
+def main(argv=None, out=sys.stdout):
+    """Run the command line.
+
+    Returns:
+        The exit status: 0, or 1 if the tally failed or validation found problems.
+    """
+
+    args = parseArgs(argv)
+
+    try:
+        if args.validate:
+            return 0 if validate(args, out) else 1
+
+        rows = tally(args)
+    except SystemExit as e:
+        # The tally aborts with a message on a missing rate or an unreadable file:
+        return e.code or 1
+    except IOError as e:
+        print >> sys.stderr, "Unable to tally\n(%s)" % e
+        return 1
+
+    write(rows, args.format, out)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
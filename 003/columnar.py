@@ -0,0 +1,394 @@
+from array import array
+from collections import defaultdict
+from decimal import Decimal, ROUND_HALF_EVEN
+
+from transsource import TransactionSource
+
+
+# NumPy, once loadNumpy has imported it; None if it isn't installed:
+numpy = False
+
+
+class TransactionColumns():
+    """Transactions stored column by column.
+
+    Amounts are kept as integer cents and the store, SKU and currency of each transaction are
+    kept as small integer codes into lists of names, so a file of millions of transactions costs
+    a few bytes per row instead of several Python objects per row. The rare amounts with
+    fractions of a cent don't fit in cents; their rows are kept aside, with the amounts as
+    strings, and converted with Decimal arithmetic.
+
+    Attributes:
+        cents (array of int): Transaction amounts in cents.
+        currencies (array of int): Currency code of each transaction.
+        skus (array of int): SKU code of each transaction.
+        stores (array of int): Store code of each transaction.
+
+        currencyNames (list of str): Currency of each currency code.
+        skuNames (list of str): SKU of each SKU code.
+        storeNames (list of str): Store of each store code.
+
+        inexact (list of tuple): (store code, SKU code, amount, currency code) of each
+                                 transaction whose amount has fractions of a cent.
+
+    """
+
+    def __init__(self):
+        """Inits an empty TransactionColumns."""
+
+        self.cents = array('l')
+        self.currencies = array('H')
+        self.skus = array('I')
+        self.stores = array('I')
+
+        self.currencyNames = []
+        self.skuNames = []
+        self.storeNames = []
+
+        self.inexact = []
+
+        self._codes = (dict(), dict(), dict())
+
+
+    def __len__(self):
+        return len(self.cents) + len(self.inexact)
+
+
+    def append(self, store, sku, cents, currency):
+        """Add a transaction to the columns.
+
+        Args:
+            store (str): Store where the item was sold.
+            sku (str): Item's SKU number.
+            cents (int): Transaction amount in cents.
+            currency (str): Transaction's currency type.
+
+        """
+
+        storeCodes, skuCodes, currencyCodes = self._codes
+
+        self.cents.append(cents)
+        self.currencies.append(_intern(currencyCodes, self.currencyNames, currency))
+        self.skus.append(_intern(skuCodes, self.skuNames, sku))
+        self.stores.append(_intern(storeCodes, self.storeNames, store))
+
+
+    def appendInexact(self, store, sku, amt, currency):
+        """Add a transaction whose amount, such as '1.005', has fractions of a cent."""
+
+        storeCodes, skuCodes, currencyCodes = self._codes
+
+        self.inexact.append((_intern(storeCodes, self.storeNames, store),
+                             _intern(skuCodes, self.skuNames, sku), amt,
+                             _intern(currencyCodes, self.currencyNames, currency)))
+
+
+    def code(self, names, name):
+        """Look up the code of a name, e.g. code(columns.skuNames, 'DM1182').
+
+        Returns:
+            The integer code or None if the name never appears in the columns.
+        """
+
+        try:
+            return names.index(name)
+        except ValueError:
+            return None
+
+
+def loadNumpy():
+    """Import NumPy the first time it's needed, as importing it takes longer than most tallies.
+
+    Returns:
+        The numpy module, or None if it isn't installed.
+    """
+
+    global numpy
+
+    if numpy is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+    return numpy
+
+
+def _intern(codes, names, name):
+    """Return the code for a name, assigning the next free code to new names."""
+
+    try:
+        return codes[name]
+    except KeyError:
+        codes[name] = len(names)
+        names.append(name)
+        return codes[name]
+
+
+def toCents(amt):
+    """Convert an amount string such as '84.16' to integer cents.
+
+    Raises:
+        ValueError: The amount isn't a number or has fractions of a cent.
+    """
+
+    if amt[-3:-2] == '.':
+        return int(amt[:-3] + amt[-2:])
+
+    cents = Decimal(amt).scaleb(2)
+    if cents != cents.to_integral_value():
+        raise ValueError("Fractional cents in amount %s" % amt)
+
+    return int(cents)
+
+
+def readColumns(transFile):
+    """Read a transactions CSV file into TransactionColumns.
+
+    Rows whose amount field isn't an amount followed by a currency, such as the header row, are
+    skipped, as getTransactions does. Amounts with fractions of a cent are kept aside (see
+    TransactionColumns).
+
+    Args:
+        transFile (str): A path to the transactions file.
+
+    Returns:
+        The TransactionColumns holding every transaction in the file.
+
+    Raises:
+        InvalidOperation: An amount isn't a number, as in tallyTransactions.
+    """
+
+    columns = TransactionColumns()
+
+    for store, sku, amt, currency in TransactionSource(transFile):
+        try:
+            cents = toCents(amt)
+        except ValueError:
+            Decimal(amt)
+            columns.appendInexact(store, sku, amt, currency)
+            continue
+
+        columns.append(store, sku, cents, currency)
+
+    return columns
+
+
+def convertCents(cents, rate):
+    """Convert an amount in cents, rounding to the nearest cent the same way tallyTransactions does.
+
+    Returns:
+        The converted amount in cents.
+    """
+
+    return convertAmount(Decimal(cents).scaleb(-2), rate)
+
+
+def convertAmount(amt, rate):
+    """Convert an amount, such as '1.005', rounding to the nearest cent as tallyTransactions does.
+
+    Returns:
+        The converted amount in cents.
+    """
+
+    converted = (Decimal(amt) * rate).quantize(Decimal("0.01"), rounding=ROUND_HALF_EVEN)
+    return int(converted.scaleb(2))
+
+
+def sumConverted(columns, item, rates):
+    """Sum the rounded, converted amounts of the selected transactions.
+
+    Every row is still rounded on its own, but the rounding is only done once for each distinct
+    (currency, amount) pair; the rest of the work is done on whole columns, with NumPy when it's
+    installed.
+
+    Args:
+        columns (TransactionColumns): The transactions.
+        item (str): The SKU of the desired item or None for all items.
+        rates (dict of Decimal): Conversion rate into the desired currency, keyed by currency;
+                                 None for currencies that can't be converted.
+
+    Returns:
+        The total in cents.
+
+    Raises:
+        KeyError: A selected transaction's currency can't be converted.
+    """
+
+    if item:
+        skuCode = columns.code(columns.skuNames, item)
+        if skuCode is None:
+            return 0
+
+    if loadNumpy() is not None:
+        counts = _countAmountsVectorized(columns, skuCode if item else None)
+    else:
+        counts = _countAmounts(columns, skuCode if item else None)
+
+    total = 0
+    for (currencyCode, cents), count in counts.items():
+        currency = columns.currencyNames[currencyCode]
+        if rates.get(currency) is None:
+            raise KeyError(currency)
+
+        total += convertCents(cents, rates[currency]) * count
+
+    for storeCode, sku, amt, currencyCode in columns.inexact:
+        if not item or sku == skuCode:
+            currency = columns.currencyNames[currencyCode]
+            if rates.get(currency) is None:
+                raise KeyError(currency)
+
+            total += convertAmount(amt, rates[currency])
+
+    return total
+
+
+def countGroups(columns, by, items=None):
+    """Count how often each amount occurs in each group of transactions, per currency.
+
+    This is the first half of sumGroups: the counts can be converted into any number of target
+    currencies without going through the columns again.
+
+    Args:
+        columns (TransactionColumns): The transactions.
+        by (tuple of str): Fields to group by; any of 'store', 'sku' and 'currency'.
+        items (opt list of str): SKUs of the only items to count; None for all items.
+
+    Returns:
+        A dictionary of counts keyed by (group, currency code, amount), where group is a tuple
+        of the values of the 'by' fields and amount is in cents, or a string for the amounts
+        with fractions of a cent.
+    """
+
+    fields = {'store': (columns.stores, columns.storeNames, 0),
+              'sku': (columns.skus, columns.skuNames, 1),
+              'currency': (columns.currencies, columns.currencyNames, 3)}
+    keyColumns = [fields[field][0] for field in by] + [columns.currencies, columns.cents]
+
+    skuCodes = None
+    if items is not None:
+        skuCodes = set(columns.code(columns.skuNames, item) for item in items) - set([None])
+
+    if not len(columns.cents) or skuCodes == set():
+        rows = []
+    elif loadNumpy() is not None:
+        keyColumns = [_view(values) for values in keyColumns]
+        if skuCodes is not None:
+            selected = numpy.in1d(_view(columns.skus), sorted(skuCodes))
+            keyColumns = [values[selected] for values in keyColumns]
+
+        keys = numpy.column_stack([values.astype(numpy.int64) for values in keyColumns])
+        keys, keyCounts = numpy.unique(keys, axis=0, return_counts=True)
+        rows = zip(map(tuple, keys.tolist()), keyCounts.tolist())
+    else:
+        rows = defaultdict(int)
+        if skuCodes is None:
+            for key in zip(*keyColumns):
+                rows[key] += 1
+        else:
+            for key in zip(columns.skus, *keyColumns):
+                if key[0] in skuCodes:
+                    rows[key[1:]] += 1
+        rows = rows.items()
+
+    counts = defaultdict(int)
+    for key, count in rows:
+        group = tuple(fields[field][1][code] for field, code in zip(by, key))
+        counts[(group, key[-2], key[-1])] += count
+
+    for row in columns.inexact:
+        if skuCodes is not None and row[1] not in skuCodes:
+            continue
+        group = tuple(fields[field][1][row[fields[field][2]]] for field in by)
+        counts[(group, row[3], row[2])] += 1
+
+    return counts
+
+
+def sumGroups(columns, counts, rates):
+    """Sum the rounded, converted amounts of each group counted by countGroups.
+
+    Args:
+        columns (TransactionColumns): The transactions that were counted.
+        counts (dict of int): The counts returned by countGroups.
+        rates (dict of Decimal): Conversion rate into the desired currency, keyed by currency;
+                                 None for currencies that can't be converted.
+
+    Returns:
+        A dictionary of totals in cents, keyed by group.
+
+    Raises:
+        KeyError: A transaction's currency can't be converted.
+    """
+
+    totals = defaultdict(int)
+    # The same amount often occurs in several groups; it's only converted once:
+    converted = {}
+
+    for (group, currencyCode, amount), count in counts.items():
+        try:
+            cents = converted[(currencyCode, amount)]
+        except KeyError:
+            currency = columns.currencyNames[currencyCode]
+            if rates.get(currency) is None:
+                raise KeyError(currency)
+
+            if isinstance(amount, str):
+                cents = convertAmount(amount, rates[currency])
+            else:
+                cents = convertCents(amount, rates[currency])
+            converted[(currencyCode, amount)] = cents
+
+        totals[group] += cents * count
+
+    return dict(totals)
+
+
+def _countAmounts(columns, skuCode):
+    """Count how often each (currency code, cents) pair occurs among the selected rows."""
+
+    counts = defaultdict(int)
+
+    if skuCode is None:
+        for currencyCode, cents in zip(columns.currencies, columns.cents):
+            counts[(currencyCode, cents)] += 1
+    else:
+        for currencyCode, cents, sku in zip(columns.currencies, columns.cents, columns.skus):
+            if sku == skuCode:
+                counts[(currencyCode, cents)] += 1
+
+    return counts
+
+
+def _view(values):
+    """View a column as a NumPy array, without copying it.
+
+    Columns read from a CSV file are arrays, whose item sizes depend on the platform (a C long
+    is only 4 bytes on some), so they're viewed with the dtype of their typecode.
+    """
+
+    if isinstance(values, array):
+        return numpy.frombuffer(values, dtype=values.typecode)
+
+    return values
+
+
+def _countAmountsVectorized(columns, skuCode):
+    """NumPy version of _countAmounts."""
+
+    cents = _view(columns.cents)
+    currencies = _view(columns.currencies)
+
+    if skuCode is not None:
+        selected = _view(columns.skus) == skuCode
+        cents = cents[selected]
+        currencies = currencies[selected]
+
+    counts = {}
+    for currencyCode in numpy.unique(currencies):
+        amounts, amountCounts = numpy.unique(cents[currencies == currencyCode], return_counts=True)
+        for amount, count in zip(amounts.tolist(), amountCounts.tolist()):
+            counts[(int(currencyCode), amount)] = count
+
+    return counts
@@ -0,0 +1,176 @@
+"""Binary columnar transaction files.
+
+    python columnfile.py data/TRANS.csv data/TRANS.cols
+
+converts a transactions CSV file once, after which tallies read the binary file instead of
+parsing text: tallyTransactions and getColumns accept either kind of file.
+"""
+
+from array import array
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+from columnar import TransactionColumns, loadNumpy, readColumns
+
+
+MAGIC = 'TRNCOL1\n'
+
+# Column name, array typecode and NumPy dtype, in file order:
+COLUMNS = (('cents', 'l', '<i8'), ('skus', 'I', '<u4'), ('stores', 'I', '<u4'),
+           ('currencies', 'H', '<u2'))
+
+# struct format of each dtype, for platforms where an array typecode has another size (a C long
+# is only 4 bytes on some):
+STRUCT_FORMATS = {'<i8': 'q', '<u4': 'I', '<u2': 'H'}
+
+# Number of values packed with struct at a time:
+PACK_SIZE = 1 << 16
+
+
+def isColumnFile(path):
+    """Returns: Whether a file is a binary columnar transactions file."""
+
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def writeColumnFile(columns, path):
+    """Write transactions to a binary columnar file.
+
+    The file is laid out as:
+        - MAGIC
+        - the length of the header, as a little-endian unsigned 64 bit integer
+        - the JSON header: the number of rows, the currency, SKU and store names and the rows
+          with fractions of a cent, padded with spaces to a multiple of 8 bytes
+        - the columns, each a little-endian array of one value per row, in the order of COLUMNS:
+          int64 cents, uint32 SKU codes, uint32 store codes and uint16 currency codes
+    so every column starts suitably aligned for memory mapping. The file is written to a
+    temporary file and renamed into place.
+
+    Args:
+        columns (TransactionColumns): The transactions.
+        path (str): Path of the columnar file.
+
+    """
+
+    header = json.dumps({'rows': len(columns.cents), 'currencies': columns.currencyNames,
+                         'skus': columns.skuNames, 'stores': columns.storeNames,
+                         'inexact': columns.inexact})
+    header += ' ' * (-(len(MAGIC) + 8 + len(header)) % 8)
+
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+
+            for name, typecode, dtype in COLUMNS:
+                values = array(typecode, getattr(columns, name))
+
+                if values.itemsize != int(dtype[2:]):
+                    for i in range(0, len(values), PACK_SIZE):
+                        chunk = values[i:i + PACK_SIZE]
+                        f.write(struct.pack('<%d%s' % (len(chunk), STRUCT_FORMATS[dtype]), *chunk))
+                    continue
+
+                if sys.byteorder == 'big':
+                    values.byteswap()
+                values.tofile(f)
+
+        os.rename(tmpPath, path)
+    except:
+        os.remove(tmpPath)
+        raise
+
+
+def convertTransactions(transFile, columnFile):
+    """Convert a transactions CSV file to a binary columnar file.
+
+    Args:
+        transFile (str): A path to the transactions file.
+        columnFile (str): Path of the columnar file to write.
+
+    Returns:
+        The number of transactions written.
+    """
+
+    columns = readColumns(transFile)
+    writeColumnFile(columns, columnFile)
+
+    return len(columns)
+
+
+def mapColumns(path):
+    """Memory-map a binary columnar file as TransactionColumns.
+
+    With NumPy installed, the columns are read-only arrays over the mapped file, so nothing is
+    read until it's used. Without it, each column is copied out of the map into an array, which
+    still costs no parsing.
+
+    Args:
+        path (str): Path of the columnar file.
+
+    Returns:
+        The TransactionColumns; they can't be appended to.
+
+    Raises:
+        ValueError: The file isn't a columnar transactions file.
+    """
+
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s isn't a columnar transactions file" % path)
+
+        (length,) = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(length))
+
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    columns = TransactionColumns()
+    columns.currencyNames = [name.encode('utf-8') for name in header['currencies']]
+    columns.skuNames = [name.encode('utf-8') for name in header['skus']]
+    columns.storeNames = [name.encode('utf-8') for name in header['stores']]
+    columns.inexact = [(store, sku, amt.encode('utf-8'), currency)
+                       for store, sku, amt, currency in header.get('inexact', [])]
+
+    numpy = loadNumpy()
+    rows = header['rows']
+    offset = len(MAGIC) + 8 + length
+
+    for name, typecode, dtype in COLUMNS:
+        size = int(dtype[2:])
+
+        if numpy is not None:
+            values = numpy.frombuffer(data, dtype=dtype, count=rows, offset=offset)
+        elif array(typecode).itemsize != size:
+            values = array(typecode, struct.unpack('<%d%s' % (rows, STRUCT_FORMATS[dtype]),
+                                                   data[offset:offset + rows * size]))
+        else:
+            values = array(typecode, data[offset:offset + rows * size])
+            if sys.byteorder == 'big':
+                values.byteswap()
+
+        setattr(columns, name, values)
+        offset += rows * size
+
+    # Keep the map open for as long as the columns are used:
+    columns._map = data
+
+    return columns
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Convert a transactions CSV file to a binary columnar file.")
+    parser.add_argument('trans', help="transactions CSV file")
+    parser.add_argument('columns', help="columnar file to write")
+    args = parser.parse_args()
+
+    print "Wrote %d transactions to %s" % (convertTransactions(args.trans, args.columns),
+                                           args.columns)
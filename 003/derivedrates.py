@@ -0,0 +1,137 @@
+from collections import OrderedDict
+import threading
+
+
+class DerivedRateCache():
+    """Bounded, thread-safe cache of derived conversion rates, keyed by ('from', 'to').
+
+    The least recently used entries are evicted once the cache holds maxSize of them. That only
+    bounds this cache: the rates it holds are looked up in a RateClosure, which keeps the rate
+    and path of every pair of currencies however small maxSize is. When several threads ask for
+    the same missing pair at once, only the first computes it; the others wait for its result
+    instead of each running the search again.
+
+    Attributes:
+        maxSize (int): Largest number of entries kept.
+        hits (int): Number of lookups answered from the cache.
+        misses (int): Number of lookups that had to compute their rate.
+        waits (int): Number of lookups that waited for another thread's computation.
+        evictions (int): Number of entries evicted to stay within maxSize.
+
+    """
+
+    def __init__(self, maxSize=1024):
+        """Inits an empty DerivedRateCache.
+
+        Args:
+            maxSize (opt int): Largest number of entries kept.
+
+        """
+
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def get(self, key, compute):
+        """Look up a rate, computing it if it isn't cached.
+
+        Args:
+            key (tuple of str): The ('from', 'to') pair.
+            compute (callable): Called without arguments to compute the rate on a miss.
+
+        Returns:
+            The rate, which may be None for pairs that can't be converted.
+
+        Raises:
+            Any exception raised by compute, in every thread waiting for it.
+        """
+
+        with self._lock:
+            if key in self._entries:
+                value = self._entries.pop(key)
+                self._entries[key] = value
+                self.hits += 1
+                return value
+
+            flight = self._pending.get(key)
+            if flight is not None:
+                self.waits += 1
+            else:
+                flight = self._pending[key] = _Flight(self._generation)
+                self.misses += 1
+
+        if flight.owner is not threading.current_thread():
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = compute()
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            with self._lock:
+                # Don't keep a rate computed from rates that changed meanwhile:
+                if flight.generation == self._generation:
+                    self._entries[key] = flight.value
+                    while len(self._entries) > self.maxSize:
+                        self._entries.popitem(last=False)
+                        self.evictions += 1
+        finally:
+            with self._lock:
+                if self._pending.get(key) is flight:
+                    del self._pending[key]
+            flight.done.set()
+
+        return flight.value
+
+
+    def invalidate(self, isStale):
+        """Forget the entries whose rate may have changed, e.g. after a known rate changes.
+
+        Rates being computed meanwhile aren't kept, as they may be stale too.
+
+        Args:
+            isStale (callable): Called with the key of each entry; returns whether to forget it.
+
+        """
+
+        with self._lock:
+            for key in [key for key in self._entries if isStale(key)]:
+                del self._entries[key]
+            self._pending.clear()
+            self._generation += 1
+
+
+    def clear(self):
+        """Forget every entry, e.g. after the known rates change."""
+
+        with self._lock:
+            self._entries.clear()
+            self._pending.clear()
+            self._generation += 1
+
+
+class _Flight():
+    """A computation of a missing rate that other threads can wait for."""
+
+    def __init__(self, generation):
+        self.owner = threading.current_thread()
+        self.generation = generation
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
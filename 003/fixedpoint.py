@@ -0,0 +1,72 @@
+from decimal import getcontext
+
+
+def roundHalfEven(n, d):
+    """Divide integers, rounding halves to even (banker's rounding).
+
+    Args:
+        n (int): Dividend.
+        d (int): Divisor; must be positive.
+
+    Returns:
+        n / d rounded to the nearest integer, halves going to the even one.
+    """
+
+    (q, r) = divmod(n, d)
+    if 2 * r > d or (2 * r == d and q & 1):
+        q += 1
+
+    return q
+
+
+def roundDigits(n, prec):
+    """Round an integer to a number of significant digits, as a Decimal context does.
+
+    Returns:
+        n with all but its first prec digits rounded to zeros, halves going to even.
+    """
+
+    digits = len(str(abs(n)))
+    if digits <= prec:
+        return n
+
+    scale = 10 ** (digits - prec)
+    return roundHalfEven(n, scale) * scale
+
+
+def fixedConverter(rate):
+    """Make a function that converts integer cents at a rate, using only integer arithmetic.
+
+    The rate is scaled to an integer once. Converting then costs an integer multiply and a
+    divmod, and gives exactly the cents that tallyTransactions' Decimal arithmetic gives: the
+    product is rounded to the context's precision when it has more digits than that, and then
+    to the nearest cent with banker's rounding.
+
+    Args:
+        rate (Decimal): Conversion rate.
+
+    Returns:
+        A function taking an amount in cents and returning the converted amount in cents.
+    """
+
+    prec = getcontext().prec
+    (sign, digits, exponent) = rate.as_tuple()
+
+    coefficient = int(''.join(map(str, digits)))
+    if sign:
+        coefficient = -coefficient
+
+    # Products of amounts smaller than this can't have more digits than the precision:
+    limit = 10 ** max(prec - len(digits), 0)
+
+    multiplier = 10 ** max(exponent, 0)
+    divisor = 10 ** max(-exponent, 0)
+
+    def convert(cents):
+        product = cents * coefficient
+        if not -limit < cents < limit:
+            product = roundDigits(product, prec)
+
+        return roundHalfEven(product * multiplier, divisor)
+
+    return convert
@@ -0,0 +1,82 @@
+import cPickle as pickle
+import hashlib
+import os
+import tempfile
+
+
+def completeEnd(transFile, blockSize=1 << 16):
+    """Find the end of the last complete row of a file that may still be being written.
+
+    Returns:
+        The offset just past the file's last newline, or 0 if it has none.
+    """
+
+    with open(transFile, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+
+        while end > 0:
+            start = max(0, end - blockSize)
+            f.seek(start)
+            newline = f.read(end - start).rfind('\n')
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+
+    return 0
+
+
+def fileIdentity(transFile, offset, blockSize=1 << 16):
+    """Identify a file and its content up to an offset, to tell whether it has been replaced.
+
+    Returns:
+        A tuple of the file's device and inode numbers and a SHA-1 digest of the first and last
+        blockSize bytes before offset, so checking it costs the same whatever the file's size.
+    """
+
+    with open(transFile, 'rb') as f:
+        stat = os.fstat(f.fileno())
+
+        digest = hashlib.sha1(str(offset))
+        digest.update(f.read(min(offset, blockSize)))
+        if offset > blockSize:
+            f.seek(max(blockSize, offset - blockSize))
+            digest.update(f.read(offset - f.tell()))
+
+    return (stat.st_dev, stat.st_ino, digest.hexdigest())
+
+
+def loadState(stateFile):
+    """Load the state saved by saveState.
+
+    Returns:
+        The state dictionary, or None if there isn't a readable state file.
+    """
+
+    try:
+        with open(stateFile, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def saveState(stateFile, state):
+    """Save the state of an incremental tally, replacing the state file atomically.
+
+    Args:
+        stateFile (str): Path of the state file.
+        state (dict): The state: 'offset' processed up to, the 'identity' of the file up to it
+                      (see fileIdentity), 'toCurrency', the 'rates' used, keyed by transaction
+                      currency, and the rounded 'totals', keyed by (sku, currency).
+
+    """
+
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(stateFile)),
+                                   suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpPath, stateFile)
+    except:
+        os.remove(tmpPath)
+        raise
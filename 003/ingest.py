@@ -0,0 +1,198 @@
+"""Concurrent ingestion of many transaction files, e.g. one per store.
+
+Reader threads read the files in blocks of whole lines, a pool of processes parses and tallies
+the blocks, and the calling thread adds up the workers' partial totals as they arrive. The
+readers wait while the queue of blocks is full and no more blocks are handed to the workers than
+they are tallying, so memory stays bounded however many files there are, and the files are read
+concurrently rather than one after another.
+"""
+
+from collections import defaultdict, deque
+from decimal import Decimal, ROUND_HALF_EVEN
+import glob
+from multiprocessing import Pool, cpu_count
+import os
+from Queue import Queue
+import threading
+
+from transsource import TransactionSource
+
+
+# Conversion rates into the desired currency, set once in each worker process by _initWorker:
+_rates = None
+
+
+def _initWorker(rates):
+    global _rates
+    _rates = rates
+
+
+def _tallyBlock(args):
+    """Tally the transactions in a block of lines, per SKU.
+
+    Args:
+        args (tuple): (transFile, lines): the file the lines are from and the lines themselves.
+
+    Returns:
+        A tuple with the following:
+
+        totals (dict of Decimal): Rounded totals, keyed by SKU.
+        missing (set of str): Currencies of transactions that can't be converted.
+        rowsParsed (int): Number of transactions in the block.
+        rowsSkipped (int): Number of lines that aren't transactions, such as headers.
+    """
+
+    (transFile, lines) = args
+
+    totals = defaultdict(Decimal)
+    missing = set()
+    source = TransactionSource(transFile, lines=lines)
+
+    for store, sku, amt, currency in source:
+        rate = _rates.get(currency)
+        if rate is None:
+            missing.add(currency)
+            continue
+
+        totals[sku] += (Decimal(amt) * rate).quantize(Decimal("0.01"), rounding=ROUND_HALF_EVEN)
+
+    return dict(totals), missing, source.rowsParsed, source.rowsSkipped
+
+
+def findFiles(pattern):
+    """Find the transaction files to ingest.
+
+    Args:
+        pattern (str): A directory, whose *.csv files are used, or a glob pattern.
+
+    Returns:
+        The sorted list of paths.
+    """
+
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.csv')
+
+    return sorted(path for path in glob.glob(pattern) if os.path.isfile(path))
+
+
+def _readFiles(paths, blocks, blockSize):
+    """Read files from a queue of paths, putting blocks of whole lines on a queue of blocks.
+
+    Puts (transFile, lines) for each block, then None once there are no more paths. An error
+    is put on the queue instead, to be raised by the thread that takes it.
+    """
+
+    try:
+        while True:
+            try:
+                transFile = paths.pop()
+            except IndexError:
+                break
+
+            with open(transFile, 'rb') as f:
+                partial = ''
+                while True:
+                    data = f.read(blockSize)
+                    if not data:
+                        break
+
+                    data = partial + data
+                    cut = data.rfind('\n') + 1
+                    partial = data[cut:]
+                    if cut:
+                        # Blocks until the workers have caught up:
+                        blocks.put((transFile, data[:cut].splitlines()))
+
+                if partial:
+                    blocks.put((transFile, partial.splitlines()))
+    except Exception as e:
+        blocks.put(e)
+    finally:
+        blocks.put(None)
+
+
+def tallyFiles(transFiles, rates, readers=4, processes=None, blockSize=1 << 20, queued=None):
+    """Tally many transaction files concurrently, per SKU.
+
+    Each row is rounded before it's added, so the totals are exactly those of tallying the
+    concatenated files in a single process.
+
+    Args:
+        transFiles (list of str): Paths to the transactions files.
+        rates (dict of Decimal): Conversion rate into the desired currency, keyed by currency;
+                                 None for currencies that can't be converted.
+        readers (opt int): Number of threads reading files at once.
+        processes (opt int): Number of worker processes; defaults to the number of CPUs.
+        blockSize (opt int): Number of bytes read at a time.
+        queued (opt int): Largest number of blocks read but not yet tallied, waiting or in the
+                          workers; defaults to twice the number of processes. At most about
+                          (queued + readers) * blockSize bytes are held at once.
+
+    Returns:
+        A tuple with the following:
+
+        totals (dict of Decimal): Rounded totals, keyed by SKU.
+        missing (set of str): Currencies of transactions that can't be converted.
+        rowsParsed (int): Number of transactions tallied.
+        rowsSkipped (int): Number of lines that aren't transactions, such as headers.
+
+    Raises:
+        IOError: A file can't be read.
+    """
+
+    processes = processes or cpu_count()
+    queued = queued or 2 * processes
+    readers = max(1, min(readers, len(transFiles)))
+
+    totals = defaultdict(Decimal)
+    missing = set()
+    counts = [0, 0]
+
+    def add(result):
+        partialTotals, partialMissing, rowsParsed, rowsSkipped = result
+        for sku, subtotal in partialTotals.items():
+            totals[sku] += subtotal
+        missing.update(partialMissing)
+        counts[0] += rowsParsed
+        counts[1] += rowsSkipped
+
+    # Started before the reader threads, as forking a process that runs threads isn't safe:
+    pool = Pool(processes, initializer=_initWorker, initargs=(rates,))
+
+    paths = list(reversed(transFiles))
+    blocks = Queue(max(1, queued - processes))
+    threads = [threading.Thread(target=_readFiles, args=(paths, blocks, blockSize))
+               for i in range(readers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    pending = deque()
+    error = None
+    try:
+        running = readers
+        while running:
+            block = blocks.get()
+            if block is None:
+                running -= 1
+                continue
+            if isinstance(block, Exception):
+                error = error or block
+                continue
+            if error is not None:
+                continue
+
+            if len(pending) >= processes:
+                add(pending.popleft().get())
+            pending.append(pool.apply_async(_tallyBlock, (block,)))
+
+        if error is not None:
+            raise error
+
+        while pending:
+            add(pending.popleft().get())
+    finally:
+        pool.close()
+        pool.join()
+
+    return dict(totals), missing, counts[0], counts[1]
@@ -0,0 +1,117 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import json
+from timeit import default_timer
+
+
+class Instrumentation():
+    """Counters and phase timings collected while loading rates and tallying transactions.
+
+    Everything is counted per phase or per scan, never per row, so collecting costs next to
+    nothing. The counters are:
+        rowsParsed, rowsSkipped: Transaction rows read, and rows skipped as bad input.
+        rateHits, rateMisses: Rows whose conversion rate was already at hand during a tally, and
+                              rates that had to be looked up in (or derived by) the RateClosure.
+        searches, nodesVisited, searchDepth: Rate graph searches run to derive missing rates,
+                                             currencies visited by them, and the longest path
+                                             found.
+    The phases timed are parseRates, derive, scan (reading transactions; for the streaming
+    tallies this includes converting and summing them) and sum (tallying in-memory columns).
+
+    Attributes:
+        counters (dict of int): Counters, keyed by name.
+        timings (dict of float): Seconds spent in each phase, keyed by phase.
+        hook (callable): Called as hook(phase, seconds, counters) at the end of every phase.
+
+    """
+
+    enabled = True
+
+    def __init__(self, hook=None):
+        """Inits Instrumentation.
+
+        Args:
+            hook (opt callable): Called as hook(phase, seconds, counters) at the end of every
+                                 phase, e.g. to forward the numbers to a metrics system.
+
+        """
+
+        self.counters = defaultdict(int)
+        self.timings = defaultdict(float)
+        self.hook = hook
+
+
+    def count(self, **counts):
+        """Add to counters, e.g. count(rowsParsed=10000, rowsSkipped=1)."""
+
+        for name, n in counts.items():
+            self.counters[name] += n
+
+
+    def maximum(self, name, value):
+        """Raise a counter to value, if it's lower."""
+
+        self.counters[name] = max(self.counters[name], value)
+
+
+    @contextmanager
+    def phase(self, name):
+        """Time a phase: with instrument.phase('scan'): ..."""
+
+        start = default_timer()
+        try:
+            yield
+        finally:
+            seconds = default_timer() - start
+            self.timings[name] += seconds
+
+            if self.hook:
+                self.hook(name, seconds, dict(self.counters))
+
+
+    def report(self):
+        """Returns: A dictionary of the counters and timings."""
+
+        return {'counters': dict(self.counters), 'timings': dict(self.timings)}
+
+
+    def toJson(self):
+        """Returns: The report as a JSON string."""
+
+        return json.dumps(self.report(), sort_keys=True)
+
+
+class NullInstrumentation():
+    """Instrumentation that collects nothing, used when instrumentation is disabled."""
+
+    enabled = False
+
+    def count(self, **counts):
+        pass
+
+
+    def maximum(self, name, value):
+        pass
+
+
+    def phase(self, name):
+        return _nullPhase
+
+
+    def report(self):
+        return {'counters': {}, 'timings': {}}
+
+
+    def toJson(self):
+        return json.dumps(self.report())
+
+
+class _NullPhase():
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        return False
+
+
+_nullPhase = _NullPhase()
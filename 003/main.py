@@ -1,8 +1,22 @@
+from array import array
 from collections import defaultdict
-from csv import reader
 from decimal import Decimal, ROUND_HALF_EVEN
+from itertools import izip
+import threading
 from xml.etree import ElementTree
-from traceback import format_exc
+
+from columnar import convertAmount, countGroups, readColumns, sumConverted, sumGroups, toCents
+from columnfile import convertTransactions, isColumnFile, mapColumns
+from derivedrates import DerivedRateCache
+from fixedpoint import fixedConverter
+from incremental import completeEnd, fileIdentity, loadState, saveState
+from instrument import NullInstrumentation
+from ratecache import ratesDigest, loadCachedRates, saveCachedRates
+from rateclosure import POLICIES, RateClosure
+from ratehistory import RateHistory
+from skuindex import buildSkuIndex, skuOffsets
+from transsource import TransactionSource
+from validation import validateTransactions
 
 
 class InternationalTrade():
@@ -20,105 +34,128 @@ class InternationalTrade():
          Problem:
              What is the grand total of sales for item DM1182 across all stores in USD currency?"
 
-    An added feature of this implementation is to optionally output any of three types of
-    debugging info. This is especially helpful to understand what is happening in the recursive
-    method used to derive missing conversion rate values.
+    Missing conversion rates are derived by searching the graph of known rates once from every
+    currency (see RateClosure), after which every conversion is a constant-time lookup. The path
+    used for each conversion is chosen by a policy: the fewest rates ('hops', the default), or
+    the best or worst product of rates.
+
+    Rows parsed and skipped, rate lookups, rate graph searches and the time spent in each phase
+    can optionally be collected by an Instrumentation (see instrument.py).
 
     Attributes:
-        rates (defaultdict of Decimal): Dictionary of conversion rates, keyed by ('from', 'to').
+        rates (defaultdict of Decimal): Dictionary of known conversion rates, keyed by
+                                        ('from', 'to'); derived rates are kept in the closure.
         currencies (set or str): Set of all the encountered currencies.
-
-        verboseRates (bool): Whether to output debug info while learning rates.
-        verboseMissing (bool): Whether to output debug info while deriving missing rates.
-        verboseTrans  (bool): Flag used to output debug info while scanning transactions.
+        closure (RateClosure): All-pairs conversion rates; None until built.
+        policy (str): How the closure chooses conversion paths: 'hops', 'best' or 'worst'.
+        history (RateHistory): Dated snapshots of the rates, for dated transactions.
+        derivedRates (DerivedRateCache): Recently looked up conversion rates, shared by the
+                                         threads using the instance.
+        instrument (Instrumentation): Collects counters and phase timings; a
+                                      NullInstrumentation, which collects nothing, by default.
+
+    The rates and the closure belong to each instance, so instances don't share rates. An
+    instance can be shared by threads: conversion rates are looked up through derivedRates, and
+    the closure is only built, searched and changed under a lock.
 
     """
 
-    rates = defaultdict(Decimal)
-    currencies = set()
+    def __init__(self, instrument=None, maxDerivedRates=1024, policy='hops'):
+        """Inits InternationalTrade.
+
+        Args:
+            instrument (opt Instrumentation): Collects counters and phase timings.
+            maxDerivedRates (opt int): Largest number of conversion rates kept in derivedRates;
+                                       this doesn't bound the RateClosure behind it.
+            policy (opt str): How conversion paths are chosen: 'hops', 'best' or 'worst'.
+
+        Raises:
+            ValueError: Unknown policy.
+        """
 
-    verboseRates = False
-    verboseMissing = False
-    verboseTrans = False
+        if policy not in POLICIES:
+            raise ValueError("Unknown path policy %s" % policy)
 
-    def __init__(self, verboseRates=False, verboseMissing=False, verboseTrans=False):
-        """Inits InternationalTrade with debugging flags.
+        self.instrument = instrument or NullInstrumentation()
 
-        Args:
-            verboseRates (opt bool): Whether to output debug info while getting input rates.
-            verboseMissing (opt bool): Whether to output debug info  while deriving missing rates.
-            verboseTrans (opt bool): Whether to output debug info while getting and tallying
-                                     transactions.
+        self.rates = defaultdict(Decimal)
+        self.currencies = set()
+        self.closure = None
+        self.policy = policy
+        self.history = RateHistory(policy)
+        self.derivedRates = DerivedRateCache(maxDerivedRates)
+
+        self._closureLock = threading.RLock()
 
+
+    def buildClosure(self):
+        """Build the table of all conversion rates, if it isn't already built.
+
+        Returns:
+            The RateClosure for the currently known rates.
         """
 
-        self.verboseRates = verboseRates
-        self.verboseMissing = verboseMissing
-        self.verboseTrans = verboseTrans
+        with self._closureLock:
+            if self.closure is None:
+                with self.instrument.phase('derive'):
+                    self.closure = RateClosure(self.rates, self.policy)
+                    self._countSearches()
+
+            return self.closure
+
 
+    def _countSearches(self):
+        """Move the closure's search counters to the instrumentation."""
 
-    def deriveMissingRate(self, tried, frm, to, indent=0):
-        """Recursively derive a missing conversion rate.
+        if self.closure is not None:
+            stats = self.closure.takeStats()
+            self.instrument.count(searches=stats['searches'], nodesVisited=stats['nodesVisited'])
+            self.instrument.maximum('searchDepth', stats['searchDepth'])
 
-        This method recursively derives a missing conversion rate value. The algorithm used is:
-            1. If there is a conversion rate value from currency 'frm' to currency 'to', stop
-               recursing and return the conversion rate.
-            2. Add currency 'frm' to the set of tried currencies.
-            3. Use the set of tried currencies to create a set of untried currencies.
-            4. For each of the currencies in the set in untried ones:
-                4a. If there's is a known conversion to the 'to' currency:
-                    4a1. Recursively attempt to find a conversion to currency 'to'.
-                    4a2. If that returned a value, save and return the conversion rate.
-            5. If no conversion was found for any of the untried values, stop recursing and return
-               None signal that there is no conversion from currency 'frm' to currency 'to'.
 
-        Side-effect: Note that to avoid repeating any derivations, any intermediate missing rates
-        that are derived in the course of deriving the requested missing rate are saved in the
-        dictionary as they are encountered.
+    def deriveMissingRate(self, frm, to):
+        """Derive a missing conversion rate.
+
+        Missing rates are looked up in the precomputed RateClosure, which is built on first use
+        by searching the rates graph once from every currency, and kept in derivedRates. Threads
+        asking for the same rate while it's being looked up wait for that lookup.
 
         Args:
-            tried (set of str): Set of currencies that have already been tried
-                                and don't need to be considered.
             frm (str): Currency that needs to be converted.
             to (str): Desired output currency.
-            indent (optional int): Number of indents to use for debugging output.
 
         Returns:
             The derived missing conversion rate or None if unable to derive rate.
         """
 
-        if self.verboseMissing: print "%sAttempting to derive %s-->%s" % ("  " * indent, frm, to)
+        return self.derivedRates.get((frm, to), lambda: self._closureRate(frm, to))
+
+
+    def conversionPath(self, frm, to):
+        """Look up the path of known rates used to convert between two currencies.
 
-        # If there's a direct conversion, just return it:
-        if self.rates[(frm, to)]:
-            return self.rates[(frm, to)]
+        Args:
+            frm (str): Currency that needs to be converted.
+            to (str): Desired output currency.
 
-        tried.add(frm)
-        untried = self.currencies - tried - {to}
+        Returns:
+            The list of currencies on the path, from frm to to, or None if there is no
+            conversion.
+        """
 
-        # Recursively try every combination:
-        for nextFrm in untried:
-            if self.verboseMissing: print "%s Considering %s-->%s" % ("  " * indent, frm, nextFrm)
+        with self._closureLock:
+            return self.buildClosure().path(frm, to)
 
-            if self.rates[(frm, nextFrm)]:
-                nextRate = self.deriveMissingRate(tried, nextFrm, to, indent+1)
 
-                # If there's a conversion rate, use it to derive the missing conversion rate,
-                #     saving the value for possible future use:
-                if nextRate:
-                    self.rates[(frm, to)] = self.rates[(frm, nextFrm)] * nextRate
-                    if self.verboseMissing:
-                        print "%s  Setting %s-->%s = %s" % ("  " * indent, frm, to,
-                                                            self.rates[(frm, to)])
-                    return self.rates[(frm, to)]
+    def _closureRate(self, frm, to):
+        with self._closureLock:
+            rate = self.buildClosure().rate(frm, to)
+            self._countSearches()
 
-        else:
-            # No solution found; give up:
-            if self.verboseMissing: print "%s Path %s-->%s didn't work" % ("  " * indent, frm, to)
-            return None
+        return rate
 
 
-    def getRates(self, ratesFile, findMissing=False):
+    def getRates(self, ratesFile, findMissing=False, cacheDir=None, asOf=None):
         """Input and build a dictionary or rates.
 
         Read in the specified rates XML file, which is formatted like the
@@ -142,10 +179,18 @@ class InternationalTrade():
               </rate>
             </rates>
 
+        When a cache directory is given, the rates and the RateClosure derived from them are
+        saved there, keyed by a hash of the file's content, and loaded from there by later calls
+        for a file with the same content instead of being parsed and derived again.
+
+        With asOf, the file is a dated snapshot of the rates: it's added to the history of rates
+        in effect from that date, used by dated tallies, rather than to the known rates.
+
         Args:
             ratesFile(str); Name of the files with the rates data.
             FindMissing (opt bool): Whether to preemptively derive all the missing conversion rates.
-
+            cacheDir (opt str): Directory in which to cache compiled rate tables.
+            asOf (opt str): ISO 8601 date from which the rates are in effect.
 
         Returns:
             Nothing
@@ -154,27 +199,61 @@ class InternationalTrade():
             IOError: Unable to open and read in rates from the file.
         """
         try:
-            for rate in ElementTree.parse(ratesFile).getroot().iter('rate'):
-                frm = rate.find('from').text
-                to = rate.find('to').text
-                self.rates[frm, to] = Decimal(rate.find('conversion').text)
-
-                self.currencies.add(frm)
-                self.currencies.add(to)
+            with open(ratesFile, 'rb') as f:
+                content = f.read()
+
+            cached = None
+            if cacheDir:
+                digest = ratesDigest(content)
+                cached = loadCachedRates(cacheDir, digest)
+
+            if cached:
+                (rates, closure) = cached
+            else:
+                with self.instrument.phase('parseRates'):
+                    rates = {}
+                    for rate in ElementTree.fromstring(content).iter('rate'):
+                        rates[(rate.find('from').text, rate.find('to').text)] = \
+                            Decimal(rate.find('conversion').text)
+                closure = None
+
+            if asOf is not None:
+                with self._closureLock:
+                    self.history.add(asOf, rates, closure)
+
+                    snapshot = self.history.snapshotAt(asOf)
+                    if (cacheDir and not cached) or findMissing:
+                        closure = self.history.closure(snapshot)
+                if cacheDir and not cached:
+                    saveCachedRates(cacheDir, digest, rates, closure)
+                return
+
+            with self._closureLock:
+                for (frm, to), rate in rates.items():
+                    self.rates[frm, to] = rate
+
+                    self.currencies.add(frm)
+                    self.currencies.add(to)
+
+                # A cached closure only covers this file's rates, with one policy:
+                if closure is not None and (len(self.rates) != len(rates) or
+                                            closure.policy != self.policy):
+                    closure = None
+                self.closure = closure
+                self.derivedRates.clear()
+
+                if cacheDir and not cached:
+                    # The cached closure must only derive from this file's rates:
+                    if len(self.rates) == len(rates):
+                        closure = self.buildClosure()
+                    else:
+                        closure = RateClosure(rates, self.policy)
+
+            if cacheDir and not cached:
+                saveCachedRates(cacheDir, digest, rates, closure)
 
             if findMissing:
-                for frm in self.currencies:
-                    for to in self.currencies:
-                        if frm != to and not self.rates[(frm, to)]:
-                            if self.verboseRates: print
-                            self.rates[(frm, to)] = self.deriveMissingRate(set(), frm, to, 0)
-
-            if self.verboseRates:
-                print
-                for rate in sorted(self.rates.items()):
-                    if rate[0][0] != rate[0][1]:
-                        print "%s-->%s = %s" % (rate[0][0], rate[0][1], rate[1])
-                print
+                self.buildClosure()
 
             return
 
@@ -183,7 +262,94 @@ class InternationalTrade():
             raise SystemExit
 
 
-    def getTransactions(self, transFile):
+    def updateRate(self, frm, to, rate):
+        """Change or add a known conversion rate.
+
+        If the rates have already been derived, only the derived rates that depend on this one
+        are invalidated; they are derived again when next needed.
+
+        Args:
+            frm (str): Currency converted from.
+            to (str): Currency converted to.
+            rate (Decimal): New conversion rate.
+
+        """
+
+        with self._closureLock:
+            self.rates[(frm, to)] = Decimal(rate)
+            self.currencies.add(frm)
+            self.currencies.add(to)
+
+            if self.closure is not None:
+                self.closure.updateRate(frm, to, Decimal(rate))
+                self.derivedRates.invalidate(lambda pair: self.closure.isStale(*pair))
+            else:
+                self.derivedRates.clear()
+
+
+    def removeRate(self, frm, to):
+        """Remove a known conversion rate.
+
+        If the rates have already been derived, only the derived rates that may depend on this
+        one are invalidated; they are derived again when next needed.
+
+        Args:
+            frm (str): Currency converted from.
+            to (str): Currency converted to.
+
+        """
+
+        with self._closureLock:
+            if self.rates.pop((frm, to), None) is not None and self.closure is not None:
+                self.closure.removeRate(frm, to)
+                self.derivedRates.invalidate(lambda pair: self.closure.isStale(*pair))
+            elif self.closure is None:
+                self.derivedRates.clear()
+
+
+    def indexTransactions(self, transFile):
+        """Write a SKU index next to a transactions file.
+
+        While the file doesn't change, reading the transactions of one item (in getTransactions
+        and tallyTransactions) then costs time proportional to the item's rows, not to the file.
+
+        Args:
+            transFile (str): A path to the transactions file.
+
+        Returns:
+            The path of the index file.
+
+        """
+
+        return buildSkuIndex(transFile)
+
+
+    def convertTransactions(self, transFile, columnFile):
+        """Convert a transactions file to a binary columnar file (see columnfile).
+
+        The columnar file can be given instead of the transactions file to tallyTransactions and
+        getColumns; it's memory-mapped instead of parsed, so the parsing is only done once.
+
+        Args:
+            transFile (str): A path to the transactions file.
+            columnFile (str): Path of the columnar file to write.
+
+        Returns:
+            The number of transactions written.
+
+        """
+
+        return convertTransactions(transFile, columnFile)
+
+
+    def _source(self, transFile, item, dates=False):
+        """TransactionSource for the rows of an item, using the file's SKU index if it has one."""
+
+        offsets = skuOffsets(transFile, item) if item else None
+        return TransactionSource(transFile, item=item, offsets=offsets, dates=dates)
+
+
+    def getTransactions(self, transFile, item=None):
         """Opens and reads transactions from a file.
 
         Read in the specified transactions CSV file, which is formatted like the
@@ -194,8 +360,13 @@ class InternationalTrade():
             Albany,DM1786,91.34 AUD
             Albany,DM1724,27.19 USD
 
+        When an item is given, only its rows are read: straight from their offsets if the file
+        has an up to date SKU index (see indexTransactions), or else by memory-mapping the file
+        and parsing only the rows containing the item's SKU.
+
         Args:
             transFile (str): A path to the transactions file.
+            item (opt str): The SKU of the only item to read, or None for all items.
 
         Yields:
             A tuple with the following:
@@ -209,85 +380,731 @@ class InternationalTrade():
 
         """
         try:
-            with open(transFile) as csvfile:
-                while True:
-
-                    (store, sku, amount) = reader(csvfile).next()
-
-                    try:
-                        (amt, currency) = amount.split()
-                    except ValueError:
-                        # Ignore header row and other bad input lines
-                        continue
-
-                    if self.verboseTrans: print "%s %s of item %s was sold in %s" \
-                                                % (amt, currency, sku, store)
+            # The header row and other bad input lines are skipped by the source:
+            source = self._source(transFile, item)
+            for store, sku, amt, currency in source:
+                yield (Decimal(amt), sku, currency)
 
-                    yield (Decimal(amt), sku, currency)
+            self.instrument.count(rowsParsed=source.rowsParsed, rowsSkipped=source.rowsSkipped)
 
         except IOError as e:
             print "Unable to open and read transactions\n(%s)" % e
             raise #SystemExit
 
 
+    def validateTransactions(self, transFile, toCurrencies):
+        """Check a transactions file before tallying it, reporting every problem at once.
+
+        The tallies skip rows they can't parse and stop at the first currency they can't
+        convert. This reads the whole file once instead, and collects all the bad rows, with
+        their line numbers, and every missing conversion (see validation.py).
+
+        Args:
+            transFile (str): A path to the transactions file.
+            toCurrencies (list of str): The currencies the transactions would be tallied in.
+
+        Returns:
+            A ValidationReport; its ok() is True if the file can be tallied.
+
+        Raises:
+            IOError: Unable to open and read in transaction from the file.
+            ValueError: The file is a columnar file, whose rows were checked when it was written.
+
+        """
+
+        if isColumnFile(transFile):
+            raise ValueError("%s is a columnar file, not a transactions file" % transFile)
+
+        self.buildClosure()
+
+        with self.instrument.phase('scan'):
+            report = validateTransactions(transFile, toCurrencies, self.deriveMissingRate)
+
+        self.instrument.count(rowsParsed=report.rowsParsed)
 
-    def tallyTransactions(self, transFile, item, toCurrency):
+        return report
+
+
+
+    def tallyTransactions(self, transFile, item, toCurrency, arithmetic='decimal', dated=False):
         """Computes a tally of items sold.
 
         Iterate the specified transaction file and calculate, in the specified
         currency, the total amount spent for specified item.
 
+        With 'fixed' arithmetic, amounts are kept as integer cents and rates as scaled integers,
+        and rounding is done with integer arithmetic (see fixedConverter). The total is the same,
+        to the cent, as with 'decimal' arithmetic, but each row is several times cheaper. The rare
+        amounts with fractions of a cent are converted with Decimal arithmetic.
+
+        The transactions file can also be a binary columnar file written by convertTransactions,
+        which is tallied with tallyColumns whatever the arithmetic.
+
+        A dated tally converts each row that has a date, in a fourth column, with the rates in
+        effect at that date in the history of rates (see getRates' asOf); rows without a date
+        are converted with the known rates. Rows usually come in date order, so the snapshot in
+        effect is only looked up again, by binary search, when a row's date is outside the
+        current snapshot's dates; each snapshot's rates are derived once. Dated tallies use
+        'decimal' arithmetic and need a transactions file, as columnar files hold no dates.
+
         Args:
-            transFile (str): A path to the transactions file.
+            transFile (str): A path to the transactions file or a columnar file.
             item (str): The SKU of the desired item or None for all items.
             toCurrency (str): The currency in which to calculate the total.
+            arithmetic (opt str): 'decimal' or 'fixed'.
+            dated (opt bool): Whether to convert each row with the rates in effect at its date.
 
         Returns:
             The total amount of the items sold expressed in the desired currency.
 
         Raises:
+            ValueError: Unknown arithmetic, or a dated tally of a columnar file or with 'fixed'
+                        arithmetic.
             MissingConversionError: A transaction's currency can't be converted.
 
         """
 
+        if arithmetic not in ('decimal', 'fixed'):
+            raise ValueError("Unknown arithmetic %s" % arithmetic)
+
+        if dated:
+            if arithmetic != 'decimal':
+                raise ValueError("Dated tallies use decimal arithmetic, not %s" % arithmetic)
+            if isColumnFile(transFile):
+                raise ValueError("%s is a columnar file, which has no dates" % transFile)
+            return self._tallyDated(transFile, item, toCurrency)
+        elif isColumnFile(transFile):
+            return self.tallyColumns(self.getColumns(transFile), item, toCurrency)
+        elif arithmetic == 'fixed':
+            return self._tallyFixed(transFile, item, toCurrency)
+
         total = Decimal(0);
+        self.buildClosure()
+        rates = {}
+        conversions = 0
+
+        with self.instrument.phase('scan'):
+            for amt, sku, transCurrency in self.getTransactions(transFile, item):
+                if not item or sku == item:
+                    # This could also be handled by just setting conversion to self to 1.0:
+                    if transCurrency == toCurrency:
+                        subtotal = Decimal(amt)
+
+                    else:
+                        conversions += 1
+                        try:
+                            rate = rates[transCurrency]
+                        except KeyError:
+                            rate = rates[transCurrency] = self.deriveMissingRate(transCurrency,
+                                                                                 toCurrency)
+                            if rate is None:
+                                print "\nNo conversion found for %s-->%s" % (transCurrency,
+                                                                             toCurrency)
+                                raise SystemExit
+
+                        subtotal = amt * rate
+
+                    total += subtotal.quantize(Decimal("0.01"), rounding=ROUND_HALF_EVEN)
+
+        self._countLookups(conversions, len(rates))
+
+        return total
+
+
+    def _countLookups(self, rows, misses):
+        """Count the rate lookups of a tally: one miss per currency, the other rows are hits."""
+
+        self.instrument.count(rateHits=rows - misses, rateMisses=misses)
+        self._countSearches()
+
 
-        for amt, sku, transCurrency in self.getTransactions(transFile):
-            if not item or sku == item:
-                # This could also be handled by just setting conversion to self to 1.0:
-                if transCurrency == toCurrency:
-                    subtotal = Decimal(amt)
+    def _tallyDated(self, transFile, item, toCurrency):
+        """tallyTransactions converting each row with the rates in effect at its date."""
 
+        dates = self.history.dates
+        # The snapshot of the last dated row and the dates [start, stop) it's in effect for:
+        current = start = stop = None
+        rates = {}
+        total = Decimal(0)
+        source = self._source(transFile, item, dates=True)
+
+        with self.instrument.phase('scan'):
+            for store, sku, amt, currency, date in source:
+                if date is None:
+                    snapshot = None
                 else:
-                    # Derive a missing conversion rates on demand:
-                    if not self.rates[(transCurrency, toCurrency)]:
-                        if not self.deriveMissingRate(set(), transCurrency, toCurrency):
-                            print "\nNo conversion found for %s-->%s" % (transCurrency, toCurrency)
+                    if start is None or date < start or (stop is not None and date >= stop):
+                        current = self.history.snapshotAt(date)
+                        if current is None:
+                            print "\nNo rates in effect at %s" % date
                             raise SystemExit
 
-                    subtotal = Decimal(amt * self.rates[(transCurrency, toCurrency)])
+                        start = dates[current]
+                        stop = dates[current + 1] if current + 1 < len(dates) else None
+
+                    snapshot = current
+
+                try:
+                    rate = rates[(snapshot, currency)]
+                except KeyError:
+                    rate = rates[(snapshot, currency)] = self._snapshotRate(snapshot, currency,
+                                                                            toCurrency)
+                    if rate is None:
+                        print "\nNo conversion found for %s-->%s at %s" % (currency, toCurrency,
+                                                                           date)
+                        raise SystemExit
 
-                total += subtotal.quantize(Decimal("0.01"), rounding=ROUND_HALF_EVEN)
+                total += (Decimal(amt) * rate).quantize(Decimal("0.01"), rounding=ROUND_HALF_EVEN)
 
-        if self.verboseTrans:
-            print "\n%s %s of item %s was sold\n" % (total, toCurrency, item)
+        self.instrument.count(rowsParsed=source.rowsParsed, rowsSkipped=source.rowsSkipped)
+        self._countLookups(source.rowsParsed, len(rates))
 
         return total
 
 
-if __name__ == '__main__':
-    try:
-        it = InternationalTrade(verboseRates=True, verboseMissing=True, verboseTrans=True)
-        rates = it.getRates("data/SAMPLE_RATES.xml", findMissing=True)
-        print "Sample files: %s" % it.tallyTransactions("data/SAMPLE_TRANS.csv", "DM1182", "USD")
+    def _snapshotRate(self, snapshot, frm, to):
+        """Look up a rate in a snapshot of the history, or in the known rates for None."""
+
+        if snapshot is None:
+            return self.deriveMissingRate(frm, to)
+
+        with self._closureLock:
+            with self.instrument.phase('derive'):
+                return self.history.closure(snapshot).rate(frm, to)
+
+
+    def _tallyFixed(self, transFile, item, toCurrency):
+        """tallyTransactions using integer cents arithmetic."""
+
+        self.buildClosure()
+        converters = {}
+        cents = 0
+        source = self._source(transFile, item)
+
+        with self.instrument.phase('scan'):
+            for store, sku, amt, transCurrency in source:
+                try:
+                    convert = converters[transCurrency]
+                except KeyError:
+                    rate = self.deriveMissingRate(transCurrency, toCurrency)
+                    if rate is None:
+                        print "\nNo conversion found for %s-->%s" % (transCurrency, toCurrency)
+                        raise SystemExit
+
+                    convert = converters[transCurrency] = fixedConverter(rate)
+
+                try:
+                    cents += convert(toCents(amt))
+                except ValueError:
+                    # Fractions of a cent, as in '1.005', need Decimal arithmetic:
+                    cents += convertAmount(amt, self.deriveMissingRate(transCurrency, toCurrency))
+
+        self.instrument.count(rowsParsed=source.rowsParsed, rowsSkipped=source.rowsSkipped)
+        self._countLookups(source.rowsParsed, len(converters))
+
+        return Decimal(cents).scaleb(-2)
+
+
+    def tallyParallel(self, transFile, item, toCurrency, processes=None):
+        """Computes a tally of items sold, using a pool of processes.
+
+        The transactions file is split into byte ranges that are tallied in parallel, each
+        worker getting the conversion rates into the desired currency once. The result is the
+        same as that of tallyTransactions. A binary columnar file is tallied with tallyColumns
+        instead.
+
+        Args:
+            transFile (str): A path to the transactions file or a columnar file.
+            item (str): The SKU of the desired item or None for all items.
+            toCurrency (str): The currency in which to calculate the total.
+            processes (opt int): Number of worker processes; defaults to the number of CPUs.
+
+        Returns:
+            The total amount of the items sold expressed in the desired currency.
+
+        Raises:
+            MissingConversionError: A transaction's currency can't be converted.
+
+        """
+
+        if isColumnFile(transFile):
+            return self.tallyColumns(self.getColumns(transFile), item, toCurrency)
+
+        # Only imported here, as multiprocessing is slow to import:
+        from parallel import tallyShards
+
+        rates = dict((currency, self.deriveMissingRate(currency, toCurrency))
+                     for currency in self.buildClosure().currencies + [toCurrency])
+
+        totals, missing = tallyShards(transFile, item, rates, processes)
+        if missing:
+            print "\nNo conversion found for %s-->%s" % (sorted(missing)[0], toCurrency)
+            raise SystemExit
+
+        return sum(totals.values(), Decimal(0))
+
+
+    def tallyFiles(self, pattern, toCurrency, readers=4, processes=None):
+        """Computes a tally of items sold per SKU across many transaction files, e.g. one per store.
+
+        The files are read concurrently by a few threads and tallied in a pool of processes, with
+        a bounded number of blocks in memory at once. The totals are the same as those of tallyAll
+        on the concatenated files.
+
+        Args:
+            pattern (str): A directory, whose *.csv files are tallied, or a glob pattern.
+            toCurrency (str): The currency in which to calculate the totals.
+            readers (opt int): Number of threads reading files at once.
+            processes (opt int): Number of worker processes; defaults to the number of CPUs.
+
+        Returns:
+            A dictionary of totals expressed in the desired currency, keyed by (sku,), as
+            returned by tallyAll.
+
+        Raises:
+            IOError: A transactions file can't be read.
+            ValueError: One of the files is a columnar file.
+            MissingConversionError: A transaction's currency can't be converted.
+
+        """
+
+        # Only imported here, as multiprocessing is slow to import:
+        from ingest import findFiles, tallyFiles
+
+        transFiles = findFiles(pattern)
+        for transFile in transFiles:
+            if isColumnFile(transFile):
+                raise ValueError("%s is a columnar file, not a transactions file" % transFile)
+
+        rates = dict((currency, self.deriveMissingRate(currency, toCurrency))
+                     for currency in self.buildClosure().currencies + [toCurrency])
+
+        with self.instrument.phase('scan'):
+            try:
+                totals, missing, rowsParsed, rowsSkipped = tallyFiles(transFiles, rates,
+                                                                      readers, processes)
+            except IOError as e:
+                print "Unable to open and read transactions\n(%s)" % e
+                raise
+
+        if missing:
+            print "\nNo conversion found for %s-->%s" % (sorted(missing)[0], toCurrency)
+            raise SystemExit
+
+        self.instrument.count(rowsParsed=rowsParsed, rowsSkipped=rowsSkipped)
+
+        return dict(((sku,), total) for sku, total in totals.items())
 
-        it = InternationalTrade()
-        rates = it.getRates("data/RATES.xml")
-        print "Real files: %s" % it.tallyTransactions("data/TRANS.csv", "DM1182", "USD")
 
-    # TODO: Add/use a custom exception:
-    except SystemExit:
-        print "\nAborting!\n"
+    def tallyAll(self, transFile, toCurrency, by=('sku',)):
+        """Computes a tally of items sold for every group of transactions in a single pass.
+
+        This gives the same totals as calling tallyTransactions once for each group, but reads
+        the transactions file only once.
+
+        Args:
+            transFile (str): A path to the transactions file.
+            toCurrency (str): The currency in which to calculate the totals.
+            by (opt tuple of str): Fields to group by; any of 'sku', 'store' and 'currency'.
+
+        Returns:
+            A dictionary of totals expressed in the desired currency, keyed by a tuple of the
+            values of the 'by' fields, e.g. {('DM1182', 'Yonkers'): Decimal('19.68'), ...}.
+
+        Raises:
+            ValueError: Unknown field in 'by'.
+            MissingConversionError: A transaction's currency can't be converted.
+
+        """
+
+        return self.tallyAllCurrencies(transFile, [toCurrency], by)[toCurrency]
+
+
+    def tallyAllCurrencies(self, transFile, toCurrencies, by=('sku',)):
+        """Computes tallyAll in several currencies at once, in a single pass.
+
+        Each row is converted and rounded once per target currency, so the totals are the same
+        as those of one tallyAll per currency. A binary columnar file written by
+        convertTransactions is tallied with tallyAllColumns.
+
+        Args:
+            transFile (str): A path to the transactions file.
+            toCurrencies (list of str): The currencies in which to calculate the totals.
+            by (opt tuple of str): Fields to group by; any of 'sku', 'store' and 'currency'.
+
+        Returns:
+            A dictionary of tallyAll results keyed by target currency, e.g.
+            {'USD': {('DM1182',): Decimal('59482.47'), ...}, 'EUR': {...}}.
+
+        Raises:
+            ValueError: Unknown field in 'by'.
+            MissingConversionError: A transaction's currency can't be converted.
+
+        """
+
+        fields = ('store', 'sku', 'currency')
+        for field in by:
+            if field not in fields:
+                raise ValueError("Can't group transactions by %s" % field)
+        positions = [fields.index(field) for field in by]
+
+        if isColumnFile(transFile):
+            return self.tallyAllColumns(self.getColumns(transFile), toCurrencies, by)
+
+        self.buildClosure()
+        rates = {}
+        totals = defaultdict(lambda: [Decimal(0)] * len(toCurrencies))
+        source = TransactionSource(transFile)
+
+        with self.instrument.phase('scan'):
+            for store, sku, amt, currency in source:
+                try:
+                    currencyRates = rates[currency]
+                except KeyError:
+                    currencyRates = rates[currency] = self._targetRates(currency, toCurrencies)
+
+                row = (store, sku, currency)
+                groupTotals = totals[tuple(row[position] for position in positions)]
+
+                amt = Decimal(amt)
+                for k, rate in enumerate(currencyRates):
+                    groupTotals[k] += (amt * rate).quantize(Decimal("0.01"),
+                                                            rounding=ROUND_HALF_EVEN)
+
+        self.instrument.count(rowsParsed=source.rowsParsed, rowsSkipped=source.rowsSkipped)
+        self._countLookups(source.rowsParsed * len(toCurrencies), len(rates) * len(toCurrencies))
+
+        return dict((toCurrency, dict((key, groupTotals[k]) for key, groupTotals in totals.items()))
+                    for k, toCurrency in enumerate(toCurrencies))
+
+
+    def tallyCurrencies(self, transFile, item, toCurrencies):
+        """Computes a tally of items sold in several currencies at once, in a single pass.
+
+        Each row is converted and rounded once per target currency, so the totals are the same
+        as those of one tallyTransactions per currency.
+
+        Args:
+            transFile (str): A path to the transactions file or a columnar file.
+            item (str): The SKU of the desired item or None for all items.
+            toCurrencies (list of str): The currencies in which to calculate the totals.
+
+        Returns:
+            A dictionary of the total amounts of the items sold, keyed by target currency.
+
+        Raises:
+            MissingConversionError: A transaction's currency can't be converted.
+
+        """
+
+        if isColumnFile(transFile):
+            columns = self.getColumns(transFile)
+            return dict((toCurrency, self.tallyColumns(columns, item, toCurrency))
+                        for toCurrency in toCurrencies)
+
+        self.buildClosure()
+        rates = {}
+        totals = [Decimal(0)] * len(toCurrencies)
+        rows = 0
+
+        with self.instrument.phase('scan'):
+            for amt, sku, currency in self.getTransactions(transFile, item):
+                if not item or sku == item:
+                    rows += 1
+
+                    try:
+                        currencyRates = rates[currency]
+                    except KeyError:
+                        currencyRates = rates[currency] = self._targetRates(currency, toCurrencies)
+
+                    for k, rate in enumerate(currencyRates):
+                        totals[k] += (amt * rate).quantize(Decimal("0.01"), rounding=ROUND_HALF_EVEN)
+
+        self._countLookups(rows * len(toCurrencies), len(rates) * len(toCurrencies))
+
+        return dict(zip(toCurrencies, totals))
+
+
+    def _targetRates(self, currency, toCurrencies):
+        """Look up the rates from a currency into each target currency."""
+
+        rates = []
+        for toCurrency in toCurrencies:
+            rate = self.deriveMissingRate(currency, toCurrency)
+            if rate is None:
+                print "\nNo conversion found for %s-->%s" % (currency, toCurrency)
+                raise SystemExit
+
+            rates.append(rate)
+
+        return rates
+
+
+    def tallyByCurrency(self, transFile, toCurrency, rounding='row'):
+        """Computes per-SKU tallies by grouping transactions by SKU and currency before converting.
+
+        Amounts are first collected, in cents, per (sku, currency) group. Then each currency's
+        rate is looked up once and each group is converted in a tight loop. The rounding can be:
+            'row': Each row is converted and rounded on its own with banker's rounding, as in
+                   tallyTransactions; the totals are exactly the same.
+            'group': The raw amounts of each group are summed, and the sum is converted and
+                     rounded once. This is cheaper, but it isn't the puzzle's rounding policy:
+                     each row's rounding can be off by up to half a cent, so a group's total can
+                     differ from the 'row' total by up to half a cent per row, plus half a cent.
+        The second dictionary returned gives that bound for each SKU.
+
+        Args:
+            transFile (str): A path to the transactions file or a columnar file.
+            toCurrency (str): The currency in which to calculate the totals.
+            rounding (opt str): 'row' or 'group'.
+
+        Returns:
+            A tuple with the following:
+
+            totals (dict of Decimal): Totals in the desired currency, keyed by SKU.
+            deviations (dict of Decimal): Largest possible difference between each SKU's total
+                                          and its 'row' rounding total, keyed by SKU; zero for
+                                          'row' rounding.
+
+        Raises:
+            ValueError: Unknown rounding.
+            MissingConversionError: A transaction's currency can't be converted.
+
+        """
+
+        if rounding not in ('row', 'group'):
+            raise ValueError("Unknown rounding %s" % rounding)
+
+        groups = defaultdict(lambda: array('l'))
+        # Amounts with fractions of a cent, as in '1.005', which need Decimal arithmetic:
+        inexact = defaultdict(list)
+
+        if isColumnFile(transFile):
+            columns = self.getColumns(transFile)
+            skuNames, currencyNames = columns.skuNames, columns.currencyNames
+
+            for sku, currency, cents in izip(columns.skus, columns.currencies, columns.cents):
+                groups[(skuNames[sku], currencyNames[currency])].append(int(cents))
+            for store, sku, amt, currency in columns.inexact:
+                inexact[(skuNames[sku], currencyNames[currency])].append(Decimal(amt))
+        else:
+            for store, sku, amt, currency in TransactionSource(transFile):
+                try:
+                    groups[(sku, currency)].append(toCents(amt))
+                except ValueError:
+                    inexact[(sku, currency)].append(Decimal(amt))
+
+        converters = {}
+        totals = defaultdict(int)
+        deviations = defaultdict(int)
+
+        for (sku, currency) in set(groups) | set(inexact):
+            amounts = groups.get((sku, currency), ())
+            others = inexact.get((sku, currency), ())
+            rate = self.deriveMissingRate(currency, toCurrency)
+
+            try:
+                convert = converters[currency]
+            except KeyError:
+                if rate is None:
+                    print "\nNo conversion found for %s-->%s" % (currency, toCurrency)
+                    raise SystemExit
+
+                convert = converters[currency] = fixedConverter(rate)
+
+            if rounding == 'row':
+                totals[sku] += sum(map(convert, amounts))
+                totals[sku] += sum(convertAmount(amt, rate) for amt in others)
+            else:
+                if others:
+                    totals[sku] += convertAmount(Decimal(sum(amounts)).scaleb(-2) + sum(others),
+                                                 rate)
+                else:
+                    totals[sku] += convert(sum(amounts))
+                # In half cents: up to one per row, plus one for the group's rounding:
+                deviations[sku] += len(amounts) + len(others) + 1
+
+        return (dict((sku, Decimal(cents).scaleb(-2)) for sku, cents in totals.items()),
+                dict((sku, Decimal(deviations[sku]) / 200) for sku in totals))
+
+
+    def tallyAppended(self, transFile, toCurrency, stateFile):
+        """Computes per-SKU tallies of a growing file, reading only the rows appended since last time.
+
+        The offset processed so far and the running totals are saved in a state file. The next
+        call with the same state file only reads the rows appended since, and adds them to the
+        saved totals; as every row is rounded before it's added, the totals are exactly those a
+        full tally would give. Only complete rows are read, so a row that is still being written
+        is left for the next call.
+
+        The tally starts over from the beginning of the file if there's no state file, if the
+        target currency or any of the rates used changed, or if the file got shorter or isn't
+        the same file any more: the state holds the file's device and inode numbers and a hash
+        of its content before the offset, so a rotated or replaced file isn't added to the old
+        totals.
+
+        Args:
+            transFile (str): A path to the transactions file.
+            toCurrency (str): The currency in which to calculate the totals.
+            stateFile (str): Path of the file in which to keep the tally's state.
+
+        Returns:
+            A dictionary of totals expressed in the desired currency, keyed by SKU.
+
+        Raises:
+            ValueError: The file is a columnar file, which can't be appended to.
+            MissingConversionError: A transaction's currency can't be converted.
+
+        """
+
+        if isColumnFile(transFile):
+            raise ValueError("%s is a columnar file, not a transactions file" % transFile)
+
+        end = completeEnd(transFile)
+
+        state = loadState(stateFile)
+        if state is None or state['toCurrency'] != toCurrency or state['offset'] > end or \
+                state.get('identity') != fileIdentity(transFile, state['offset']) or \
+                any(self.deriveMissingRate(currency, toCurrency) != rate
+                    for currency, rate in state['rates'].items()):
+            state = {'offset': 0, 'toCurrency': toCurrency, 'rates': {}, 'totals': {}}
+
+        rates = state['rates']
+        totals = state['totals']
+
+        for store, sku, amt, currency in TransactionSource(transFile, state['offset'], end):
+            try:
+                rate = rates[currency]
+            except KeyError:
+                rate = rates[currency] = self.deriveMissingRate(currency, toCurrency)
+                if rate is None:
+                    print "\nNo conversion found for %s-->%s" % (currency, toCurrency)
+                    raise SystemExit
+
+            totals[(sku, currency)] = totals.get((sku, currency), 0) + \
+                (Decimal(amt) * rate).quantize(Decimal("0.01"), rounding=ROUND_HALF_EVEN)
+
+        state['offset'] = end
+        state['identity'] = fileIdentity(transFile, end)
+        saveState(stateFile, state)
+
+        skuTotals = defaultdict(Decimal)
+        for (sku, currency), total in totals.items():
+            skuTotals[sku] += total
+
+        return dict(skuTotals)
+
+
+    def getColumns(self, transFile):
+        """Read all the transactions from a file into memory, column by column.
+
+        A binary columnar file written by convertTransactions is memory-mapped instead.
+
+        Args:
+            transFile (str): A path to the transactions file or a columnar file.
+
+        Returns:
+            A TransactionColumns holding the transactions.
+
+        Raises:
+            IOError: Unable to open and read in transaction from the file.
+
+        """
+
+        with self.instrument.phase('scan'):
+            if isColumnFile(transFile):
+                columns = mapColumns(transFile)
+            else:
+                columns = readColumns(transFile)
+
+        self.instrument.count(rowsParsed=len(columns))
+
+        return columns
+
+
+    def tallyColumns(self, columns, item, toCurrency):
+        """Computes a tally of items sold from transactions already read by getColumns.
+
+        This is the batch version of tallyTransactions: rather than converting and rounding one
+        row at a time, each distinct amount in each currency is converted and rounded once and
+        the totals are computed a column at a time. The result is the same, to the cent.
+
+        Args:
+            columns (TransactionColumns): The transactions.
+            item (str): The SKU of the desired item or None for all items.
+            toCurrency (str): The currency in which to calculate the total.
+
+        Returns:
+            The total amount of the items sold expressed in the desired currency.
+
+        Raises:
+            MissingConversionError: A transaction's currency can't be converted.
+
+        """
+
+        rates = dict((currency, self.deriveMissingRate(currency, toCurrency))
+                     for currency in columns.currencyNames)
+
+        try:
+            with self.instrument.phase('sum'):
+                cents = sumConverted(columns, item, rates)
+        except KeyError as e:
+            print "\nNo conversion found for %s-->%s" % (e.args[0], toCurrency)
+            raise SystemExit
+
+        return Decimal(cents).scaleb(-2)
+
+
+    def tallyAllColumns(self, columns, toCurrencies, by=('sku',), items=None):
+        """Computes tallyAllCurrencies from transactions already read by getColumns.
+
+        The amounts of each group are counted once, a column at a time, and each distinct
+        amount is converted and rounded once per target currency. The totals are the same, to
+        the cent.
+
+        Args:
+            columns (TransactionColumns): The transactions.
+            toCurrencies (list of str): The currencies in which to calculate the totals.
+            by (opt tuple of str): Fields to group by; any of 'sku', 'store' and 'currency'.
+            items (opt list of str): SKUs of the only items to tally; None for all items.
+
+        Returns:
+            A dictionary of tallyAll results keyed by target currency.
+
+        Raises:
+            ValueError: Unknown field in 'by'.
+            MissingConversionError: A transaction's currency can't be converted.
+
+        """
+
+        for field in by:
+            if field not in ('store', 'sku', 'currency'):
+                raise ValueError("Can't group transactions by %s" % field)
+
+        with self.instrument.phase('sum'):
+            counts = countGroups(columns, by, items)
+
+        allTotals = {}
+        for toCurrency in toCurrencies:
+            rates = dict((currency, self.deriveMissingRate(currency, toCurrency))
+                         for currency in columns.currencyNames)
+            try:
+                with self.instrument.phase('sum'):
+                    totals = sumGroups(columns, counts, rates)
+            except KeyError as e:
+                print "\nNo conversion found for %s-->%s" % (e.args[0], toCurrency)
+                raise SystemExit
+
+            allTotals[toCurrency] = dict((group, Decimal(cents).scaleb(-2))
+                                         for group, cents in totals.items())
+
+        return allTotals
+
+
+if __name__ == '__main__':
+    import sys
+
+    from cli import main
 
-    except Exception as e:
-        print "\n%s\nUnhandled exception; aborting!\n\n" % format_exc()
+    # The puzzle's question, unless other arguments are given (see cli.py):
+    sys.exit(main(sys.argv[1:] or ['--sku', 'DM1182']))
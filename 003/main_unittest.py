@@ -0,0 +1,746 @@
+from decimal import Decimal
+from StringIO import StringIO
+import time
+import os
+import shutil
+import subprocess
+import sys
+import json
+import tempfile
+import threading
+import unittest
+import urllib2
+
+import columnar
+import columnfile
+from cli import main as runCli
+from derivedrates import DerivedRateCache
+from fixedpoint import fixedConverter, roundHalfEven
+from instrument import Instrumentation
+from main import InternationalTrade
+from rateclosure import RateClosure
+from ratehistory import RateHistory
+from service import TallyServer, TallyService
+from skuindex import skuOffsets
+from transsource import TransactionSource
+
+
+class Test(unittest.TestCase):
+    sample_rates = {('AUD', 'CAD'): Decimal('1.0079'),
+                    ('CAD', 'USD'): Decimal('1.0090'),
+                    ('USD', 'CAD'): Decimal('0.9911')}
+
+    target_sku = 'DM1182'
+
+    def test_closure_derives_rate_2_levels_deep(self):
+        closure = RateClosure(self.sample_rates)
+        self.assertEqual(closure.rate('AUD', 'USD'), Decimal('1.0079') * Decimal('1.0090'))
+
+    def test_closure_reports_unreachable_pairs(self):
+        closure = RateClosure(self.sample_rates)
+        self.assertEqual(closure.unreachable(), [('CAD', 'AUD'), ('USD', 'AUD')])
+        self.assertEqual(closure.rate('USD', 'AUD'), None)
+
+    def test_closure_same_currency_returns_one(self):
+        closure = RateClosure(self.sample_rates)
+        self.assertEqual(closure.rate('USD', 'USD'), 1)
+        self.assertEqual(closure.rate('ZZZ', 'ZZZ'), 1)
+
+    def test_tally_sample_files_returns_134_22(self):
+        it = InternationalTrade()
+        it.getRates('data/SAMPLE_RATES.xml', findMissing=True)
+        total = it.tallyTransactions('data/SAMPLE_TRANS.csv', self.target_sku, 'USD')
+        self.assertEqual(total, Decimal('134.22'))
+
+    def test_tally_real_files_returns_59482_47(self):
+        it = InternationalTrade()
+        it.getRates('data/RATES.xml')
+        total = it.tallyTransactions('data/TRANS.csv', self.target_sku, 'USD')
+        self.assertEqual(total, Decimal('59482.47'))
+
+    def test_tally_columns_matches_tally_transactions(self):
+        it = InternationalTrade()
+        it.getRates('data/RATES.xml')
+        columns = it.getColumns('data/TRANS.csv')
+        for currency in ('USD', 'EUR', 'AUD'):
+            self.assertEqual(it.tallyColumns(columns, None, currency),
+                             it.tallyTransactions('data/TRANS.csv', None, currency))
+
+    def test_column_file_tallies_match_csv(self):
+        workDir = tempfile.mkdtemp()
+        try:
+            columnFile = os.path.join(workDir, 'TRANS.cols')
+            it = InternationalTrade()
+            it.getRates('data/RATES.xml')
+            self.assertEqual(it.convertTransactions('data/TRANS.csv', columnFile),
+                             len(it.getColumns('data/TRANS.csv')))
+
+            for arithmetic in ('decimal', 'fixed'):
+                self.assertEqual(it.tallyTransactions(columnFile, self.target_sku, 'USD', arithmetic),
+                                 Decimal('59482.47'))
+            self.assertEqual(it.tallyTransactions(columnFile, None, 'EUR'),
+                             it.tallyTransactions('data/TRANS.csv', None, 'EUR'))
+
+            columns = it.getColumns(columnFile)
+            self.assertEqual(columns.storeNames[columns.stores[0]], 'Utica')
+        finally:
+            shutil.rmtree(workDir)
+
+    def test_column_file_is_tallied_or_refused_by_every_entry_point(self):
+        workDir = tempfile.mkdtemp()
+        try:
+            columnFile = os.path.join(workDir, 'TRANS.cols')
+            it = InternationalTrade()
+            it.getRates('data/RATES.xml')
+            it.convertTransactions('data/TRANS.csv', columnFile)
+
+            self.assertEqual(it.tallyParallel(columnFile, self.target_sku, 'USD', processes=2),
+                             Decimal('59482.47'))
+            for rounding in ('row', 'group'):
+                self.assertEqual(it.tallyByCurrency(columnFile, 'EUR', rounding),
+                                 it.tallyByCurrency('data/TRANS.csv', 'EUR', rounding))
+
+            self.assertRaises(ValueError, it.validateTransactions, columnFile, ['USD'])
+            self.assertRaises(ValueError, it.tallyAppended, columnFile, 'USD',
+                              os.path.join(workDir, 'state'))
+            self.assertRaises(ValueError, it.tallyFiles, columnFile, 'USD')
+        finally:
+            shutil.rmtree(workDir)
+
+    def test_column_file_is_packed_when_array_item_sizes_differ(self):
+        workDir = tempfile.mkdtemp()
+        layout, numpy = columnfile.COLUMNS, columnar.numpy
+        try:
+            columnFile = os.path.join(workDir, 'TRANS.cols')
+            it = InternationalTrade()
+            it.getRates('data/RATES.xml')
+            it.convertTransactions('data/TRANS.csv', columnFile)
+            with open(columnFile, 'rb') as f:
+                expected = f.read()
+
+            # As on platforms where a C long is 4 bytes, without NumPy:
+            columnfile.COLUMNS = (('cents', 'i', '<i8'),) + layout[1:]
+            columnar.numpy = None
+            it.convertTransactions('data/TRANS.csv', columnFile)
+            with open(columnFile, 'rb') as f:
+                self.assertEqual(f.read(), expected)
+            self.assertEqual(it.tallyTransactions(columnFile, self.target_sku, 'USD'),
+                             Decimal('59482.47'))
+        finally:
+            columnfile.COLUMNS, columnar.numpy = layout, numpy
+            shutil.rmtree(workDir)
+
+    def test_column_tallies_keep_fractions_of_a_cent(self):
+        workDir = tempfile.mkdtemp()
+        try:
+            transFile = os.path.join(workDir, 'trans.csv')
+            columnFile = os.path.join(workDir, 'trans.cols')
+            with open(transFile, 'w') as f:
+                f.write('store,sku,amount\n'
+                        'Utica,DM1182,1.00 USD\n'
+                        'Utica,DM1182,2.004 USD\n'
+                        'Akron,DM1182,1.015 AUD\n')
+
+            it = InternationalTrade()
+            it.getRates('data/RATES.xml')
+            expected = it.tallyTransactions(transFile, self.target_sku, 'USD')
+            self.assertEqual(it.tallyColumns(it.getColumns(transFile), self.target_sku, 'USD'),
+                             expected)
+            self.assertEqual(it.convertTransactions(transFile, columnFile), 3)
+            self.assertEqual(it.tallyTransactions(columnFile, self.target_sku, 'USD'), expected)
+
+            self.assertEqual(it.tallyTransactions(transFile, self.target_sku, 'USD', 'fixed'),
+                             expected)
+            totals, deviations = it.tallyByCurrency(transFile, 'USD')
+            self.assertEqual(totals[self.target_sku], expected)
+            totals, deviations = it.tallyByCurrency(transFile, 'USD', rounding='group')
+            self.assertTrue(abs(totals[self.target_sku] - expected) <= deviations[self.target_sku])
+        finally:
+            shutil.rmtree(workDir)
+
+    def test_tally_all_matches_tally_transactions_per_sku(self):
+        it = InternationalTrade()
+        it.getRates('data/RATES.xml')
+        totals = it.tallyAll('data/TRANS.csv', 'USD')
+        self.assertEqual(totals[(self.target_sku,)], Decimal('59482.47'))
+        self.assertEqual(sum(totals.values()), it.tallyTransactions('data/TRANS.csv', None, 'USD'))
+
+    def test_tally_currencies_matches_one_tally_per_currency(self):
+        it = InternationalTrade()
+        it.getRates('data/RATES.xml')
+        currencies = ['USD', 'EUR', 'CAD']
+        for item in (None, self.target_sku):
+            self.assertEqual(it.tallyCurrencies('data/TRANS.csv', item, currencies),
+                             dict((currency, it.tallyTransactions('data/TRANS.csv', item, currency))
+                                  for currency in currencies))
+
+        allTotals = it.tallyAllCurrencies('data/TRANS.csv', currencies)
+        for currency in currencies:
+            self.assertEqual(allTotals[currency], it.tallyAll('data/TRANS.csv', currency))
+
+    def test_tally_all_groups_by_sku_and_store(self):
+        it = InternationalTrade()
+        it.getRates('data/SAMPLE_RATES.xml')
+        totals = it.tallyAll('data/SAMPLE_TRANS.csv', 'USD', by=('sku', 'store'))
+        self.assertEqual(totals[('DM1182', 'Camden')], Decimal('54.64'))
+        self.assertEqual(len(totals), 5)
+
+    def test_transaction_source_skips_and_counts_header(self):
+        source = TransactionSource('data/SAMPLE_TRANS.csv')
+        rows = list(source)
+        self.assertEqual(rows[0], ('Yonkers', 'DM1210', '70.00', 'USD'))
+        self.assertEqual((source.rowsParsed, source.rowsSkipped), (5, 1))
+
+    def test_transaction_source_skips_and_counts_malformed_quoted_rows(self):
+        errors = []
+        source = TransactionSource(None, errors=errors, lines=[
+            'Utica,DM1759,84.16 CAD', 'Utica,"DM1759,84.16 CAD', '"Albany",DM1786,91.34 AUD',
+            '"Albany\0",DM1786,91.34 AUD', '"Albany, NY",DM1724,27.19 USD'])
+        self.assertEqual([row[0] for row in source], ['Utica', 'Albany', 'Albany, NY'])
+        self.assertEqual((source.rowsParsed, source.rowsSkipped), (3, 2))
+        self.assertEqual([lineNumber for lineNumber, line in errors], [2, 4])
+
+    def test_transaction_source_ranges_yield_every_row_once(self):
+        size = os.path.getsize('data/TRANS.csv')
+        bounds = [0, 1, size // 3, size // 2, size]
+        rows = []
+        for start, end in zip(bounds, bounds[1:]):
+            rows.extend(TransactionSource('data/TRANS.csv', start, end, chunkSize=1000))
+        self.assertEqual(rows, list(TransactionSource('data/TRANS.csv')))
+
+    def test_tally_parallel_matches_tally_transactions(self):
+        it = InternationalTrade()
+        it.getRates('data/RATES.xml')
+        self.assertEqual(it.tallyParallel('data/TRANS.csv', self.target_sku, 'USD', processes=3),
+                         Decimal('59482.47'))
+        self.assertEqual(it.tallyParallel('data/TRANS.csv', None, 'EUR', processes=2),
+                         it.tallyTransactions('data/TRANS.csv', None, 'EUR'))
+
+    def test_tally_files_matches_tally_all(self):
+        workDir = tempfile.mkdtemp()
+        try:
+            with open('data/TRANS.csv') as f:
+                header = f.readline()
+                stores = {}
+                for line in f:
+                    stores.setdefault(line.split(',')[0], []).append(line)
+            for store, lines in stores.items():
+                with open(os.path.join(workDir, store + '.csv'), 'wb') as f:
+                    # Some stores send their files with CRLF line endings:
+                    data = header + ''.join(lines)
+                    f.write(data.replace('\n', '\r\n') if store < 'N' else data)
+
+            it = InternationalTrade(instrument=Instrumentation())
+            it.getRates('data/RATES.xml')
+            totals = it.tallyFiles(workDir, 'USD', readers=2, processes=2)
+            self.assertEqual(totals[(self.target_sku,)], Decimal('59482.47'))
+            self.assertEqual(it.instrument.counters['rowsSkipped'], len(stores))
+            self.assertEqual(totals, it.tallyAll('data/TRANS.csv', 'USD'))
+        finally:
+            shutil.rmtree(workDir)
+
+    def test_transaction_source_item_scan_matches_filtered_rows(self):
+        rows = [row for row in TransactionSource('data/TRANS.csv') if row[1] == self.target_sku]
+        source = TransactionSource('data/TRANS.csv', item=self.target_sku)
+        self.assertEqual(list(source), rows)
+        self.assertEqual(source.rowsParsed, len(rows))
+
+    def test_get_rates_loads_closure_from_cache(self):
+        cacheDir = tempfile.mkdtemp()
+        try:
+            InternationalTrade().getRates('data/RATES.xml', cacheDir=cacheDir)
+            self.assertEqual(len(os.listdir(cacheDir)), 1)
+
+            it = InternationalTrade()
+            it.getRates('data/RATES.xml', cacheDir=cacheDir)
+            self.assertNotEqual(it.closure, None)
+            self.assertEqual(it.tallyTransactions('data/TRANS.csv', self.target_sku, 'USD'),
+                             Decimal('59482.47'))
+        finally:
+            shutil.rmtree(cacheDir)
+
+    def test_cached_closure_only_derives_from_its_file(self):
+        cacheDir = tempfile.mkdtemp()
+        try:
+            for name, frm, to in (('A.xml', 'EUR', 'AUD'), ('B.xml', 'AUD', 'USD')):
+                with open(os.path.join(cacheDir, name), 'w') as f:
+                    f.write('<rates><rate><from>%s</from><to>%s</to>'
+                            '<conversion>1.5</conversion></rate></rates>' % (frm, to))
+
+            it = InternationalTrade()
+            it.getRates(os.path.join(cacheDir, 'A.xml'))
+            it.getRates(os.path.join(cacheDir, 'B.xml'), cacheDir=cacheDir)
+            self.assertEqual(it.deriveMissingRate('EUR', 'USD'), Decimal('2.25'))
+
+            it = InternationalTrade()
+            it.getRates(os.path.join(cacheDir, 'B.xml'), cacheDir=cacheDir)
+            self.assertEqual(it.deriveMissingRate('EUR', 'USD'), None)
+            self.assertEqual(it.deriveMissingRate('AUD', 'USD'), Decimal('1.5'))
+        finally:
+            shutil.rmtree(cacheDir)
+
+    def test_round_half_even_rounds_halves_to_even(self):
+        self.assertEqual([roundHalfEven(n, 10) for n in (5, 15, 25, 26, -5, -15, -26)],
+                         [0, 2, 2, 3, 0, -2, -3])
+
+    def test_fixed_converter_matches_decimal_for_long_rates(self):
+        rate = Decimal('1.367012552621234567890123457')
+        convert = fixedConverter(rate)
+        for cents in (1, 8416, 123456789012345, -5000):
+            expected = (Decimal(cents).scaleb(-2) * rate).quantize(Decimal('0.01'))
+            self.assertEqual(Decimal(convert(cents)).scaleb(-2), expected)
+
+    def test_tally_fixed_matches_tally_decimal_for_real_files(self):
+        it = InternationalTrade()
+        it.getRates('data/RATES.xml')
+        for currency in ('USD', 'EUR', 'CAD', 'AUD'):
+            for item in (None, self.target_sku):
+                self.assertEqual(it.tallyTransactions('data/TRANS.csv', item, currency, 'fixed'),
+                                 it.tallyTransactions('data/TRANS.csv', item, currency))
+
+    def test_closure_updates_match_closure_built_from_scratch(self):
+        for policy in ('hops', 'best', 'worst'):
+            rates = dict(self.sample_rates)
+            closure = RateClosure(rates, policy)
+            closure.rate('AUD', 'USD')
+
+            for frm, to, rate in (('CAD', 'USD', Decimal('1.02')), ('USD', 'AUD', Decimal('0.98')),
+                                  ('EUR', 'CAD', Decimal('1.4')), ('AUD', 'USD', Decimal('1.1')),
+                                  ('AUD', 'USD', None), ('CAD', 'USD', None)):
+                if rate is None:
+                    del rates[(frm, to)]
+                    closure.removeRate(frm, to)
+                else:
+                    rates[(frm, to)] = rate
+                    closure.updateRate(frm, to, rate)
+
+                expected = RateClosure(rates, policy)
+                for x in expected.currencies:
+                    for y in expected.currencies:
+                        self.assertEqual(closure.rate(x, y), expected.rate(x, y))
+                        self.assertEqual(closure.path(x, y), expected.path(x, y))
+
+    def test_closure_path_policies(self):
+        rates = {('A', 'B'): Decimal(2), ('B', 'C'): Decimal(3), ('A', 'C'): Decimal('6.5'),
+                 ('A', 'D'): Decimal(1), ('D', 'C'): Decimal(7)}
+        for policy, path, rate in (('hops', ['A', 'C'], Decimal('6.5')),
+                                   ('best', ['A', 'D', 'C'], Decimal(7)),
+                                   ('worst', ['A', 'B', 'C'], Decimal(6))):
+            closure = RateClosure(rates, policy)
+            self.assertEqual(closure.path('A', 'C'), path)
+            self.assertEqual(closure.rate('A', 'C'), rate)
+        self.assertEqual(closure.arbitrage(), [])
+
+        # With arbitrage, the best path is the best simple path:
+        rates[('C', 'A')] = Decimal('0.2')
+        closure = RateClosure(rates, 'best')
+        self.assertEqual(closure.path('A', 'C'), ['A', 'D', 'C'])
+        self.assertEqual(closure.path('B', 'A'), ['B', 'C', 'A'])
+        self.assertEqual(closure.arbitrage(), [('A', 'D', 'C')])
+        self.assertRaises(ValueError, RateClosure, rates, 'cheapest')
+
+    def test_closure_searches_again_only_from_currencies_reaching_a_changed_rate(self):
+        rates = {('A', 'B'): Decimal(2), ('B', 'A'): Decimal('0.6'), ('C', 'A'): Decimal(1),
+                 ('D', 'E'): Decimal(3)}
+        closure = RateClosure(rates, 'best')
+        self.assertEqual(closure.arbitrage(), [('A', 'B')])
+        self.assertEqual(closure.path('C', 'B'), ['C', 'A', 'B'])
+        closure.takeStats()
+
+        closure.updateRate('D', 'E', Decimal(4))
+        closure.updateRate('C', 'A', Decimal(2))
+        rates.update({('D', 'E'): Decimal(4), ('C', 'A'): Decimal(2)})
+        expected = RateClosure(rates, 'best')
+        for x in expected.currencies:
+            for y in expected.currencies:
+                self.assertEqual(closure.rate(x, y), expected.rate(x, y))
+        self.assertEqual(closure.takeStats()['searches'], 2)
+
+    def test_closure_finds_arbitrage_in_real_rates(self):
+        it = InternationalTrade(policy='best')
+        it.getRates('data/RATES.xml')
+        self.assertEqual(it.buildClosure().arbitrage(), [('CAD', 'USD')])
+        self.assertEqual(it.conversionPath('EUR', 'USD'), ['EUR', 'AUD', 'CAD', 'USD'])
+        self.assertEqual(it.tallyTransactions('data/TRANS.csv', self.target_sku, 'USD'),
+                         Decimal('59482.47'))
+
+    def test_update_rate_changes_derived_rates(self):
+        it = InternationalTrade()
+        it.getRates('data/SAMPLE_RATES.xml', findMissing=True)
+        it.updateRate('CAD', 'USD', '1.1')
+        self.assertEqual(it.deriveMissingRate('AUD', 'USD'), Decimal('1.0079') * Decimal('1.1'))
+        it.removeRate('AUD', 'CAD')
+        self.assertEqual(it.deriveMissingRate('AUD', 'USD'), None)
+
+        # Only the derived rates whose path goes through the changed rate are forgotten:
+        for pair in (('USD', 'CAD'), ('CAD', 'USD')):
+            it.deriveMissingRate(*pair)
+        it.updateRate('USD', 'CAD', '0.98')
+        self.assertEqual(len(it.derivedRates), 2)
+        hits = it.derivedRates.hits
+        self.assertEqual(it.deriveMissingRate('CAD', 'USD'), Decimal('1.1'))
+        self.assertEqual(it.derivedRates.hits, hits + 1)
+        self.assertEqual(it.deriveMissingRate('USD', 'CAD'), Decimal('0.98'))
+
+    def test_tally_service_answers_concurrent_queries(self):
+        it = InternationalTrade()
+        it.getRates('data/RATES.xml')
+        server = TallyServer(('127.0.0.1', 0), TallyService(it, 'data/TRANS.csv'))
+        threading.Thread(target=server.serve_forever).start()
+        try:
+            url = 'http://127.0.0.1:%d/total?sku=%%s&currency=USD' % server.server_address[1]
+            replies = {}
+            def ask(sku):
+                replies[sku] = json.load(urllib2.urlopen(url % sku))['total']
+
+            askers = [threading.Thread(target=ask, args=(sku,)) for sku in ('DM1182', 'DM1210')]
+            for asker in askers:
+                asker.start()
+            for asker in askers:
+                asker.join()
+
+            self.assertEqual(replies['DM1182'], '59482.47')
+            self.assertEqual(Decimal(replies['DM1210']),
+                             it.tallyTransactions('data/TRANS.csv', 'DM1210', 'USD'))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_in_memory_tally_service_answers_a_batch_in_one_pass(self):
+        it = InternationalTrade()
+        it.getRates('data/RATES.xml')
+        service = TallyService(it, 'data/TRANS.csv', inMemory=True, window=0.2)
+
+        passes = []
+        tallyAllColumns = it.tallyAllColumns
+        def countingTallyAllColumns(*args, **kwargs):
+            passes.append(args[1])
+            return tallyAllColumns(*args, **kwargs)
+        it.tallyAllColumns = countingTallyAllColumns
+
+        queries = [(sku, currency) for sku in ('DM1182', 'DM1210') for currency in ('USD', 'EUR')]
+        answers = {}
+        def ask(sku, currency):
+            answers[(sku, currency)] = service.total(sku, currency)
+
+        askers = [threading.Thread(target=ask, args=query) for query in queries]
+        for asker in askers:
+            asker.start()
+        for asker in askers:
+            asker.join()
+
+        self.assertEqual(passes, [['EUR', 'USD']])
+        self.assertEqual(answers[('DM1182', 'USD')], Decimal('59482.47'))
+        self.assertEqual(answers[('DM1182', 'EUR')], Decimal('43510.10'))
+        self.assertEqual(answers[('DM1210', 'USD')], Decimal('62284.26'))
+
+    def test_sku_index_is_used_until_file_changes(self):
+        workDir = tempfile.mkdtemp()
+        try:
+            transFile = os.path.join(workDir, 'TRANS.csv')
+            shutil.copy('data/TRANS.csv', transFile)
+
+            it = InternationalTrade()
+            it.getRates('data/RATES.xml')
+            it.indexTransactions(transFile)
+            self.assertEqual(len(skuOffsets(transFile, self.target_sku)), 1010)
+            self.assertEqual(it.tallyTransactions(transFile, self.target_sku, 'USD'),
+                             Decimal('59482.47'))
+
+            with open(transFile, 'a') as f:
+                f.write('Utica,DM1182,1.00 USD\n')
+            self.assertEqual(skuOffsets(transFile, self.target_sku), None)
+            self.assertEqual(it.tallyTransactions(transFile, self.target_sku, 'USD'),
+                             Decimal('59483.47'))
+
+            # Without a header row, the first row is indexed like the others:
+            with open(transFile, 'w') as f:
+                f.write('Utica,DM1182,5.00 USD\nUtica,DM1182,2.00 USD\n')
+            it.indexTransactions(transFile)
+            self.assertEqual(len(skuOffsets(transFile, self.target_sku)), 2)
+            self.assertEqual(it.tallyTransactions(transFile, self.target_sku, 'USD'),
+                             Decimal('7.00'))
+
+            # Quoted rows, with a date or with a NUL byte, are split as a scan splits them:
+            with open(transFile, 'w') as f:
+                f.write('"Albany, NY",DM1182,1.00 USD,2014-01-05\n'
+                        'Utica,"DM1182\0",2.00 USD\n'
+                        'Utica,DM1182,2.00 USD\n')
+            it.indexTransactions(transFile)
+            self.assertEqual(len(skuOffsets(transFile, self.target_sku)), 2)
+            self.assertEqual(it.tallyTransactions(transFile, self.target_sku, 'USD'),
+                             Decimal('3.00'))
+        finally:
+            shutil.rmtree(workDir)
+
+    def test_tally_appended_reads_only_complete_appended_rows(self):
+        workDir = tempfile.mkdtemp()
+        try:
+            transFile = os.path.join(workDir, 'TRANS.csv')
+            stateFile = os.path.join(workDir, 'TRANS.state')
+            with open('data/TRANS.csv') as f:
+                lines = f.readlines()
+            with open(transFile, 'w') as f:
+                f.writelines(lines[:5000])
+
+            it = InternationalTrade()
+            it.getRates('data/RATES.xml')
+            it.tallyAppended(transFile, 'USD', stateFile)
+
+            with open(transFile, 'a') as f:
+                f.writelines(lines[5000:])
+                f.write('Utica,DM1182,1.0')
+            totals = it.tallyAppended(transFile, 'USD', stateFile)
+            self.assertEqual(totals[self.target_sku], Decimal('59482.47'))
+
+            with open(transFile, 'a') as f:
+                f.write('0 USD\n')
+            totals = it.tallyAppended(transFile, 'USD', stateFile)
+            self.assertEqual(totals[self.target_sku], Decimal('59483.47'))
+
+            # A rotated file, as long as the one tallied, starts a new tally:
+            os.rename(transFile, transFile + '.1')
+            with open(transFile, 'w') as f:
+                f.writelines(lines[:1] + ['Utica,DM1182,1.00 USD\n'] * 2 * len(lines))
+            self.assertTrue(os.path.getsize(transFile) > os.path.getsize(transFile + '.1'))
+            totals = it.tallyAppended(transFile, 'USD', stateFile)
+            self.assertEqual(totals[self.target_sku], Decimal(2 * len(lines)))
+        finally:
+            shutil.rmtree(workDir)
+
+    def test_tally_by_currency_row_rounding_matches_tally_all(self):
+        it = InternationalTrade()
+        it.getRates('data/RATES.xml')
+        totals, deviations = it.tallyByCurrency('data/TRANS.csv', 'USD')
+        self.assertEqual(totals, dict((sku, total) for (sku,), total
+                                      in it.tallyAll('data/TRANS.csv', 'USD').items()))
+        self.assertEqual(set(deviations.values()), set([0]))
+
+    def test_tally_by_currency_group_rounding_stays_within_reported_deviation(self):
+        it = InternationalTrade()
+        it.getRates('data/RATES.xml')
+        exact, _ = it.tallyByCurrency('data/TRANS.csv', 'EUR')
+        totals, deviations = it.tallyByCurrency('data/TRANS.csv', 'EUR', rounding='group')
+        for sku, total in totals.items():
+            self.assertTrue(abs(total - exact[sku]) <= deviations[sku])
+
+    def test_derived_rate_cache_evicts_least_recently_used(self):
+        cache = DerivedRateCache(maxSize=2)
+        for key in ('a', 'b', 'a', 'c'):
+            cache.get(key, lambda: key.upper())
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (1, 3, 1))
+        self.assertEqual(cache.get('b', lambda: 'recomputed'), 'recomputed')
+        self.assertEqual(cache.get('a', lambda: 'recomputed'), 'recomputed')
+
+    def test_derived_rate_cache_computes_concurrent_misses_once(self):
+        cache = DerivedRateCache()
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return Decimal('1.5')
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get(('AUD', 'USD'), compute)))
+                   for i in range(8)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        while cache.waits < len(threads) - 1:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [Decimal('1.5')] * len(threads))
+
+    def test_concurrent_tallies_share_one_instance(self):
+        it = InternationalTrade()
+        it.getRates('data/RATES.xml')
+        totals = []
+        threads = [threading.Thread(target=lambda: totals.append(
+                       it.tallyTransactions('data/TRANS.csv', self.target_sku, 'USD')))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(totals, [Decimal('59482.47')] * len(threads))
+        self.assertEqual(it.derivedRates.misses, len(it.derivedRates))
+
+    def test_dated_tally_converts_rows_with_rates_in_effect(self):
+        workDir = tempfile.mkdtemp()
+        try:
+            with open('data/RATES.xml') as f:
+                content = f.read()
+            changedRates = os.path.join(workDir, 'RATES-0110.xml')
+            with open(changedRates, 'w') as f:
+                f.write(content.replace('1.0090', '1.1000'))
+
+            with open('data/TRANS.csv') as f:
+                lines = f.read().splitlines()
+            paths = dict((name, os.path.join(workDir, name))
+                         for name in ('early.csv', 'late.csv', 'dated.csv'))
+            with open(paths['early.csv'], 'w') as f:
+                f.write('\n'.join(lines[:5000]) + '\n')
+            with open(paths['late.csv'], 'w') as f:
+                f.write('\n'.join(lines[:1] + lines[5000:]) + '\n')
+            with open(paths['dated.csv'], 'w') as f:
+                f.write(lines[0] + ',date\n')
+                for n, line in enumerate(lines[1:]):
+                    f.write('%s,%s\n' % (line, '2014-01-05T%02d:%02d:%02d' %
+                                         (n // 3600, n // 60 % 60, n % 60) if n < 4999 else
+                                         '2014-01-20T09:30'))
+
+            early = InternationalTrade()
+            early.getRates('data/RATES.xml')
+            late = InternationalTrade()
+            late.getRates(changedRates)
+            expected = early.tallyTransactions(paths['early.csv'], None, 'USD') + \
+                late.tallyTransactions(paths['late.csv'], None, 'USD')
+
+            it = InternationalTrade()
+            for date in ('2014-01-01', '2014-01-05', '2014-01-08'):
+                it.getRates('data/RATES.xml', asOf=date)
+            it.getRates(changedRates, asOf='2014-01-10')
+            self.assertEqual(len(it.history), 4)
+            self.assertTrue(it.history.snapshots[0] is it.history.snapshots[2])
+            lookups = []
+            snapshotAt = it.history.snapshotAt
+            it.history.snapshotAt = lambda date: lookups.append(date) or snapshotAt(date)
+            self.assertEqual(it.tallyTransactions(paths['dated.csv'], None, 'USD', dated=True),
+                             expected)
+            # Once per snapshot the rows are in effect in, not once per timestamp:
+            self.assertEqual(lookups, ['2014-01-05T00:00:00', '2014-01-20T09:30'])
+            del it.history.snapshotAt
+            self.assertEqual(it.history.rate('AUD', 'USD', '2013-12-31'), None)
+
+            self.assertRaises(ValueError, it.tallyTransactions, paths['dated.csv'], None, 'USD',
+                              'fixed', dated=True)
+            columnFile = os.path.join(workDir, 'dated.cols')
+            it.convertTransactions(paths['dated.csv'], columnFile)
+            self.assertRaises(ValueError, it.tallyTransactions, columnFile, None, 'USD',
+                              dated=True)
+            self.assertTrue(it.history.closure(0) is it.history.closure(2))
+        finally:
+            shutil.rmtree(workDir)
+
+    def test_rate_history_replacing_a_date_keeps_equal_neighbours(self):
+        history = RateHistory()
+        history.add('2014-01-01', {('AUD', 'USD'): Decimal('1.1')})
+        history.add('2014-01-05', {('AUD', 'USD'): Decimal('1.1')})
+        history.add('2014-01-01', {('AUD', 'USD'): Decimal('2.0')})
+        self.assertEqual(history.rate('AUD', 'USD', '2014-01-02'), Decimal('2.0'))
+        self.assertEqual(history.rate('AUD', 'USD', '2014-01-06'), Decimal('1.1'))
+
+    def test_cold_start_imports_only_what_a_tally_needs(self):
+        script = ("import sys, timeit; start = timeit.default_timer(); import main; "
+                  "print timeit.default_timer() - start; "
+                  "print ' '.join(sorted(m for m in ('numpy', 'multiprocessing', 'argparse') "
+                  "                      if m in sys.modules))")
+        (seconds, heavy) = subprocess.check_output([sys.executable, '-c', script]).split('\n')[:2]
+        self.assertEqual(heavy, '')
+        self.assertTrue(float(seconds) < 1.0, "importing main took %s seconds" % seconds)
+
+        output = subprocess.check_output([sys.executable, 'cli.py', '--sku', 'DM1182'])
+        self.assertEqual(output, 'DM1182 USD 59482.47\n')
+
+    def test_tally_all_of_column_file_matches_csv(self):
+        workDir = tempfile.mkdtemp()
+        try:
+            columnFile = os.path.join(workDir, 'TRANS.cols')
+            it = InternationalTrade()
+            it.getRates('data/RATES.xml')
+            it.convertTransactions('data/TRANS.csv', columnFile)
+
+            for by in (('sku',), ('store', 'currency')):
+                self.assertEqual(it.tallyAllCurrencies(columnFile, ['USD', 'EUR'], by),
+                                 it.tallyAllCurrencies('data/TRANS.csv', ['USD', 'EUR'], by))
+
+            out = StringIO()
+            self.assertEqual(runCli(['--trans', columnFile, '--format', 'csv'], out), 0)
+            self.assertTrue('DM1182,USD,59482.47' in out.getvalue().splitlines())
+        finally:
+            shutil.rmtree(workDir)
+
+    def test_cli_writes_totals_in_each_format(self):
+        out = StringIO()
+        self.assertEqual(runCli(['--sku', 'DM1182,DM1210', '--currency', 'USD', '--currency', 'EUR',
+                                 '--format', 'json'], out), 0)
+        totals = json.loads(out.getvalue())
+        self.assertEqual(totals[0], {'sku': 'DM1182', 'currency': 'USD', 'total': '59482.47'})
+        self.assertEqual([(row['sku'], row['currency']) for row in totals],
+                         [('DM1182', 'USD'), ('DM1182', 'EUR'), ('DM1210', 'USD'), ('DM1210', 'EUR')])
+
+        out = StringIO()
+        self.assertEqual(runCli(['--rates', 'data/SAMPLE_RATES.xml', '--trans', 'data/SAMPLE_TRANS.csv',
+                                 '--format', 'csv'], out), 0)
+        self.assertEqual(out.getvalue().splitlines()[:2], ['sku,currency,total', 'DM1182,USD,134.22'])
+
+    def test_validate_transactions_reports_every_problem(self):
+        it = InternationalTrade()
+        it.getRates('data/RATES.xml')
+        self.assertTrue(it.validateTransactions('data/TRANS.csv', ['USD', 'EUR']).ok())
+
+        workDir = tempfile.mkdtemp()
+        try:
+            transFile = os.path.join(workDir, 'trans.csv')
+            with open(transFile, 'w') as f:
+                f.write('store,sku,amount\n'
+                        'Utica,DM1759,84.16 CAD\n'
+                        'Utica,DM1759\n'
+                        'Albany,DM1786,91.34 XYZ\n'
+                        'Albany,DM1724,abc USD\n'
+                        'Albany,DM1724,27.19 USD\n'
+                        'Albany,DM1724,1.00 XYZ\n'
+                        'Albany,"DM1724,1.00 USD\n')
+
+            report = it.validateTransactions(transFile, ['USD'])
+            self.assertFalse(report.ok())
+            self.assertEqual(report.rowsParsed, 5)
+            self.assertEqual(report.badRows, [(3, 'Utica,DM1759'), (5, 'Albany,DM1724,abc USD'),
+                                              (8, 'Albany,"DM1724,1.00 USD')])
+            self.assertEqual(dict(report.missing), {('XYZ', 'USD'): 2})
+
+            out = StringIO()
+            self.assertEqual(runCli(['--trans', transFile, '--validate'], out), 1)
+            self.assertEqual(out.getvalue().splitlines()[-1],
+                             "5 transactions, 3 bad rows, 1 missing conversions")
+
+            # The header of a file whose rows have dates isn't a bad row either:
+            with open(transFile, 'w') as f:
+                f.write('store,sku,amount,date\n'
+                        'Utica,DM1759,84.16 CAD,2014-01-05\n')
+            self.assertTrue(it.validateTransactions(transFile, ['USD']).ok())
+        finally:
+            shutil.rmtree(workDir)
+
+    def test_instrumentation_counts_and_times_phases(self):
+        phases = []
+        instrument = Instrumentation(hook=lambda phase, seconds, counters: phases.append(phase))
+        it = InternationalTrade(instrument=instrument)
+        it.getRates('data/RATES.xml')
+        self.assertEqual(it.tallyTransactions('data/TRANS.csv', 'DM1182', 'USD'),
+                         Decimal('59482.47'))
+
+        report = json.loads(instrument.toJson())
+        self.assertEqual(phases, ['parseRates', 'derive', 'scan'])
+        self.assertEqual(set(report['timings']), set(phases))
+        counters = report['counters']
+        self.assertEqual(counters['searches'], len(it.closure.currencies))
+        self.assertTrue(counters['searchDepth'] >= 1)
+        self.assertEqual(counters['rowsSkipped'], 0)
+        self.assertTrue(counters['rowsParsed'] >= counters['rateHits'] + counters['rateMisses'])
+        self.assertTrue(0 < counters['rateMisses'] <= len(it.closure.currencies))
+
+        self.assertEqual(InternationalTrade().instrument.report(), {'counters': {}, 'timings': {}})
+
+
+if __name__ == "__main__":
+    unittest.main()
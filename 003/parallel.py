@@ -0,0 +1,104 @@
+from collections import defaultdict
+from decimal import Decimal, ROUND_HALF_EVEN
+from multiprocessing import Pool, cpu_count
+import os
+
+from transsource import TransactionSource
+
+
+# Conversion rates into the desired currency, set once in each worker process by _initWorker:
+_rates = None
+
+
+def _initWorker(rates):
+    global _rates
+    _rates = rates
+
+
+def _tallyRange(args):
+    """Tally the transactions in one byte range of a file, per SKU.
+
+    Args:
+        args (tuple): (transFile, start, end, item), as passed to TransactionSource, plus the SKU
+                      of the desired item or None for all items.
+
+    Returns:
+        A tuple with the following:
+
+        totals (dict of Decimal): Rounded totals, keyed by SKU.
+        missing (set of str): Currencies of selected transactions that can't be converted.
+    """
+
+    (transFile, start, end, item) = args
+
+    totals = defaultdict(Decimal)
+    missing = set()
+
+    for store, sku, amt, currency in TransactionSource(transFile, start, end, item=item):
+        if not item or sku == item:
+            rate = _rates.get(currency)
+            if rate is None:
+                missing.add(currency)
+                continue
+
+            totals[sku] += (Decimal(amt) * rate).quantize(Decimal("0.01"), rounding=ROUND_HALF_EVEN)
+
+    return dict(totals), missing
+
+
+def splitRanges(transFile, shards):
+    """Split a file into byte ranges of about the same size.
+
+    The ranges don't need to fall on line boundaries; TransactionSource assigns each row to the
+    range its first byte is in.
+
+    Returns:
+        A list of (start, end) tuples covering the whole file.
+    """
+
+    size = os.path.getsize(transFile)
+    shards = max(1, min(shards, size))
+    bounds = [size * i // shards for i in range(shards + 1)]
+
+    return zip(bounds, bounds[1:])
+
+
+def tallyShards(transFile, item, rates, processes=None, shardsPerProcess=4):
+    """Tally a transactions file in a pool of processes, per SKU.
+
+    Each row is rounded before it's added, so the workers' partial totals add up to exactly the
+    total a single process would compute.
+
+    Args:
+        transFile (str): A path to the transactions file.
+        item (str): The SKU of the desired item or None for all items.
+        rates (dict of Decimal): Conversion rate into the desired currency, keyed by currency;
+                                 None for currencies that can't be converted.
+        processes (opt int): Number of worker processes; defaults to the number of CPUs.
+        shardsPerProcess (opt int): Number of byte ranges per process, to even out the load.
+
+    Returns:
+        A tuple with the following:
+
+        totals (dict of Decimal): Rounded totals, keyed by SKU.
+        missing (set of str): Currencies of selected transactions that can't be converted.
+    """
+
+    processes = processes or cpu_count()
+    ranges = splitRanges(transFile, processes * shardsPerProcess)
+
+    pool = Pool(processes, initializer=_initWorker, initargs=(rates,))
+    try:
+        results = pool.map(_tallyRange, [(transFile, start, end, item) for start, end in ranges])
+    finally:
+        pool.close()
+        pool.join()
+
+    totals = defaultdict(Decimal)
+    missing = set()
+    for partialTotals, partialMissing in results:
+        for sku, subtotal in partialTotals.items():
+            totals[sku] += subtotal
+        missing |= partialMissing
+
+    return dict(totals), missing
@@ -0,0 +1,68 @@
+import cPickle as pickle
+import hashlib
+import os
+import tempfile
+
+
+# Part of every digest, so entries written by an older format are never loaded:
+CACHE_VERSION = 4
+
+
+def ratesDigest(content):
+    """Hash the content of a rates XML file.
+
+    Returns:
+        The hex digest used to name the file's cache entry.
+    """
+
+    return hashlib.sha1("%d\n%s" % (CACHE_VERSION, content)).hexdigest()
+
+
+def cachePath(cacheDir, digest):
+    return os.path.join(cacheDir, "%s.rates" % digest)
+
+
+def loadCachedRates(cacheDir, digest):
+    """Load the compiled rate table of a rates file from the cache.
+
+    Args:
+        cacheDir (str): Directory holding the cache entries.
+        digest (str): Hash of the rates file's content, from ratesDigest.
+
+    Returns:
+        A tuple (rates, closure) of the file's rates dictionary and its RateClosure, or None if
+        the file isn't in the cache or its entry can't be read.
+    """
+
+    try:
+        with open(cachePath(cacheDir, digest), 'rb') as f:
+            return pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def saveCachedRates(cacheDir, digest, rates, closure):
+    """Save the compiled rate table of a rates file in the cache.
+
+    The entry is written to a temporary file and renamed into place, so jobs loading the cache
+    at the same time never see a partial entry.
+
+    Args:
+        cacheDir (str): Directory holding the cache entries; created if needed.
+        digest (str): Hash of the rates file's content, from ratesDigest.
+        rates (dict of Decimal): Conversion rates read from the file, keyed by ('from', 'to').
+        closure (RateClosure): All-pairs conversion rates derived from them.
+
+    """
+
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+
+    fd, tmpPath = tempfile.mkstemp(dir=cacheDir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((rates, closure), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpPath, cachePath(cacheDir, digest))
+    except:
+        os.remove(tmpPath)
+        raise
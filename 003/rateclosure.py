@@ -0,0 +1,694 @@
+from bisect import insort
+from collections import defaultdict, deque
+from decimal import Decimal
+from math import log
+
+
+POLICIES = ('hops', 'best', 'worst')
+
+# Differences in summed log rates smaller than this are treated as ties:
+EPSILON = 1e-12
+
+
+class RateClosure():
+    """Precomputed conversion rates between every pair of currencies.
+
+    The known conversion rates form a directed graph with one node per currency and one edge per
+    rate. A breadth-first search is run once from each currency, multiplying the rates along the
+    way, and the results are stored in a dense matrix indexed by currency position. After that,
+    looking up any conversion is a pair of dictionary lookups and a list index.
+
+    The path chosen for each pair depends on the policy:
+        - 'hops': A path with the fewest rates, found by breadth-first search.
+        - 'best': The path with the largest product of rates, found by Bellman-Ford over the
+                  graph weighted by -log(rate).
+        - 'worst': The path with the smallest product of rates, found by Bellman-Ford over the
+                   graph weighted by log(rate).
+    A cycle whose rates multiply to more than 1 (arbitrage, see arbitrage()) makes the 'best'
+    product unbounded, and one whose rates multiply to less than 1 does the same for 'worst'.
+    The currencies from which such a cycle can be reached are found once, by a single
+    Bellman-Ford search from every currency at once (see _unboundedSources), and the paths from
+    them are instead chosen among simple paths: for each number of hops, the best path found to
+    each currency is extended by one rate, skipping the currencies already on it. That isn't
+    guaranteed to find the best simple path (which is NP-hard in general), but it takes
+    polynomial time and finds it on small graphs like the puzzle's; it costs a pass over the
+    rates per hop, so on rates full of such cycles, as random rates are, these searches
+    dominate the closure's cost. Bellman-Ford is only run from the other currencies, where it
+    stops as soon as nothing changes. Neighbours are always visited in sorted order and ties
+    keep the path found first, so the path chosen for a pair is the same from run to run. Each
+    pair's path is kept along with its rate. The rates weighted by log(rate) are built once,
+    and rebuilt only when the rates change.
+
+    Rates can be changed, added and removed afterwards with updateRate and removeRate. Only the
+    conversions that the change can affect are invalidated, and they are recomputed the next time
+    they're looked up:
+        - A changed rate keeps every path as it is, so only the pairs whose path goes through it
+          are recomputed, by multiplying the rates along their path again.
+        - An added or removed rate can change which paths are chosen, so the searches from the
+          currencies whose search tree it can change are run again.
+    The results are always the same as those of a RateClosure built from scratch. With the
+    'best' and 'worst' policies, any change to a rate can change any path through the currency
+    it converts from, so the searches from every currency that can reach it are run again.
+
+    Attributes:
+        policy (str): How paths are chosen: 'hops', 'best' or 'worst'.
+        currencies (list of str): All currencies; a currency's position in this list is its
+                                  index in the matrix.
+        index (dict of int): Matrix index of each currency, keyed by currency.
+        matrix (list of list of Decimal): matrix[i][j] is the rate from currencies[i] to
+                                          currencies[j], or None if there is no conversion.
+                                          Entries can be stale after an update; use rate().
+        parents (list of list of int): parents[i][j] is the index of the currency before
+                                       currencies[j] on the path from currencies[i], or None.
+        hops (list of list of int): hops[i][j] is the number of rates on the path from
+                                    currencies[i] to currencies[j], or None.
+        paths (list of list of tuple): paths[i][j] is the tuple of the indexes of the
+                                       currencies on the path from currencies[i] to
+                                       currencies[j], both included, or None.
+
+        searches (int): Number of searches run since the last takeStats().
+        nodesVisited (int): Number of currencies visited by those searches.
+        searchDepth (int): Largest number of hops found by those searches.
+
+    """
+
+    def __init__(self, rates, policy='hops'):
+        """Inits RateClosure from the known conversion rates.
+
+        Args:
+            rates (dict of Decimal): Known conversion rates, keyed by ('from', 'to'). Entries
+                                     with an empty value are ignored.
+            policy (opt str): How paths are chosen: 'hops', 'best' or 'worst'.
+
+        Raises:
+            ValueError: Unknown policy.
+        """
+
+        if policy not in POLICIES:
+            raise ValueError("Unknown path policy %s" % policy)
+
+        self.policy = policy
+        self.searches = 0
+        self.nodesVisited = 0
+        self.searchDepth = 0
+
+        self._neighbours = defaultdict(list)
+        currencies = set()
+
+        for (frm, to), rate in rates.items():
+            if rate and frm != to:
+                self._neighbours[frm].append((to, rate))
+                currencies.add(frm)
+                currencies.add(to)
+
+        self.currencies = sorted(currencies)
+        self.index = dict((currency, i) for i, currency in enumerate(self.currencies))
+
+        for edges in self._neighbours.values():
+            edges.sort()
+
+        self._weighted = {}
+        self._unbounded = None
+
+        self.matrix = []
+        self.parents = []
+        self.hops = []
+        self.paths = []
+        for frm in self.currencies:
+            (row, parents, hops, paths) = self._search(frm)
+            self.matrix.append(row)
+            self.parents.append(parents)
+            self.hops.append(hops)
+            self.paths.append(paths)
+
+        self._staleRows = set()
+        self._stalePairs = set()
+
+
+    def _search(self, frm):
+        """Search for the paths from one currency to all the others, according to the policy.
+
+        Args:
+            frm (str): Currency to convert from.
+
+        Returns:
+            A tuple of the rates, parents, hops and paths rows for the currency.
+        """
+
+        if self.policy == 'hops':
+            paths = self._searchHops(self.index[frm])
+        else:
+            paths = self._searchProducts(self.index[frm])
+
+        size = len(self.currencies)
+        row = [None] * size
+        parents = [None] * size
+        hops = [None] * size
+
+        # Multiply the rates along each path, once for each distinct prefix of the paths: the
+        # rate of every prefix is kept in a trie, keyed by (prefix's node, next currency):
+        trie = {}
+        for j, path in enumerate(paths):
+            if path is None:
+                continue
+
+            hops[j] = len(path) - 1
+            if len(path) > 1:
+                parents[j] = path[-2]
+
+            (node, rate) = (0, Decimal(1))
+            for k in range(1, len(path)):
+                try:
+                    (node, rate) = trie[(node, path[k])]
+                except KeyError:
+                    rate = rate * self._edgeRate(self.currencies[path[k - 1]],
+                                                 self.currencies[path[k]])
+                    trie[(node, path[k])] = (len(trie) + 1, rate)
+                    node = len(trie)
+
+            row[j] = rate
+
+        self.searches += 1
+        self.nodesVisited += size - row.count(None)
+        self.searchDepth = max([self.searchDepth] + [n for n in hops if n is not None])
+
+        return row, parents, hops, paths
+
+
+    def _searchHops(self, start):
+        """Breadth-first search for the paths with the fewest rates from one currency."""
+
+        paths = [None] * len(self.currencies)
+        paths[start] = (start,)
+
+        queue = deque([start])
+        while queue:
+            i = queue.popleft()
+
+            for to, rate in self._neighbours[self.currencies[i]]:
+                j = self.index[to]
+                if paths[j] is None:
+                    paths[j] = paths[i] + (j,)
+                    queue.append(j)
+
+        return paths
+
+
+    def _weightedEdges(self, sign):
+        """Weight the rates by sign * log(rate), once until the rates change.
+
+        Returns:
+            A tuple of the list of (from index, to index, weight) of every rate, in the order of
+            the currencies, and of the list of (to index, weight) of the rates from each currency.
+        """
+
+        try:
+            return self._weighted[sign]
+        except KeyError:
+            pass
+
+        edges = [(self.index[frm], self.index[to], sign * log(rate))
+                 for frm in self.currencies
+                 for to, rate in self._neighbours[frm]]
+
+        neighbours = [[] for i in range(len(self.currencies))]
+        for i, j, weight in edges:
+            neighbours[i].append((j, weight))
+
+        self._weighted[sign] = (edges, neighbours)
+        return self._weighted[sign]
+
+
+    def _components(self, neighbours):
+        """Number the strongly connected components of the rates graph, by Tarjan's algorithm.
+
+        Returns:
+            A list of the component number of each currency.
+        """
+
+        size = len(neighbours)
+        component = [None] * size
+        order = [None] * size
+        low = [None] * size
+        stack = []
+        visited = 0
+        count = 0
+
+        for root in range(size):
+            if order[root] is not None:
+                continue
+
+            order[root] = low[root] = visited
+            visited += 1
+            stack.append(root)
+            work = [(root, iter(neighbours[root]))]
+
+            while work:
+                (i, edges) = work[-1]
+                for j, weight in edges:
+                    if order[j] is None:
+                        order[j] = low[j] = visited
+                        visited += 1
+                        stack.append(j)
+                        work.append((j, iter(neighbours[j])))
+                        break
+                    if component[j] is None:
+                        # j is on the stack, in the component being built:
+                        low[i] = min(low[i], order[j])
+                else:
+                    work.pop()
+                    if work:
+                        low[work[-1][0]] = min(low[work[-1][0]], low[i])
+
+                    if low[i] == order[i]:
+                        while True:
+                            j = stack.pop()
+                            component[j] = count
+                            if j == i:
+                                break
+                        count += 1
+
+        return component
+
+
+    def _unboundedSources(self):
+        """Find the currencies from which a cycle making the policy's product unbounded is reachable.
+
+        Those cycles are the negative cycles of the graph weighted for the policy, and each lies
+        within a strongly connected component. A single Bellman-Ford search from every currency
+        at once, over the rates within the components, leaves a rate on every negative cycle that
+        can still improve a currency on it. The currencies that can reach one of those are the
+        ones whose paths are chosen among simple paths.
+
+        Returns:
+            The set of the indexes of those currencies, found once until the rates change.
+        """
+
+        if self._unbounded is not None:
+            return self._unbounded
+
+        size = len(self.currencies)
+        (edges, neighbours) = self._weightedEdges(-1 if self.policy == 'best' else 1)
+        component = self._components(neighbours)
+        inner = [edge for edge in edges if component[edge[0]] == component[edge[1]]]
+
+        dist = [0.0] * size
+        unbounded = set()
+
+        if self._bellmanFord(inner, dist, [None] * size) is not None:
+            stack = [j for i, j, weight in inner if dist[i] + weight < dist[j] - EPSILON]
+            unbounded.update(stack)
+
+            predecessors = [[] for i in range(size)]
+            for i, j, weight in edges:
+                predecessors[j].append(i)
+
+            while stack:
+                for i in predecessors[stack.pop()]:
+                    if i not in unbounded:
+                        unbounded.add(i)
+                        stack.append(i)
+
+        self._unbounded = unbounded
+        return unbounded
+
+
+    def _bellmanFord(self, edges, dist, parents):
+        """Relax the edges until nothing changes, at most once per currency.
+
+        Returns:
+            The index of a currency that was still being improved after as many rounds as there
+            are currencies, which means it's reachable from a negative cycle, or None.
+        """
+
+        for n in range(len(self.currencies)):
+            improved = None
+            for i, j, weight in edges:
+                if dist[i] is not None and (dist[j] is None or dist[i] + weight < dist[j] - EPSILON):
+                    dist[j] = dist[i] + weight
+                    parents[j] = i
+                    improved = j
+
+            if improved is None:
+                return None
+
+        return improved
+
+
+    def _searchProducts(self, start):
+        """Search for the paths with the best or worst product of rates from one currency."""
+
+        size = len(self.currencies)
+        (edges, neighbours) = self._weightedEdges(-1 if self.policy == 'best' else 1)
+        if start in self._unboundedSources():
+            return self._searchSimplePaths(start, neighbours)
+
+        dist = [None] * size
+        parents = [None] * size
+        dist[start] = 0.0
+
+        if self._bellmanFord(edges, dist, parents) is not None:
+            # A cycle too close to a product of 1 to be told apart from every currency at once:
+            return self._searchSimplePaths(start, neighbours)
+
+        paths = [None] * size
+        paths[start] = (start,)
+        for j in range(size):
+            if dist[j] is not None and paths[j] is None:
+                path = [j]
+                while path[-1] != start:
+                    path.append(parents[path[-1]])
+                paths[j] = tuple(reversed(path))
+
+        return paths
+
+
+    def _searchSimplePaths(self, start, neighbours):
+        """Search the simple paths from one currency, one hop at a time, for the lowest weight."""
+
+        size = len(self.currencies)
+        links = [None] * size
+        weights = [None] * size
+        links[start] = (start, None)
+        weights[start] = 0.0
+
+        # The best path found to each currency with the current number of hops, with its
+        # weight and a bit mask of the currencies on it. Paths are kept as (currency, link to
+        # the path before it), so extending one doesn't copy it:
+        layer = {start: (links[start], 0.0, 1 << start)}
+        while layer:
+            extended = {}
+            for i in sorted(layer):
+                (link, weight, visited) = layer[i]
+
+                for j, edgeWeight in neighbours[i]:
+                    if visited >> j & 1:
+                        continue
+
+                    if j not in extended or weight + edgeWeight < extended[j][1] - EPSILON:
+                        extended[j] = ((j, link), weight + edgeWeight, visited | 1 << j)
+
+            for j, (link, weight, visited) in extended.items():
+                if weights[j] is None or weight < weights[j] - EPSILON:
+                    links[j] = link
+                    weights[j] = weight
+
+            layer = extended
+
+        paths = [None] * size
+        for j, link in enumerate(links):
+            if link is not None:
+                path = []
+                while link is not None:
+                    (k, link) = link
+                    path.append(k)
+                paths[j] = tuple(reversed(path))
+
+        return paths
+
+
+    def arbitrage(self):
+        """Find arbitrage: cycles of rates that multiply to more than 1.
+
+        A Bellman-Ford search over the graph weighted by -log(rate), started from every currency
+        at once, finds negative cycles, which are the arbitrage cycles. Once a cycle is found,
+        its rates are left out and the search is run again, so cycles sharing a rate with one
+        already found aren't listed.
+
+        Returns:
+            A sorted list of cycles, each a tuple of currencies starting with the lowest; empty
+            if and only if there is no arbitrage.
+        """
+
+        size = len(self.currencies)
+        dist = [0.0] * size
+        parents = [None] * size
+        edges = self._weightedEdges(-1)[0]
+
+        cycles = set()
+        improved = self._bellmanFord(edges, dist, parents)
+        while improved is not None:
+            # Walk back far enough to be on the cycle, then around it:
+            k = improved
+            for n in range(size):
+                k = parents[k]
+
+            cycle = [k]
+            while parents[cycle[-1]] != k:
+                cycle.append(parents[cycle[-1]])
+            cycle.reverse()
+            cycleEdges = set(zip(cycle, cycle[1:] + cycle[:1]))
+
+            product = Decimal(1)
+            for i, j in cycleEdges:
+                product *= self._edgeRate(self.currencies[i], self.currencies[j])
+            if product > 1:
+                first = cycle.index(min(cycle))
+                cycles.add(tuple(self.currencies[i] for i in cycle[first:] + cycle[:first]))
+
+            # Look for other cycles, with this one's rates left out:
+            edges = [edge for edge in edges if edge[:2] not in cycleEdges]
+            dist = [0.0] * size
+            parents = [None] * size
+            improved = self._bellmanFord(edges, dist, parents)
+
+        return sorted(cycles)
+
+
+    def takeStats(self):
+        """Return the search counters and reset them.
+
+        Returns:
+            A dictionary of searches, nodesVisited and searchDepth.
+        """
+
+        stats = {'searches': self.searches, 'nodesVisited': self.nodesVisited,
+                 'searchDepth': self.searchDepth}
+        self.searches = self.nodesVisited = self.searchDepth = 0
+
+        return stats
+
+
+    def rate(self, frm, to):
+        """Look up a conversion rate.
+
+        Args:
+            frm (str): Currency that needs to be converted.
+            to (str): Desired output currency.
+
+        Returns:
+            The conversion rate or None if there is no conversion.
+        """
+
+        try:
+            i = self.index[frm]
+            j = self.index[to]
+        except KeyError:
+            return Decimal(1) if frm == to else None
+
+        if self._staleRows or self._stalePairs:
+            self._refresh(i, j)
+
+        return self.matrix[i][j]
+
+
+    def path(self, frm, to):
+        """Look up the path chosen for a conversion.
+
+        Args:
+            frm (str): Currency that needs to be converted.
+            to (str): Desired output currency.
+
+        Returns:
+            The list of currencies on the path, from frm to to, or None if there is no
+            conversion.
+        """
+
+        try:
+            i = self.index[frm]
+            j = self.index[to]
+        except KeyError:
+            return [frm] if frm == to else None
+
+        if self._staleRows or self._stalePairs:
+            self._refresh(i, j)
+
+        path = self.paths[i][j]
+        return None if path is None else [self.currencies[k] for k in path]
+
+
+    def isStale(self, frm, to):
+        """Returns: Whether a change of rates invalidated a conversion since it was looked up."""
+
+        try:
+            i = self.index[frm]
+            j = self.index[to]
+        except KeyError:
+            return False
+
+        return i in self._staleRows or (i, j) in self._stalePairs
+
+
+    def unreachable(self):
+        """List the pairs of currencies that can't be converted.
+
+        Returns:
+            A sorted list of ('from', 'to') tuples.
+        """
+
+        return sorted((frm, to)
+                      for frm in self.currencies
+                      for to in self.currencies
+                      if self.rate(frm, to) is None)
+
+
+    def updateRate(self, frm, to, rate):
+        """Change or add a known conversion rate.
+
+        Args:
+            frm (str): Currency converted from.
+            to (str): Currency converted to.
+            rate (Decimal): New conversion rate.
+
+        """
+
+        if frm == to:
+            return
+
+        for currency in (frm, to):
+            if currency not in self.index:
+                self._addCurrency(currency)
+
+        self._weighted = {}
+        self._unbounded = None
+
+        edges = self._neighbours[frm]
+        for k, (edgeTo, edgeRate) in enumerate(edges):
+            if edgeTo == to:
+                edges[k] = (to, rate)
+                if self.policy == 'hops':
+                    self._invalidatePaths(self.index[frm], self.index[to])
+                else:
+                    self._invalidateReaching(self.index[frm])
+                return
+
+        insort(edges, (to, rate))
+        self._invalidateSearches(self.index[frm], self.index[to], added=True)
+
+
+    def removeRate(self, frm, to):
+        """Remove a known conversion rate.
+
+        Args:
+            frm (str): Currency converted from.
+            to (str): Currency converted to.
+
+        """
+
+        edges = self._neighbours.get(frm, [])
+        for k, (edgeTo, edgeRate) in enumerate(edges):
+            if edgeTo == to:
+                del edges[k]
+                self._weighted = {}
+                self._unbounded = None
+                self._invalidateSearches(self.index[frm], self.index[to], added=False)
+                return
+
+
+    def _addCurrency(self, currency):
+        size = len(self.currencies)
+
+        self.index[currency] = size
+        self.currencies.append(currency)
+
+        for rows in (self.matrix, self.parents, self.hops, self.paths):
+            for row in rows:
+                row.append(None)
+            rows.append([None] * (size + 1))
+
+        self.matrix[size][size] = Decimal(1)
+        self.hops[size][size] = 0
+        self.paths[size][size] = (size,)
+
+
+    def _invalidatePaths(self, a, b):
+        """Mark the pairs whose path goes through the rate from currency a to currency b."""
+
+        for i in range(len(self.currencies)):
+            if i in self._staleRows or self.parents[i][b] != a:
+                continue
+
+            # Every currency reached through b uses the rate:
+            for j in range(len(self.currencies)):
+                k = j
+                while k is not None and k != b:
+                    k = self.parents[i][k]
+                if k == b:
+                    self._stalePairs.add((i, j))
+
+
+    def _invalidateReaching(self, a):
+        """Mark the searches that a changed, added or removed rate from currency a can change.
+
+        Only the searches from the currencies that can reach a can go through a rate from a, or
+        find a cycle through it.
+        """
+
+        for i in range(len(self.currencies)):
+            if self.hops[i][a] is not None:
+                self._staleRows.add(i)
+
+
+    def _invalidateSearches(self, a, b, added):
+        """Mark the searches that an added or removed rate from currency a to b can change."""
+
+        if self.policy != 'hops':
+            self._invalidateReaching(a)
+            return
+
+        for i in range(len(self.currencies)):
+            if i in self._staleRows:
+                continue
+
+            if added:
+                # The new rate matters if b isn't reached before a's neighbours are visited:
+                changed = self.hops[i][a] is not None and \
+                    (self.hops[i][b] is None or self.hops[i][a] + 1 <= self.hops[i][b])
+            else:
+                changed = self.parents[i][b] == a
+
+            if changed:
+                self._staleRows.add(i)
+
+
+    def _refresh(self, i, j):
+        """Recompute the rate from currency i to currency j if it's stale."""
+
+        if i in self._staleRows:
+            (self.matrix[i], self.parents[i], self.hops[i], self.paths[i]) = \
+                self._search(self.currencies[i])
+            self._staleRows.discard(i)
+            self._stalePairs = set(pair for pair in self._stalePairs if pair[0] != i)
+            return
+
+        if (i, j) not in self._stalePairs:
+            return
+
+        # Walk back to the nearest currency with a fresh rate, then multiply forwards:
+        path = []
+        k = j
+        while (i, k) in self._stalePairs:
+            path.append(k)
+            k = self.parents[i][k]
+
+        for k in reversed(path):
+            parent = self.parents[i][k]
+            self.matrix[i][k] = self.matrix[i][parent] * \
+                self._edgeRate(self.currencies[parent], self.currencies[k])
+            self._stalePairs.discard((i, k))
+
+
+    def _edgeRate(self, frm, to):
+        for edgeTo, rate in self._neighbours[frm]:
+            if edgeTo == to:
+                return rate
@@ -0,0 +1,128 @@
+from bisect import bisect_left, bisect_right
+
+from rateclosure import RateClosure
+
+
+class RateHistory():
+    """Dated snapshots of the known conversion rates.
+
+    Each snapshot holds the rates in effect from its date until the next snapshot's date. The
+    dates are kept sorted, so the rates in effect at any date are found by binary search. Dates
+    are ISO 8601 strings, such as '2014-01-27' or '2014-01-27T09:30:00', which sort in time
+    order; a snapshot dated '2014-01-27' applies to the timestamps of that whole day.
+
+    Snapshots are stored compactly: a snapshot with the same rates as a neighbouring one shares
+    its rates dictionary and RateClosure, and rates that don't change between snapshots share the
+    same Decimal objects. Every date is kept, so replacing one snapshot never changes the rates
+    in effect at another's date. The RateClosure of each snapshot is only built when it's first
+    used.
+
+    Attributes:
+        policy (str): How the closures choose conversion paths: 'hops', 'best' or 'worst'.
+        dates (list of str): Sorted dates from which each snapshot is in effect.
+        snapshots (list of dict of Decimal): Conversion rates of each snapshot, keyed by
+                                             ('from', 'to').
+
+    """
+
+    def __init__(self, policy='hops'):
+        """Inits an empty RateHistory.
+
+        Args:
+            policy (opt str): How the closures choose conversion paths.
+
+        """
+
+        self.policy = policy
+        self.dates = []
+        self.snapshots = []
+
+        self._closures = []
+        self._values = {}
+
+
+    def __len__(self):
+        return len(self.dates)
+
+
+    def add(self, date, rates, closure=None):
+        """Add the rates in effect from a date, replacing any snapshot with the same date.
+
+        Args:
+            date (str): ISO 8601 date from which the rates are in effect.
+            rates (dict of Decimal): Conversion rates, keyed by ('from', 'to').
+            closure (opt RateClosure): The rates' closure, if it's already built.
+
+        """
+
+        # Share the rates that are the same as in other snapshots:
+        rates = dict((pair, self._values.setdefault((pair, rate), rate))
+                     for pair, rate in rates.items())
+        if closure is not None and closure.policy != self.policy:
+            closure = None
+
+        i = bisect_left(self.dates, date)
+        if i == len(self.dates) or self.dates[i] != date:
+            self.dates.insert(i, date)
+            self.snapshots.insert(i, None)
+            self._closures.insert(i, None)
+
+        # Share the rates and closure of neighbours with the same rates:
+        for j in (i - 1, i + 1):
+            if 0 <= j < len(self.dates) and self.snapshots[j] == rates:
+                rates = self.snapshots[j]
+                closure = closure or self._closures[j]
+
+        self.snapshots[i] = rates
+        self._closures[i] = closure
+
+
+    def snapshotAt(self, date):
+        """Find the snapshot in effect at a date.
+
+        Returns:
+            The index of the snapshot, or None if the date is before the first snapshot.
+        """
+
+        i = bisect_right(self.dates, date) - 1
+        return i if i >= 0 else None
+
+
+    def closure(self, snapshot):
+        """Returns: The RateClosure of a snapshot, built on first use."""
+
+        if self._closures[snapshot] is None:
+            rates = self.snapshots[snapshot]
+
+            # Snapshots sharing the rates share the closure:
+            first = last = snapshot
+            while first > 0 and self.snapshots[first - 1] is rates:
+                first -= 1
+            while last + 1 < len(self.snapshots) and self.snapshots[last + 1] is rates:
+                last += 1
+
+            closure = next((c for c in self._closures[first:last + 1] if c is not None), None)
+            if closure is None:
+                closure = RateClosure(rates, self.policy)
+            self._closures[first:last + 1] = [closure] * (last + 1 - first)
+
+        return self._closures[snapshot]
+
+
+    def rate(self, frm, to, date):
+        """Look up the conversion rate in effect at a date.
+
+        Args:
+            frm (str): Currency that needs to be converted.
+            to (str): Desired output currency.
+            date (str): ISO 8601 date or timestamp.
+
+        Returns:
+            The conversion rate or None if there is no conversion, or no rates, at that date.
+        """
+
+        snapshot = self.snapshotAt(date)
+        if snapshot is None:
+            return None
+
+        return self.closure(snapshot).rate(frm, to)
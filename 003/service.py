@@ -0,0 +1,209 @@
+"""Long-running tally service.
+
+Keeps the rates, and optionally the transactions, in memory and answers HTTP queries such as
+
+    GET /total?sku=DM1182&currency=USD
+
+with {"sku": "DM1182", "currency": "USD", "total": "59482.47"}. Queries arriving together are
+answered together, from a single scan of the transactions file.
+
+    python service.py --rates data/RATES.xml --trans data/TRANS.csv --port 8080 --in-memory
+"""
+
+from argparse import ArgumentParser
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from collections import defaultdict
+from decimal import Decimal
+import json
+import threading
+import time
+import urlparse
+
+from main import InternationalTrade
+
+
+class TallyService():
+    """Answers tally queries in batches.
+
+    Queries are queued, and a worker thread answers everything queued within a short window of
+    the first query together. Each batch costs one scan of the file, or one pass over the
+    in-memory transactions, however many SKUs and target currencies were asked about.
+
+    Attributes:
+        trade (InternationalTrade): Holds the conversion rates.
+        transFile (str): A path to the transactions file.
+        columns (TransactionColumns): In-memory copy of the transactions, or None.
+        window (float): Seconds to wait for more queries after the first of a batch.
+
+    """
+
+    def __init__(self, trade, transFile, inMemory=False, window=0.01):
+        """Inits TallyService and starts its worker thread.
+
+        Args:
+            trade (InternationalTrade): Holds the conversion rates.
+            transFile (str): A path to the transactions file.
+            inMemory (opt bool): Whether to keep a columnar copy of the transactions in memory.
+            window (opt float): Seconds to wait for more queries after the first of a batch.
+
+        """
+
+        self.trade = trade
+        self.transFile = transFile
+        self.columns = trade.getColumns(transFile) if inMemory else None
+        self.window = window
+
+        self._queue = []
+        self._ready = threading.Condition()
+
+        worker = threading.Thread(target=self._run)
+        worker.daemon = True
+        worker.start()
+
+
+    def total(self, item, toCurrency):
+        """Computes a tally of items sold, batched with any other queries arriving meanwhile.
+
+        Args:
+            item (str): The SKU of the desired item.
+            toCurrency (str): The currency in which to calculate the total.
+
+        Returns:
+            The total amount of the items sold expressed in the desired currency.
+
+        Raises:
+            ValueError: The tally failed, e.g. a transaction's currency can't be converted.
+        """
+
+        query = {'item': item, 'currency': toCurrency, 'done': threading.Event()}
+
+        with self._ready:
+            self._queue.append(query)
+            self._ready.notify()
+
+        query['done'].wait()
+
+        if 'error' in query:
+            raise ValueError(query['error'])
+
+        return query['total']
+
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while not self._queue:
+                    self._ready.wait()
+
+            time.sleep(self.window)
+
+            with self._ready:
+                (batch, self._queue) = (self._queue, [])
+
+            self._answer(batch)
+
+
+    def _answer(self, batch):
+        """Answer a batch of queries, with one pass for all the target currencies if possible."""
+
+        byCurrency = defaultdict(list)
+        for query in batch:
+            byCurrency[query['currency']].append(query)
+
+        items = sorted(set(query['item'] for query in batch))
+
+        allTotals = {}
+        if self.columns is not None or len(byCurrency) > 1:
+            try:
+                allTotals = self._tallyAll(sorted(byCurrency), items)
+            except (SystemExit, Exception):
+                # Tally each currency on its own, so only the failing ones get an error:
+                pass
+
+        for toCurrency, queries in byCurrency.items():
+            try:
+                if toCurrency in allTotals:
+                    totals = allTotals[toCurrency]
+                else:
+                    totals = self._tallyAll([toCurrency], items)[toCurrency]
+
+                for query in queries:
+                    query['total'] = totals.get((query['item'],), Decimal("0.00"))
+
+            except (SystemExit, Exception) as e:
+                for query in queries:
+                    query['error'] = "Unable to tally %s in %s (%r)" % (query['item'],
+                                                                        toCurrency, e)
+
+            for query in queries:
+                query['done'].set()
+
+
+    def _tallyAll(self, toCurrencies, items):
+        """Tally the items in the target currencies, from the in-memory transactions if kept."""
+
+        if self.columns is not None:
+            return self.trade.tallyAllColumns(self.columns, toCurrencies, items=items)
+
+        return self.trade.tallyAllCurrencies(self.transFile, toCurrencies)
+
+
+class TallyRequestHandler(BaseHTTPRequestHandler):
+    """Handles GET /total?sku=...&currency=... requests for the server's TallyService."""
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+
+        if url.path != '/total' or 'sku' not in params:
+            return self._reply(404, {'error': "Use /total?sku=<sku>&currency=<currency>"})
+
+        currency = params.get('currency', 'USD')
+        try:
+            total = self.server.service.total(params['sku'], currency)
+        except ValueError as e:
+            return self._reply(500, {'error': str(e)})
+
+        self._reply(200, {'sku': params['sku'], 'currency': currency, 'total': str(total)})
+
+
+    def _reply(self, status, body):
+        content = json.dumps(body)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TallyServer(ThreadingMixIn, HTTPServer):
+    """HTTP server answering each request in its own thread, so requests can be batched."""
+
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        HTTPServer.__init__(self, address, TallyRequestHandler)
+        self.service = service
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Serve tally queries over HTTP on localhost.")
+    parser.add_argument('--rates', default='data/RATES.xml')
+    parser.add_argument('--trans', default='data/TRANS.csv')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--in-memory', action='store_true',
+                        help="keep a columnar copy of the transactions in memory")
+    args = parser.parse_args()
+
+    it = InternationalTrade()
+    it.getRates(args.rates, findMissing=True)
+
+    server = TallyServer(('127.0.0.1', args.port), TallyService(it, args.trans, args.in_memory))
+    print "Serving tallies on http://127.0.0.1:%d/total" % server.server_address[1]
+    server.serve_forever()
@@ -0,0 +1,116 @@
+from array import array
+from collections import defaultdict
+from csv import Error, reader
+import cPickle as pickle
+import os
+import struct
+
+
+MAGIC = 'SKUIDX1\n'
+
+
+def indexPath(transFile):
+    return transFile + '.idx'
+
+
+def buildSkuIndex(transFile):
+    """Write a sidecar index of the rows of each SKU next to a transactions file.
+
+    The index holds the byte offset of every row, grouped by SKU, along with the size and
+    modification time of the transactions file, so a stale index is never used. It's laid out
+    as:
+        - MAGIC
+        - the length of the header, as a little-endian unsigned 64 bit integer
+        - the pickled header: the file's size and mtime, the array typecode of the offsets and,
+          for each SKU, the position of its first offset and its number of offsets
+        - the offsets, SKU after SKU
+    so a query only reads the header and the offsets of the SKU it's about.
+
+    Rows are split as TransactionSource splits them, with or without a date, so every row a
+    scan would tally is indexed; rows it would skip may be indexed too, and are skipped when
+    they're parsed.
+
+    Args:
+        transFile (str): A path to the transactions file.
+
+    Returns:
+        The path of the index file.
+    """
+
+    stat = os.stat(transFile)
+    offsets = defaultdict(lambda: array('L'))
+
+    with open(transFile, 'rb') as f:
+        # The header row, if there is one, is indexed too; it's skipped when it's parsed:
+        pos = 0
+
+        for line in f:
+            if '"' in line:
+                try:
+                    fields = next(reader([line]), [])
+                except Error:
+                    # A NUL byte or an unterminated quote; the row can't be parsed:
+                    fields = []
+            else:
+                fields = line.split(',', 2)
+
+            if len(fields) in (3, 4):
+                offsets[fields[1]].append(pos)
+
+            pos += len(line)
+
+    skus = {}
+    first = 0
+    for sku in sorted(offsets):
+        skus[sku] = (first, len(offsets[sku]))
+        first += len(offsets[sku])
+
+    header = pickle.dumps({'size': stat.st_size, 'mtime': stat.st_mtime, 'typecode': 'L',
+                           'skus': skus}, pickle.HIGHEST_PROTOCOL)
+
+    path = indexPath(transFile)
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for sku in sorted(offsets):
+            offsets[sku].tofile(f)
+
+    return path
+
+
+def skuOffsets(transFile, item):
+    """Read the offsets of an item's rows from a transactions file's sidecar index.
+
+    Args:
+        transFile (str): A path to the transactions file.
+        item (str): The SKU of the desired item.
+
+    Returns:
+        An array of the byte offsets of the item's rows, or None if there's no index for the
+        file or the file has changed since it was indexed.
+    """
+
+    try:
+        f = open(indexPath(transFile), 'rb')
+    except IOError:
+        return None
+
+    with f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return None
+
+        (length,) = struct.unpack('<Q', f.read(8))
+        header = pickle.loads(f.read(length))
+
+        stat = os.stat(transFile)
+        if (header['size'], header['mtime']) != (stat.st_size, stat.st_mtime):
+            return None
+
+        offsets = array(header['typecode'])
+        if item in header['skus']:
+            (first, count) = header['skus'][item]
+            f.seek(first * offsets.itemsize, os.SEEK_CUR)
+            offsets.fromfile(f, count)
+
+        return offsets
@@ -0,0 +1,279 @@
+from csv import Error, reader
+import mmap
+import os
+
+
+class TransactionSource():
+    """Stream transactions from a CSV file with constant memory.
+
+    The file is read a chunk at a time and split into complete lines. Plain rows are split on
+    commas directly; only rows containing a quote go through the csv module, using one reader
+    for the whole file. Rows that can't be parsed, such as the header row, are skipped and
+    counted rather than raising exceptions.
+
+    The source can be limited to a range of bytes of the file. A row belongs to the range its
+    first byte is in, so the ranges [0, n) and [n, size) together yield every row exactly once.
+
+    The source can also be limited to one item. The file is then memory-mapped and searched for
+    the item's SKU, and only the rows it's found in are parsed. Rows for other items aren't
+    counted as parsed or skipped.
+
+    Finally, the source can be limited to the rows starting at given byte offsets, such as the
+    offsets of an item's rows in a SKU index (see skuindex). Only those rows are read.
+
+    Rows can have a fourth field, the transaction's date, which is only yielded if asked for.
+
+    Lines that were already read, e.g. by another thread, can be given instead of the file; only
+    they are parsed.
+
+    The skipped rows can be collected, with their line numbers, to report bad input. Lines are
+    numbered from 1 in the order the source reads them, which is the file's numbering when the
+    whole file is read. The line numbers are only worked out for batches that have bad rows, so
+    collecting them costs nothing while the input is good.
+
+    Attributes:
+        transFile (str): A path to the transactions file.
+        start (int): Offset of the first byte of the range to read.
+        end (int): Offset just past the range to read, or None to read to the end of the file.
+        chunkSize (int): Number of bytes to read at a time.
+        item (str): The SKU of the only item to read, or None for all items.
+        offsets (array of int): Byte offsets of the only rows to read, or None for all rows.
+        dates (bool): Whether to yield each row's date.
+        lines (list of str): Lines to parse instead of the file's, or None.
+        errors (list of tuple): (lineNumber, line) of each row skipped so far, or None if they
+                                aren't collected.
+
+        linesRead (int): Number of lines read so far.
+        rowsParsed (int): Number of rows yielded so far.
+        rowsSkipped (int): Number of rows skipped so far.
+
+    """
+
+    def __init__(self, transFile, start=0, end=None, chunkSize=1 << 20, item=None, offsets=None,
+                 dates=False, lines=None, errors=None):
+        """Inits TransactionSource for a file or a range of bytes in a file.
+
+        Args:
+            transFile (str): A path to the transactions file.
+            start (opt int): Offset of the first byte of the range to read.
+            end (opt int): Offset just past the range to read; None to read to the end.
+            chunkSize (opt int): Number of bytes to read at a time.
+            item (opt str): The SKU of the only item to read; None to read all items.
+            offsets (opt array of int): Byte offsets of the only rows to read; None to read all.
+            dates (opt bool): Whether to yield each row's date.
+            lines (opt list of str): Lines, without line endings, to parse instead of the file's.
+            errors (opt list): List to append (lineNumber, line) of each skipped row to.
+
+        """
+
+        self.transFile = transFile
+        self.start = start
+        self.end = end
+        self.chunkSize = chunkSize
+        self.item = item
+        self.offsets = offsets
+        self.dates = dates
+        self.lines = lines
+        self.errors = errors
+
+        self.linesRead = 0
+        self.rowsParsed = 0
+        self.rowsSkipped = 0
+
+
+    def __iter__(self):
+        """Iterate the transactions.
+
+        Yields:
+            A tuple of interned strings (store, sku, amt, currency), e.g.
+            ('Utica', 'DM1759', '84.16', 'CAD'). With dates, the tuple also has the row's date,
+            or None if it has none: ('Utica', 'DM1759', '84.16', 'CAD', '2014-01-27').
+
+        Raises:
+            IOError: Unable to open and read in transaction from the file.
+        """
+
+        item = self.item
+        dates = self.dates
+        feed = []
+        quoted = reader(iter(feed.pop, None))
+
+        if self.lines is not None:
+            batches = [self.lines]
+        elif self.offsets is not None:
+            batches = self.rows()
+        elif item:
+            batches = self.matches()
+        else:
+            batches = self.chunks()
+
+        for lines in batches:
+            skipped = []
+            other = 0
+
+            for line in lines:
+                if '"' in line:
+                    feed.append(line)
+                    try:
+                        fields = quoted.next()
+                    except (Error, IndexError):
+                        # An unterminated quote or a NUL byte; the reader can't go on:
+                        del feed[:]
+                        quoted = reader(iter(feed.pop, None))
+                        skipped.append(line)
+                        continue
+                else:
+                    fields = line.split(',')
+
+                date = None
+                try:
+                    (store, sku, amount) = fields
+                except ValueError:
+                    if len(fields) != 4:
+                        skipped.append(line)
+                        continue
+                    (store, sku, amount, date) = fields
+
+                (amt, space, currency) = amount.partition(' ')
+                if not (amt and currency) or ' ' in currency:
+                    parts = amount.split()
+                    if len(parts) != 2:
+                        # Ignore header row and other bad input lines
+                        skipped.append(line)
+                        continue
+                    (amt, currency) = parts
+
+                if item and sku != item:
+                    # The SKU was found elsewhere in the row:
+                    other += 1
+                    continue
+
+                if dates:
+                    yield (intern(store), intern(sku), amt, intern(currency), date and intern(date))
+                else:
+                    yield (intern(store), intern(sku), amt, intern(currency))
+
+            self.rowsParsed += len(lines) - len(skipped) - other
+            self.rowsSkipped += len(skipped)
+            if skipped and self.errors is not None:
+                self.recordErrors(lines, skipped)
+            self.linesRead += len(lines)
+
+
+    def recordErrors(self, lines, skipped):
+        """Append the line numbers and skipped lines of a batch to errors.
+
+        Args:
+            lines (list of str): The batch of lines, which start after linesRead lines.
+            skipped (list of str): The skipped lines, in order; the same objects as in lines.
+
+        """
+
+        skipped = iter(skipped)
+        line = next(skipped)
+
+        for i, candidate in enumerate(lines):
+            if candidate is line:
+                self.errors.append((self.linesRead + i + 1, line))
+                line = next(skipped, None)
+                if line is None:
+                    break
+
+
+    def chunks(self):
+        """Read the range a chunk at a time.
+
+        Yields:
+            Lists of the complete lines, without line endings, in each chunk.
+        """
+
+        with open(self.transFile, 'rb') as f:
+            pos = self.start
+            if pos:
+                # Skip the end of a row that belongs to the previous range:
+                f.seek(pos - 1)
+                pos += len(f.readline()) - 1
+
+            pending = ''
+            while self.end is None or pos < self.end:
+                chunk = f.read(self.chunkSize)
+                if not chunk:
+                    if pending:
+                        yield [pending]
+                    return
+
+                data = pending + chunk
+                cut = data.rfind('\n') + 1
+
+                if self.end is not None and pos + cut > self.end:
+                    # Stop after the row that the range ends in:
+                    yield data[:data.find('\n', self.end - pos - 1) + 1].splitlines()
+                    return
+
+                pending = data[cut:]
+                if cut:
+                    yield data[:cut].splitlines()
+                    pos += cut
+
+
+    def matches(self, batchSize=1024):
+        """Search the memory-mapped range for lines containing the item's SKU.
+
+        Yields:
+            Lists of up to batchSize lines, without line endings.
+        """
+
+        with open(self.transFile, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return
+
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                end = size if self.end is None else min(self.end, size)
+                lines = []
+
+                hit = mapped.find(self.item, self.start)
+                while hit >= 0:
+                    lineStart = mapped.rfind('\n', 0, hit) + 1
+                    if lineStart >= end:
+                        break
+
+                    lineEnd = mapped.find('\n', hit)
+                    if lineEnd < 0:
+                        lineEnd = size
+
+                    # Rows starting before the range belong to the previous range:
+                    if lineStart >= self.start:
+                        lines.append(mapped[lineStart:lineEnd].rstrip('\r'))
+                        if len(lines) == batchSize:
+                            yield lines
+                            lines = []
+
+                    hit = mapped.find(self.item, lineEnd)
+
+                if lines:
+                    yield lines
+
+            finally:
+                mapped.close()
+
+
+    def rows(self, batchSize=1024):
+        """Read the rows starting at the source's offsets.
+
+        Yields:
+            Lists of up to batchSize lines, without line endings.
+        """
+
+        with open(self.transFile, 'rb') as f:
+            lines = []
+            for offset in self.offsets:
+                f.seek(offset)
+                lines.append(f.readline().rstrip('\r\n'))
+                if len(lines) == batchSize:
+                    yield lines
+                    lines = []
+
+            if lines:
+                yield lines
@@ -0,0 +1,121 @@
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
+
+from transsource import TransactionSource
+
+
+HEADER = ('store', 'sku', 'amount')
+# The header of a file whose rows have dates (see TransactionSource):
+DATED_HEADER = HEADER + ('date',)
+
+
+class ValidationReport():
+    """Problems found in a transactions file by a single validation pass.
+
+    Attributes:
+        rowsParsed (int): Number of transactions read.
+        badRows (list of tuple): (lineNumber, line) of each row that can't be tallied: rows that
+                                 can't be parsed and rows whose amount isn't a number. The
+                                 header row, with or without a date column, isn't counted.
+        missing (dict of int): Number of transactions that can't be converted, keyed by
+                               ('from', 'to') currency pair.
+
+    """
+
+    def __init__(self):
+        """Inits an empty ValidationReport."""
+
+        self.rowsParsed = 0
+        self.badRows = []
+        self.missing = defaultdict(int)
+
+
+    def ok(self):
+        """Returns: Whether the transactions can all be tallied."""
+
+        return not (self.badRows or self.missing)
+
+
+    def lines(self):
+        """Describe the problems, e.g. for printing.
+
+        Returns:
+            A list of strings, one per bad row and per missing conversion.
+        """
+
+        return (["line %d: bad row %r" % (lineNumber, line) for lineNumber, line in self.badRows] +
+                ["No conversion found for %s-->%s (%d transactions)" % (frm, to, n)
+                 for (frm, to), n in sorted(self.missing.items())])
+
+
+def validateTransactions(transFile, toCurrencies, rate):
+    """Check that every transaction in a file can be tallied, collecting all the problems.
+
+    The file is read once with the same parser as the tallies, collecting the rows it skips.
+    Amounts that aren't numbers are rare, so their rows are only located, by reading the file a
+    second time, if there are any.
+
+    Args:
+        transFile (str): A path to the transactions file.
+        toCurrencies (list of str): The currencies the transactions would be tallied in.
+        rate (callable): Called as rate(frm, to) to look up a conversion rate, or None if there
+                         is no conversion.
+
+    Returns:
+        A ValidationReport.
+
+    Raises:
+        IOError: Unable to open and read the transactions file.
+    """
+
+    report = ValidationReport()
+    errors = []
+    badAmounts = set()
+    rates = {}
+
+    source = TransactionSource(transFile, errors=errors)
+    for store, sku, amt, currency in source:
+        try:
+            currencyRates = rates[currency]
+        except KeyError:
+            currencyRates = rates[currency] = [(to, rate(currency, to)) for to in toCurrencies]
+
+        for to, currencyRate in currencyRates:
+            if currencyRate is None:
+                report.missing[(currency, to)] += 1
+
+        try:
+            Decimal(amt)
+        except InvalidOperation:
+            badAmounts.add(amt)
+
+    report.rowsParsed = source.rowsParsed
+    report.badRows = [(lineNumber, line) for lineNumber, line in errors
+                      if not (lineNumber == 1 and
+                              tuple(line.split(',')) in (HEADER, DATED_HEADER))]
+
+    if badAmounts:
+        report.badRows.extend(_locateAmounts(transFile, badAmounts))
+        report.badRows.sort()
+
+    return report
+
+
+def _locateAmounts(transFile, amounts):
+    """Find the rows of a file whose amount is one of the given strings.
+
+    Returns:
+        A list of (lineNumber, line) tuples.
+    """
+
+    found = []
+
+    with open(transFile, 'rb') as f:
+        for lineNumber, line in enumerate(f, 1):
+            line = line.rstrip('\r\n')
+            if any(amt in line for amt in amounts):
+                for row in TransactionSource(transFile, lines=[line]):
+                    if row[2] in amounts:
+                        found.append((lineNumber, line))
+
+    return found
@@ -5,15 +5,25 @@ Created on Jan 27, 2014
 '''
 
 import os
+import sys
 import csv
 import decimal
-import operator
-import itertools
-from bs4 import BeautifulSoup
-from collections import namedtuple
+from array import array
+from collections import namedtuple, Counter, deque
+# The other modules are imported by the functions needing them, so a short run starts quickly
 
 Transaction = namedtuple('Transaction', ['store', 'sku', 'amount','currency']) 
 Rate 				= namedtuple('rate', ['TO', 'FROM', 'EXCHANGE_RATE']) # caps, cause namedtuple has weird _ restrictions
+# inexact holds (store code, sku code, amount, currency code) of the rows whose amount has 
+# fractions of a cent, as in 003's columns, since their amounts don't fit in the cents column 
+Columns			= namedtuple('Columns', ['skus', 'cents', 'currencies', 'sku_names', 'currency_names', 
+																		 'stores', 'store_names', 'inexact'])
+
+COLUMNS_MAGIC = 'TRNCOL1\n'
+# name, array typecode, struct format and size in the file; a C long isn't 8 bytes everywhere, 
+# so columns whose typecode has another size are packed with struct instead 
+COLUMNS_LAYOUT = (('cents', 'l', 'q', 8), ('skus', 'I', 'I', 4), ('stores', 'I', 'I', 4), 
+									('currencies', 'H', 'H', 2))
 
 
 def load_csv(filename):
@@ -23,12 +33,69 @@ def load_csv(filename):
 		csvreader = csv.reader(f, delimiter=',')
 		return [x for x in csvreader][1:]
 	
+def stream_csv(filename, buffer_size=1 << 20):
+	''' 
+	streams the rows of a csv file from the examples dir, without the header row. 
+	Unlike load_csv, only one row is held in memory at a time. 
+	'''
+	_path = os.path.join('examples', filename)
+	with open(_path, 'rb', buffer_size) as f:
+		csvreader = csv.reader(f, delimiter=',')
+		next(csvreader, None)
+		for row in csvreader: 
+			yield row
+	
+def scan_csv(filename, sku):
+	''' 
+	Memory-maps a csv file from the examples dir and yields only the 
+	rows for one SKU. The file is searched for the SKU's bytes, so rows 
+	for other SKUs are never split or decoded. 
+	'''
+	import mmap
+	_path = os.path.join('examples', filename)
+	with open(_path, 'rb') as f:
+		if not os.fstat(f.fileno()).st_size: 
+			return
+		data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			hit = data.find(sku)
+			while hit >= 0:
+				start = data.rfind('\n', 0, hit) + 1
+				end = data.find('\n', hit)
+				if end < 0: 
+					end = data.size()
+				for row in csv.reader([data[start:end]]):
+					if row[1:2] == [sku]:
+						yield row
+				hit = data.find(sku, end)
+		finally:
+			data.close()
+	
 def load_xml(filename):
 	''' loads an xml file from the examples dir'''
+	from bs4 import BeautifulSoup 	# only needed here, and slow to import
 	_path = os.path.join('examples', filename)
 	with open(_path, 'rb') as f:
 		return BeautifulSoup(f.read())
 	
+def load_rates(filename):
+	''' 
+	Streams the rates in an xml file from the examples dir as Rates. 
+	Each <rate> is cleared from the tree once it has been read, so 
+	memory stays bounded however many rates the file holds. 
+	
+	Returns: 
+		generator of Rates, ready for build_rates_cache
+	'''
+	from xml.etree.cElementTree import iterparse
+	_path = os.path.join('examples', filename)
+	events = iterparse(_path, events=('start', 'end'))
+	_, root = next(events)
+	for event, elem in events:
+		if event == 'end' and elem.tag == 'rate':
+			yield Rate(elem.findtext('to'), elem.findtext('from'), float(elem.findtext('conversion')))
+			root.clear()
+	
 def xml_to_list(xml_rates):
 	''' Converts the input XML into a flat list '''
 	_to = lambda x: x.find('to').get_text()
@@ -75,58 +142,65 @@ def round_(n):
 	Returns: 
 		Rounded Decimal
 	'''
-	decimal.getcontext().rounding = decimal.ROUND_HALF_UP
 	return decimal.Decimal(n).quantize(
 																decimal.Decimal('.01'), 
 																rounding=decimal.ROUND_HALF_EVEN)
 	
-def my_terrible_search_function_helper(rates, _to, _from, prev_rate, p=[]):
+def build_rates_index(rates):
 	''' 
-	helper function for the rate search. It's exactly the same as 
-	its parent method, but stores all of its results in a list.   
+	Builds an adjacency index of the rates, so a search only has to 
+	look at the rates leaving each currency instead of all the rates. 
+	
+	Returns: 
+		dictionary of Rates lists, sorted by TO, keyed by FROM currency
 	'''
-	rates_with_TOs = [rate for rate in rates if rate.TO == _to and (prev_rate.TO != rate.FROM or rate.TO != prev_rate.FROM)]
-	for rate in rates_with_TOs: 
-		if rate.FROM != _from:
-			p.append(rate)
-			my_terrible_search_function_helper(rates, rate.FROM, _from, rate, p)
-			return p
-		else:
-			p.append(rate)
-			return p
+	index = {}
+	for rate in rates: 
+		index.setdefault(rate.FROM, []).append(rate)
+	for _rates in index.itervalues():
+		_rates.sort()
+	return index
 
-def my_terrible_search_function(rates, _to, _from):
+def rates_index(rates):
 	''' 
-	This is the best I could come up with after... 4... hours..
-	Inefficiently finds a conversion path between the FROM and TO 
-	currencies. 
-	
-	Algorithm: 
-		Find all RATES which have the same TO field as the target currency. 
-		For each rate in the found RATES, repeat the same search pattern, but 
-		using the rate's TO field. 
-		 
+	Returns the rates index, building it only if given the list of rates, 
+	so callers converting many transactions build it once, not per search. 
 	'''
-	rates_with_matching_to_fields = [rate for rate in rates if rate.TO == _to]
-	for rate in rates_with_matching_to_fields: 
-		output = []
-		if rate.FROM != _from:
-			output.append(rate)
-			output.extend(my_terrible_search_function_helper(rates, rate.FROM, _from, rate, []))
-			if _from in [rate.FROM for rate in output]:
-				return output
-			continue
-	return None
+	return rates if isinstance(rates, dict) else build_rates_index(rates)
 
+def find_conversions(index, _from):
+	''' 
+	Breadth first search for the conversions from one currency to every 
+	currency it can be converted to, using the fewest rates possible. 
+	Currencies are visited in sorted order, so the result is always the same. 
+	
+	Args: 
+		index	-> rates index built by build_rates_index
+		_from	-> Currency from which we're converting
+	Returns: 
+		dictionary of Float currency conversion values, keyed by target currency
+	'''
+	conversions = {_from: 1}
+	queue = deque([_from])
+	while queue: 
+		currency = queue.popleft()
+		for rate in index.get(currency, ()):
+			if rate.TO not in conversions: 
+				conversions[rate.TO] = conversions[currency] * rate.EXCHANGE_RATE
+				queue.append(rate.TO)
+	del conversions[_from]
+	return conversions
 
 def find_curreny_conversion(rates, _to, _from, cache):
 	''' 
 	Checks the cache for the currency conversion. If not 
-	found, it then searches the rates listing for a possible 
-	match.
+	found, it then searches the rates for a possible match, 
+	and caches every conversion from the _from currency found 
+	along the way, so each currency is only searched from once.
 	
 	Args: 
-		rates	-> list of all available currency rates
+		rates	-> list of all available currency rates, or the index 
+						 of them built by build_rates_index
 		_to 	-> target currency
 		_from	-> Currency from which we're converting
 		cache -> previously found conversions
@@ -138,42 +212,313 @@ def find_curreny_conversion(rates, _to, _from, cache):
 		return 1 	# multiplicative identity, not a status code
 	key = 'FROM_%s_TO_%s' % (_from,_to)
 	if key not in cache:
-		results = my_terrible_search_function(rates, _to, _from)
-		if not results:
-			return None
-		new_rate = reduce(operator.mul, 
-										[r.EXCHANGE_RATE for r in results])
-		cache[key] = new_rate 
+		for currency, conversion in find_conversions(rates_index(rates), _from).iteritems():
+			cache.setdefault('FROM_%s_TO_%s' % (_from, currency), conversion)
+		cache.setdefault(key, None)
 	return cache[key]
 	
-def calculate_grand_total(transactions, sku, rates, cache):
+def calculate_grand_total(transactions, sku, rates, cache, currency='USD'):
+	rates = rates_index(rates)
 	for transaction in transactions: 
 		if transaction.sku == sku: 
-			yield round_(transaction.amount * find_curreny_conversion(rates, 'USD', transaction.currency, cache))
+			yield round_(transaction.amount * find_curreny_conversion(rates, currency, transaction.currency, cache))
 
-def display_total(sku, total):
-	msg = 'Grand total for {sku}: {total}'
-	print msg.format(sku=sku, total=total)
-	
-if __name__ == '__main__':
-	transactions = format_transaction_details(load_csv('TRANS.csv'))
-	rates = xml_to_list(load_xml('RATES.xml'))
-	cache = build_rates_cache(rates)
-	target_sku = 'DM1182'
+def calculate_grand_totals(transactions, sku, rates, cache, currencies=('USD',)):
+	''' 
+	Grand totals of one SKU in several currencies, in one pass over the 
+	transactions. Every transaction is rounded once per currency, so each 
+	total is the same as sum(calculate_grand_total(...)) in that currency. 
 	
-	total = sum(calculate_grand_total(transactions, target_sku))
-	display_total(target_sku, total)
-			
+	Args: 
+		transactions	-> Transactions to total
+		sku 					-> target SKU
+		rates					-> list of all available currency rates
+		cache 				-> previously found conversions
+		currencies		-> target currencies, e.g. ('USD', 'EUR', 'CAD')
+	Returns: 
+		dictionary of Decimal grand totals, keyed by target currency
+	'''
+	rates = rates_index(rates)
+	totals = dict((currency, 0) for currency in currencies)
+	for transaction in transactions: 
+		if transaction.sku == sku: 
+			for currency in currencies: 
+				totals[currency] += round_(transaction.amount * 
+																	 find_curreny_conversion(rates, currency, transaction.currency, cache))
+	return totals
+
+def calculate_sku_totals(transactions, skus, rates, cache, currencies=('USD',)):
+	''' 
+	Grand totals of several SKUs in several currencies, in one pass over 
+	the transactions. Each total is the same as calculate_grand_totals' for 
+	that SKU. Transactions whose currency can't be converted are left out 
+	of the totals and reported instead. 
 	
+	Args: 
+		transactions	-> Transactions to total, e.g. streamed by stream_csv
+		skus					-> target SKUs
+		rates					-> list of all available currency rates
+		cache 				-> previously found conversions
+		currencies		-> target currencies, e.g. ('USD', 'EUR', 'CAD')
+	Returns: 
+		dictionary of dictionaries of Decimal grand totals, keyed by SKU then 
+		by target currency, and the set of (from, to) currencies with no conversion
+	'''
+	rates = rates_index(rates)
+	totals = dict((sku, dict((currency, 0) for currency in currencies)) for sku in skus)
+	missing = set()
+	for transaction in transactions: 
+		sku_totals = totals.get(transaction.sku)
+		if sku_totals is None: 
+			continue
+		for currency in currencies: 
+			conversion = find_curreny_conversion(rates, currency, transaction.currency, cache)
+			if conversion is None: 
+				missing.add((transaction.currency, currency))
+				continue
+			sku_totals[currency] += round_(transaction.amount * conversion)
+	return totals, missing
+
+def calculate_all_totals(transactions, rates, cache, by=('sku',)):
+	''' 
+	Grand totals for every group of transactions, in one pass over 
+	the transactions instead of one pass per SKU. 
 	
+	Args: 
+		transactions	-> Transactions to total
+		rates				-> list of all available currency rates
+		cache 			-> previously found conversions
+		by					-> Transaction fields to group by, e.g. ('sku', 'store')
+	Returns: 
+		dictionary of Decimal totals in USD, keyed by tuples of the 'by' fields
+	'''
+	import operator
+	rates = rates_index(rates)
+	key = operator.attrgetter(*by)
+	if len(by) == 1: 
+		_key, key = key, lambda transaction: (_key(transaction),)
+	totals = {}
+	for transaction in transactions: 
+		group = key(transaction)
+		totals[group] = totals.get(group, 0) + round_(transaction.amount * 
+										find_curreny_conversion(rates, 'USD', transaction.currency, cache))
+	return totals
+
+def to_columns(transactions):
+	''' 
+	Stores transactions column by column: amounts as integer cents, 
+	and SKUs, stores and currencies as integer codes into lists of names. 
+	Rows whose amount has fractions of a cent are kept aside in inexact, 
+	so the batch total still matches the row by row total to the cent. 
 	
+	Returns: 
+		Columns namedtuple
+	'''
+	columns = Columns(array('I'), array('l'), array('H'), [], [], array('I'), [], [])
+	sku_codes, currency_codes, store_codes = {}, {}, {}
+	for transaction in transactions: 
+		if transaction.sku not in sku_codes: 
+			sku_codes[transaction.sku] = len(columns.sku_names)
+			columns.sku_names.append(transaction.sku)
+		if transaction.currency not in currency_codes: 
+			currency_codes[transaction.currency] = len(columns.currency_names)
+			columns.currency_names.append(transaction.currency)
+		if transaction.store not in store_codes: 
+			store_codes[transaction.store] = len(columns.store_names)
+			columns.store_names.append(transaction.store)
+		cents = int(round(transaction.amount * 100))
+		if cents / 100.0 != transaction.amount: 
+			columns.inexact.append((store_codes[transaction.store], sku_codes[transaction.sku], 
+															repr(transaction.amount), currency_codes[transaction.currency]))
+			continue
+		columns.skus.append(sku_codes[transaction.sku])
+		columns.stores.append(store_codes[transaction.store])
+		columns.cents.append(cents)
+		columns.currencies.append(currency_codes[transaction.currency])
+	return columns
+
+def save_columns(columns, filename): 
+	''' 
+	Saves columns to a binary columnar file in the examples dir, so the 
+	CSV only has to be parsed once. The layout, shared with 003's columnfile, is: 
+	COLUMNS_MAGIC, the header length as a little-endian uint64, a JSON header 
+	of the row count, the names and the inexact rows (padded with spaces to a 
+	multiple of 8 bytes), then the little-endian columns in COLUMNS_LAYOUT order: 
+	int64 cents, uint32 SKU codes, uint32 store codes and uint16 currency codes. 
 	
+	Args: 
+		columns		-> Columns built by to_columns
+		filename	-> name of the file to write
+	'''
+	import json, struct
+	header = json.dumps({'rows': len(columns.cents), 'currencies': columns.currency_names, 
+											 'skus': columns.sku_names, 'stores': columns.store_names, 
+											 'inexact': columns.inexact})
+	header += ' ' * (-(len(COLUMNS_MAGIC) + 8 + len(header)) % 8)
+	_path = os.path.join('examples', filename)
+	with open(_path, 'wb') as f:
+		f.write(COLUMNS_MAGIC)
+		f.write(struct.pack('<Q', len(header)))
+		f.write(header)
+		for name, typecode, fmt, size in COLUMNS_LAYOUT: 
+			values = array(typecode, getattr(columns, name))
+			if values.itemsize != size: 
+				f.write(struct.pack('<%d%s' % (len(values), fmt), *values))
+				continue
+			if sys.byteorder == 'big': 
+				values.byteswap()
+			values.tofile(f)
+
+def load_columns(filename): 
+	''' 
+	Memory-maps a binary columnar file from the examples dir, written by 
+	save_columns or by 003's converter, and copies each column out of the 
+	map. No text is parsed, except for the amounts of the inexact rows. 
 	
+	Returns: 
+		Columns namedtuple
+	'''
+	import json, mmap, struct
+	_path = os.path.join('examples', filename)
+	with open(_path, 'rb') as f:
+		data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	try:
+		if data[:len(COLUMNS_MAGIC)] != COLUMNS_MAGIC: 
+			raise ValueError('%s is not a columnar transactions file' % filename)
+		offset = len(COLUMNS_MAGIC) + 8
+		(length,) = struct.unpack('<Q', data[offset - 8:offset])
+		header = json.loads(data[offset:offset + length])
+		offset += length
+		names = dict((key, [name.encode('utf-8') for name in header[key]]) 
+								 for key in ('currencies', 'skus', 'stores'))
+		inexact = [(store, sku, amount.encode('utf-8'), currency) 
+							 for store, sku, amount, currency in header.get('inexact', [])]
+		values = {}
+		for name, typecode, fmt, size in COLUMNS_LAYOUT: 
+			column = data[offset:offset + header['rows'] * size]
+			if array(typecode).itemsize != size: 
+				values[name] = array(typecode, struct.unpack('<%d%s' % (header['rows'], fmt), column))
+			else: 
+				values[name] = array(typecode, column)
+				if sys.byteorder == 'big': 
+					values[name].byteswap()
+			offset += header['rows'] * size
+	finally:
+		data.close()
+	return Columns(values['skus'], values['cents'], values['currencies'], names['skus'], 
+								 names['currencies'], values['stores'], names['stores'], inexact)
+
+def calculate_grand_total_batch(columns, sku, rates, cache):
+	''' 
+	Batch version of sum(calculate_grand_total(...)). 
+	Counts how often each (currency, amount) pair occurs for the SKU, 
+	vectorized when NumPy is installed (see count_amounts), then 
+	converts and rounds each distinct pair only once. The inexact rows, 
+	whose amounts have fractions of a cent, are converted one by one. 
 	
+	Args: 
+		columns	-> Columns built by to_columns
+		sku 		-> target SKU
+		rates		-> list of all available currency rates
+		cache 	-> previously found conversions
+	Returns: 
+		Decimal grand total in USD, the same to the cent as calculate_grand_total
+	'''
+	if sku not in columns.sku_names: 
+		return decimal.Decimal(0)
+	rates = rates_index(rates)
+	counts = count_amounts(columns, columns.sku_names.index(sku))
+	total = decimal.Decimal(0)
+	for (currency_code, cents), count in counts.iteritems():
+		currency = columns.currency_names[currency_code]
+		total += round_(cents / 100.0 * find_curreny_conversion(rates, 'USD', currency, cache)) * count
+	for store_code, sku_code, amount, currency_code in columns.inexact: 
+		if columns.sku_names[sku_code] == sku: 
+			currency = columns.currency_names[currency_code]
+			total += round_(float(amount) * find_curreny_conversion(rates, 'USD', currency, cache))
+	return total
+
+def count_amounts(columns, sku_code):
+	''' 
+	Counts how often each (currency code, cents) pair occurs among one 
+	SKU's rows. With NumPy installed, the columns are compared, sorted 
+	and counted as whole arrays; otherwise they're counted row by row. 
 	
+	Args: 
+		columns		-> Columns built by to_columns or load_columns
+		sku_code	-> code of the SKU in columns.sku_names
+	Returns: 
+		dictionary of counts, keyed by (currency code, cents)
+	'''
+	try: 
+		import numpy
+	except ImportError: 
+		import itertools
+		return Counter((currency_code, cents) for currency_code, cents, code in 
+									 itertools.izip(columns.currencies, columns.cents, columns.skus)
+									 if code == sku_code)
+	view = lambda values: numpy.frombuffer(values, dtype=values.typecode)
+	selected = view(columns.skus) == sku_code
+	pairs = numpy.column_stack((view(columns.currencies)[selected].astype(numpy.int64), 
+															view(columns.cents)[selected].astype(numpy.int64)))
+	if not len(pairs): 
+		return {}
+	pairs, counts = numpy.unique(pairs, axis=0, return_counts=True)
+	return dict(((currency_code, cents), count) for (currency_code, cents), count in 
+							zip(pairs.tolist(), counts.tolist()))
+
+def display_total(sku, total, currency=None):
+	msg = 'Grand total for {sku}: {total}' if currency is None else 'Grand total for {sku} in {currency}: {total}'
+	print msg.format(sku=sku, total=total, currency=currency)
+
+def main(argv=None): 
+	''' 
+	Command line entry point: prints the grand totals of SKUs in one 
+	or more currencies, e.g. 
+		python trade.py --sku DM1182 --currency USD,EUR --format json
+	Files are read from the examples dir. SKUs and currencies can be 
+	repeated or comma separated. 
 	
+	Args: 
+		argv	-> command line arguments, without the program name
+	Returns: 
+		exit status
+	'''
+	from argparse import ArgumentParser
+	parser = ArgumentParser(description='Grand totals of sales in one or more currencies.')
+	parser.add_argument('--rates', default='RATES.xml', help='rates xml file in the examples dir')
+	parser.add_argument('--trans', default='TRANS.csv', help='transactions csv file in the examples dir')
+	parser.add_argument('--sku', action='append', default=[], help='SKU(s) to total; DM1182 if not given')
+	parser.add_argument('--currency', action='append', default=[], help='currency or currencies; USD if not given')
+	parser.add_argument('--format', choices=('text', 'json', 'csv'), default='text')
+	args = parser.parse_args(argv)
+	skus = [sku for value in args.sku for sku in value.split(',') if sku] or ['DM1182']
+	currencies = [currency for value in args.currency for currency in value.split(',') if currency] or ['USD']
 	
+	rates = build_rates_index(list(load_rates(args.rates)))
+	cache = {}
+	if len(skus) == 1: 
+		transactions = format_transaction_details(scan_csv(args.trans, skus[0]))
+	else: 
+		transactions = format_transaction_details(stream_csv(args.trans))
+	totals, missing = calculate_sku_totals(transactions, skus, rates, cache, currencies)
+	if missing: 
+		print >> sys.stderr, 'No conversion found for %s' % ', '.join('%s-->%s' % pair for pair in sorted(missing))
+		return 1
 	
+	if args.format == 'json': 
+		import json
+		print json.dumps([{'sku': sku, 'currency': currency, 'total': str(totals[sku][currency])} 
+											for sku in skus for currency in currencies])
+	elif args.format == 'csv': 
+		writer = csv.writer(sys.stdout, lineterminator='\n')
+		writer.writerow(('sku', 'currency', 'total'))
+		writer.writerows((sku, currency, totals[sku][currency]) for sku in skus for currency in currencies)
+	else: 
+		for sku in skus: 
+			for currency in currencies: 
+				display_total(sku, totals[sku][currency], None if currencies == ['USD'] else currency)
+	return 0
 	
-
-
+if __name__ == '__main__':
+	sys.exit(main())
@@ -6,6 +6,9 @@ Created on Jan 27, 2014
 
 import os 
 import csv 
+import sys 
+import subprocess 
+import trade
 from trade import *
 import unittest
 
@@ -51,6 +54,26 @@ class Test(unittest.TestCase):
 		actual 	 = next(format_transaction_details(test_data))
 		self.assertEqual(expected, actual)
 		
+	def test_calculate_all_totals__by_sku__matches_calculate_grand_total(self):
+		trans = list(format_transaction_details(load_csv('TRANS.csv')))
+		totals = calculate_all_totals(trans, self.rates, self.cache)
+		self.assertEqual(float(totals[(self.target_sku,)]), 59482.47)
+		
+	def test_calculate_all_totals__by_sku_and_store__groups_by_both(self):
+		sample_trans = format_transaction_details(load_csv('SAMPLE_TRANS.csv'))
+		totals = calculate_all_totals(sample_trans, self.sample_rates, self.sample_cache, by=('sku', 'store'))
+		self.assertEqual(float(totals[('DM1182', 'Camden')]), 54.64)
+		
+	def test_stream_csv__matches_load_csv(self):
+		self.assertEqual(list(stream_csv('SAMPLE_TRANS.csv')), load_csv('SAMPLE_TRANS.csv'))
+		
+	def test_scan_csv__returns_only_matching_rows(self):
+		expected = [row for row in load_csv('TRANS.csv') if row[1] == self.target_sku]
+		self.assertEqual(list(scan_csv('TRANS.csv', self.target_sku)), expected)
+		
+	def test_load_rates__matches_xml_to_list(self):
+		self.assertEqual(list(load_rates('RATES.xml')), self.rates)
+		
 	def test_find_curreny_conversion__matching_to_from_fields__returns_one(self):
 		self.assertEqual(find_curreny_conversion(None, 'USD', 'USD', None), 1)
 		
@@ -67,11 +90,119 @@ class Test(unittest.TestCase):
 		actual   = find_curreny_conversion(self.rates, 'USD', 'EUR', self.cache)
 		self.assertEqual(round(actual,len('36701255262')), expected)
 		
+	def test_find_curreny_conversion__caches_every_conversion_found(self):
+		find_curreny_conversion(build_rates_index(self.rates), 'USD', 'AUD', self.cache)
+		self.assertTrue('FROM_AUD_TO_EUR' in self.cache)
+		self.assertEqual(self.cache['FROM_AUD_TO_USD'], 1.0169711)
+		
+	def test_find_curreny_conversion__no_match__caches_none(self):
+		find_curreny_conversion(self.rates, 'USD', 'ZZZ', self.cache)
+		self.assertEqual(self.cache['FROM_ZZZ_TO_USD'], None)
+		
+	def test_calculate_all_totals__builds_rates_index_once(self):
+		build = trade.build_rates_index
+		calls = []
+		trade.build_rates_index = lambda rates: calls.append(rates) or build(rates)
+		try:
+			calculate_all_totals(format_transaction_details(load_csv('TRANS.csv')), self.rates, {})
+		finally:
+			trade.build_rates_index = build
+		self.assertEqual(len(calls), 1)
+	
 	def test_calculate_grand_total__sample_trans__returns_134_22(self):
 		target_sku = 'DM1182'
 		total = sum(calculate_grand_total(self.sample_trans, target_sku, self.sample_rates, self.sample_cache))	
 		self.assertEqual(float(total), 134.22)
+		
+	def test_calculate_grand_totals__matches_calculate_grand_total_per_currency(self):
+		trans = list(format_transaction_details(load_csv('TRANS.csv')))
+		totals = calculate_grand_totals(trans, self.target_sku, self.rates, self.cache, ('USD', 'EUR', 'CAD'))
+		self.assertEqual(totals['USD'], decimal.Decimal('59482.47'))
+		for currency in ('EUR', 'CAD'): 
+			self.assertEqual(totals[currency], 
+											 sum(calculate_grand_total(trans, self.target_sku, self.rates, self.cache, currency)))
+	
+	def test_calculate_sku_totals__matches_calculate_grand_totals_per_sku(self):
+		trans = list(format_transaction_details(load_csv('TRANS.csv')))
+		totals, missing = calculate_sku_totals(trans, ('DM1182', 'DM1210'), self.rates, self.cache, ('USD', 'EUR'))
+		self.assertEqual(missing, set())
+		for sku in ('DM1182', 'DM1210'): 
+			self.assertEqual(totals[sku], calculate_grand_totals(trans, sku, self.rates, self.cache, ('USD', 'EUR')))
+		totals, missing = calculate_sku_totals(trans, ('DM1182',), self.rates, self.cache, ('XYZ',))
+		self.assertEqual(missing, set([('AUD', 'XYZ'), ('CAD', 'XYZ'), ('EUR', 'XYZ'), ('USD', 'XYZ')]))
+	
+	def test_calculate_grand_total_batch__matches_calculate_grand_total(self):
+		trans = list(format_transaction_details(load_csv('TRANS.csv')))
+		expected = sum(calculate_grand_total(trans, self.target_sku, self.rates, self.cache))
+		actual 	 = calculate_grand_total_batch(to_columns(trans), self.target_sku, self.rates, self.cache)
+		self.assertEqual(expected, actual)
+	
+	def test_calculate_grand_total_batch__keeps_fractions_of_a_cent(self):
+		trans = [Transaction('Utica', self.target_sku, 100.006, 'AUD'), 
+						 Transaction('Utica', self.target_sku, 1.0, 'USD')]
+		columns = to_columns(trans)
+		self.assertEqual(len(columns.inexact), 1)
+		self.assertEqual(calculate_grand_total_batch(columns, self.target_sku, self.rates, self.cache), 
+										 sum(calculate_grand_total(trans, self.target_sku, self.rates, self.cache)))
+	
+	def test_count_amounts__matches_counting_rows(self):
+		columns = to_columns(format_transaction_details(load_csv('TRANS.csv')))
+		sku_code = columns.sku_names.index(self.target_sku)
+		expected = Counter((currency_code, cents) for currency_code, cents, code in 
+											 zip(columns.currencies, columns.cents, columns.skus) if code == sku_code)
+		self.assertEqual(dict(count_amounts(columns, sku_code)), dict(expected))
+
+	
+	def test_load_columns__matches_to_columns(self):
+		trans = list(format_transaction_details(load_csv('TRANS.csv')))
+		columns = to_columns(trans)
+		save_columns(columns, 'TRANS.cols')
+		try:
+			loaded = load_columns('TRANS.cols')
+		finally:
+			os.remove(os.path.join('examples', 'TRANS.cols'))
+		self.assertEqual(loaded, columns)
+		self.assertEqual(calculate_grand_total_batch(loaded, self.target_sku, self.rates, self.cache), 
+										 sum(calculate_grand_total(trans, self.target_sku, self.rates, self.cache)))
+	
+	def test_load_columns__keeps_inexact_rows(self):
+		trans = list(format_transaction_details(load_csv('TRANS.csv')))
+		columns = to_columns(trans)
+		columns.inexact.append((0, columns.sku_names.index(self.target_sku), '10.006', 
+														columns.currency_names.index('USD')))
+		save_columns(columns, 'TRANS.cols')
+		try:
+			loaded = load_columns('TRANS.cols')
+		finally:
+			os.remove(os.path.join('examples', 'TRANS.cols'))
+		self.assertEqual(loaded.inexact, columns.inexact)
+		trans.append(Transaction(columns.store_names[0], self.target_sku, 10.006, 'USD'))
+		self.assertEqual(calculate_grand_total_batch(loaded, self.target_sku, self.rates, self.cache), 
+										 sum(calculate_grand_total(trans, self.target_sku, self.rates, self.cache)))
+	
+	def test_save_columns__packs_columns_whose_item_size_differs(self):
+		columns = to_columns(format_transaction_details(load_csv('TRANS.csv')))
+		layout = trade.COLUMNS_LAYOUT
+		_path = os.path.join('examples', 'TRANS.cols')
+		try:
+			save_columns(columns, 'TRANS.cols')
+			with open(_path, 'rb') as f: 
+				expected = f.read()
+			# as on platforms where a C long is 4 bytes
+			trade.COLUMNS_LAYOUT = (('cents', 'i', 'q', 8),) + layout[1:]
+			save_columns(columns, 'TRANS.cols')
+			with open(_path, 'rb') as f: 
+				self.assertEqual(f.read(), expected)
+			self.assertEqual(load_columns('TRANS.cols').cents.tolist(), columns.cents.tolist())
+		finally:
+			trade.COLUMNS_LAYOUT = layout
+			os.remove(_path)
 	
+	def test_import__loads_no_parsers__and_main_prints_total(self):
+		script = 'import sys, trade; print sorted(m for m in ("bs4", "xml.etree.cElementTree", "json") if m in sys.modules)'
+		self.assertEqual(subprocess.check_output([sys.executable, '-c', script]).strip(), '[]')
+		output = subprocess.check_output([sys.executable, 'trade.py', '--currency', 'USD,EUR', '--format', 'csv'])
+		self.assertEqual(output.splitlines(), ['sku,currency,total', 'DM1182,USD,59482.47', 'DM1182,EUR,43510.10'])	
 
 if __name__ == "__main__":
 		#import sys;sys.argv = ['', 'Test.testName']
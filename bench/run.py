@@ -0,0 +1,155 @@
+"""Time both Python implementations on synthetic files of increasing size.
+
+For each combination of currency count, rate graph density and row count, synthetic files are
+written with synth.py and every phase (loading rates, deriving missing rates, tallying) of
+InternationalTrade (003/main.py) and of the 006/trade.py functions is timed. 003's rates are
+also derived with the 'best' path policy (deriveBest), whose searches cost the most, as random
+rates are full of arbitrage cycles. The timings are written as JSON, one result per phase, so
+runs can be compared to catch scaling regressions:
+
+    python run.py --currencies 10,100,1000 --rows 10000,1000000 --density 0.05 --out results.json
+"""
+
+from argparse import ArgumentParser
+from datetime import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+from timeit import default_timer
+
+import synth
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(here, '..', '003'), os.path.join(here, '..', '006')]
+
+from main import InternationalTrade
+import trade
+
+
+def timed(results, phase, func, *args):
+    """Time one call and record it in results.
+
+    Returns:
+        Whatever func returned.
+    """
+
+    start = default_timer()
+    value = func(*args)
+    results[phase] = default_timer() - start
+
+    return value
+
+
+def bench003(ratesFile, transFile, sku):
+    """Time the phases of InternationalTrade.
+
+    Returns:
+        A dictionary of seconds, keyed by phase.
+    """
+
+    results = {}
+    it = InternationalTrade()
+
+    timed(results, 'getRates', it.getRates, ratesFile)
+    timed(results, 'derive', it.buildClosure)
+
+    best = InternationalTrade(policy='best')
+    best.getRates(ratesFile)
+    timed(results, 'deriveBest', best.buildClosure)
+    timed(results, 'tally', it.tallyTransactions, transFile, sku, 'USD')
+    timed(results, 'tallyFixed', it.tallyTransactions, transFile, sku, 'USD', 'fixed')
+    timed(results, 'tallyAll', it.tallyAll, transFile, 'USD')
+
+    columns = timed(results, 'getColumns', it.getColumns, transFile)
+    timed(results, 'tallyColumns', it.tallyColumns, columns, sku, 'USD')
+
+    return results
+
+
+def bench006(ratesFile, transFile, sku, currencies):
+    """Time the phases of the trade module.
+
+    Returns:
+        A dictionary of seconds, keyed by phase.
+    """
+
+    def derive(rates):
+        index = trade.build_rates_index(rates)
+        cache = trade.build_rates_cache(rates)
+        for currency in currencies:
+            trade.find_curreny_conversion(index, 'USD', currency, cache)
+        return index, cache
+
+    def tally(index, cache):
+        transactions = trade.format_transaction_details(trade.stream_csv(transFile))
+        return sum(trade.calculate_grand_total(transactions, sku, index, cache))
+
+    results = {}
+
+    rates = timed(results, 'loadRates', lambda: list(trade.load_rates(ratesFile)))
+    index, cache = timed(results, 'derive', derive, rates)
+    timed(results, 'tally', tally, index, cache)
+
+    return results
+
+
+def run(currencyCounts, rowCounts, density, seed=0):
+    """Benchmark every combination of sizes.
+
+    Returns:
+        A list of result dictionaries.
+    """
+
+    results = []
+    workDir = tempfile.mkdtemp()
+    ratesFile = os.path.join(workDir, 'RATES.xml')
+    transFile = os.path.join(workDir, 'TRANS.csv')
+
+    try:
+        for currencyCount in currencyCounts:
+            codes = synth.currencyCodes(currencyCount)
+            rateCount = synth.writeRates(ratesFile, codes, density, seed)
+
+            for rowCount in rowCounts:
+                synth.writeTransactions(transFile, rowCount, codes, seed=seed)
+                size = {'currencies': currencyCount, 'rates': rateCount, 'density': density,
+                        'rows': rowCount}
+
+                for implementation, phases in (
+                        ('003', bench003(ratesFile, transFile, 'DM0000')),
+                        ('006', bench006(ratesFile, transFile, 'DM0000', codes))):
+                    for phase, seconds in sorted(phases.items()):
+                        result = dict(size, implementation=implementation, phase=phase,
+                                      seconds=seconds)
+                        print "%(implementation)s %(phase)-12s currencies=%(currencies)-5d " \
+                              "rows=%(rows)-10d %(seconds).4fs" % result
+                        results.append(result)
+    finally:
+        shutil.rmtree(workDir)
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Benchmark both implementations on synthetic files.")
+    parser.add_argument('--currencies', default='10,100',
+                        help="comma separated currency counts (10 to 1000)")
+    parser.add_argument('--rows', default='10000,100000',
+                        help="comma separated transaction counts (10k to 100M)")
+    parser.add_argument('--density', type=float, default=0.1,
+                        help="probability of a direct rate between two currencies")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='bench_results.json',
+                        help="file to write the JSON results to")
+    args = parser.parse_args()
+
+    results = run([int(n) for n in args.currencies.split(',')],
+                  [int(n) for n in args.rows.split(',')], args.density, args.seed)
+
+    with open(args.out, 'w') as f:
+        json.dump({'python': platform.python_version(),
+                   'started': datetime.utcnow().isoformat(),
+                   'results': results}, f, indent=2, sort_keys=True)
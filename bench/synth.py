@@ -0,0 +1,117 @@
+"""Synthetic rates and transactions files for benchmarking.
+
+The files have the same format as RATES.xml and TRANS.csv, at any size:
+
+    python synth.py --currencies 100 --density 0.05 --rows 1000000 --out /tmp/bench
+"""
+
+from argparse import ArgumentParser
+from itertools import product
+import os
+import random
+import string
+
+
+def currencyCodes(count):
+    """Three letter currency codes, starting with USD.
+
+    Returns:
+        A list of count distinct codes.
+    """
+
+    codes = ['USD']
+    for letters in product(string.ascii_uppercase, repeat=3):
+        if len(codes) == count:
+            break
+
+        code = ''.join(letters)
+        if code != 'USD':
+            codes.append(code)
+
+    return codes
+
+
+def writeRates(ratesFile, currencies, density, seed=0):
+    """Write a rates XML file for a random rates graph.
+
+    Every currency has a rate to and from the next one, so every pair can be converted; each
+    other ordered pair of currencies has a direct rate with probability 'density'.
+
+    Args:
+        ratesFile (str): Path of the file to write.
+        currencies (list of str): Currency codes.
+        density (float): Probability of a direct rate between two currencies, from 0 to 1.
+        seed (opt int): Random seed.
+
+    Returns:
+        The number of rates written.
+    """
+
+    rng = random.Random(seed)
+    count = len(currencies)
+
+    pairs = set()
+    for i in range(count - 1):
+        pairs.add((i, i + 1))
+        pairs.add((i + 1, i))
+
+    for i in range(count):
+        for j in range(count):
+            if i != j and rng.random() < density:
+                pairs.add((i, j))
+
+    with open(ratesFile, 'w') as f:
+        f.write('<?xml version="1.0"?>\n<rates>\n')
+        for i, j in sorted(pairs):
+            f.write("  <rate>\n    <from>%s</from>\n    <to>%s</to>\n"
+                    "    <conversion>%.4f</conversion>\n  </rate>\n"
+                    % (currencies[i], currencies[j], rng.uniform(0.5, 2)))
+        f.write('</rates>\n')
+
+    return len(pairs)
+
+
+def writeTransactions(transFile, rows, currencies, skus=1000, stores=50, seed=0):
+    """Write a transactions CSV file of random sales.
+
+    Args:
+        transFile (str): Path of the file to write.
+        rows (int): Number of transactions.
+        currencies (list of str): Currency codes.
+        skus (opt int): Number of distinct SKUs, DM0000 onwards.
+        stores (opt int): Number of distinct stores.
+        seed (opt int): Random seed.
+
+    """
+
+    rng = random.Random(seed)
+    skuNames = ['DM%04d' % i for i in range(skus)]
+    storeNames = ['Store%02d' % i for i in range(stores)]
+
+    with open(transFile, 'w') as f:
+        f.write('store,sku,amount\n')
+
+        lines = []
+        for _ in xrange(rows):
+            lines.append("%s,%s,%d.%02d %s\n" % (rng.choice(storeNames), rng.choice(skuNames),
+                                                 rng.randint(1, 99), rng.randint(0, 99),
+                                                 rng.choice(currencies)))
+            if len(lines) == 10000:
+                f.writelines(lines)
+                lines = []
+
+        f.writelines(lines)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Write synthetic RATES.xml and TRANS.csv files.")
+    parser.add_argument('--currencies', type=int, default=10)
+    parser.add_argument('--density', type=float, default=0.1)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='.')
+    args = parser.parse_args()
+
+    codes = currencyCodes(args.currencies)
+    writeRates(os.path.join(args.out, 'RATES.xml'), codes, args.density, args.seed)
+    writeTransactions(os.path.join(args.out, 'TRANS.csv'), args.rows, codes, seed=args.seed)